@@ -1,10 +1,10 @@
 # app/emqx_api.py
 
 import os, logging, asyncio
-from typing import Any, Dict, List, Optional
-import httpx
+from typing import Any, Dict, List, Optional, Tuple
 
 from app.utils.db import get_db
+from app.utils.http_clients import get_http_client
 # ---------------------------------------------------
 # Configuración EMQX Management API
 # ---------------------------------------------------
@@ -23,27 +23,37 @@ router = APIRouter(prefix="/emqx", tags=["emqx"])
 # ---------------------------------------------------
 async def emqx_get(path: str) -> Any:
     url = f"{EMQX_API_BASE}{path}"
-    async with httpx.AsyncClient() as client:
-        r = await client.get(url, auth=(EMQX_APP_USER, EMQX_APP_PASS))
-        r.raise_for_status()
-        return r.json()
+    client = get_http_client("emqx")
+    r = await client.get(url, auth=(EMQX_APP_USER, EMQX_APP_PASS))
+    r.raise_for_status()
+    return r.json()
 
 async def emqx_post(path: str, payload: dict) -> Any:
     url = f"{EMQX_API_BASE}{path}"
-    async with httpx.AsyncClient() as client:
-        r = await client.post(
-            url, json=payload,
-            auth=(EMQX_APP_USER, EMQX_APP_PASS)
-        )
-        r.raise_for_status()
-        return r.json()
+    client = get_http_client("emqx")
+    r = await client.post(
+        url, json=payload,
+        auth=(EMQX_APP_USER, EMQX_APP_PASS)
+    )
+    r.raise_for_status()
+    return r.json()
+
+async def emqx_put(path: str, payload: dict) -> Any:
+    url = f"{EMQX_API_BASE}{path}"
+    client = get_http_client("emqx")
+    r = await client.put(
+        url, json=payload,
+        auth=(EMQX_APP_USER, EMQX_APP_PASS)
+    )
+    r.raise_for_status()
+    return r.json()
 
 async def emqx_delete(path: str) -> Any:
     url = f"{EMQX_API_BASE}{path}"
-    async with httpx.AsyncClient() as client:
-        resp = await client.delete(url, auth=(EMQX_APP_USER, EMQX_APP_PASS))
-        resp.raise_for_status()
-        return resp.json()
+    client = get_http_client("emqx")
+    resp = await client.delete(url, auth=(EMQX_APP_USER, EMQX_APP_PASS))
+    resp.raise_for_status()
+    return resp.json()
 # ---------------------------------------------------
 # Variables globales
 # ---------------------------------------------------
@@ -132,20 +142,86 @@ async def init_emqx_resources() -> None:
     )
 
 # ---------------------------------------------------
-# INIT creacion de alarmas (regla)
+# Definición de reglas (SAVE y ALARM)
 # ---------------------------------------------------
-async def crear_regla_alarma(
+SAVE_RULE_PREFIX = "SAVER-RULE "
+ALARM_RULE_PREFIX = "ALARM "
+
+# Granularidad de las reglas SAVE:
+# device: una regla por dispositivo (comportamiento original).
+# tenant: una regla por usuario, iot/{username}/+/+/sdata.
+# global: una única regla, iot/+/+/+/sdata.
+# En tenant/global la API comprueba que el dispositivo del topic existe.
+SAVE_RULE_MODE = os.getenv("SAVE_RULE_MODE", "device").lower()
+if SAVE_RULE_MODE not in ("device", "tenant", "global"):
+    raise RuntimeError(f"SAVE_RULE_MODE inválido: {SAVE_RULE_MODE!r}")
+
+def save_rules_consolidated() -> bool:
+    return SAVE_RULE_MODE != "device"
+
+def save_rule_scope(username: str, device_id: str) -> Tuple[Optional[str], Optional[str]]:
+    """(username, device_id) de la regla SAVE que cubre a un dispositivo; None = comodín."""
+    if SAVE_RULE_MODE == "global":
+        return (None, None)
+    if SAVE_RULE_MODE == "tenant":
+        return (username, None)
+    return (username, device_id)
+
+def construir_regla_save(
+    username: Optional[str],
+    device_id: Optional[str],
+    resource_id: Optional[str]
+) -> dict:
+    """
+    Regla que reenvía al saver-webhook los mensajes con payload.save = 1 de
+    iot/{username}/{device_id}/+/sdata; username/device_id a None se
+    sustituyen por el comodín +.
+    """
+    topic = f"iot/{username or '+'}/{device_id or '+'}/+/sdata"
+    rawsql = (
+        f"SELECT payload AS payload, topic "
+        f"FROM \"{topic}\" "
+        f"WHERE payload.save = 1"
+    )
+    if username is None:
+        payload_tmpl = '{"payload":${payload},"topic":"${topic}"}'
+        description = f"{SAVE_RULE_PREFIX}*"
+    else:
+        payload_tmpl = (
+            f'{{"username":"{username}",'
+            f'"payload":${{payload}},'
+            f'"topic":"${{topic}}"}}'
+        )
+        description = f"{SAVE_RULE_PREFIX}{username}" + (f"/{device_id}" if device_id else "")
+    return {
+        "rawsql": rawsql,
+        "actions": [
+            {
+                "name": "data_to_webserver",
+                "params": {
+                    "$resource": resource_id,
+                    "payload_tmpl": payload_tmpl
+                }
+            }
+        ],
+        "description": description,
+        "enabled": True
+    }
+
+def construir_regla_alarma(
     username: str,
     device_id: str,
     variable_id: str,
     field: str,
     operator: str,
-    threshold: float
-) -> str:
+    threshold: float,
+    resource_id: Optional[str]
+) -> dict:
     """
-    Crea y devuelve el ID de una regla de alarma instantánea en EMQX para:
-      iot/{username}/{device_id}/{variable_id}/sdata
-    Dispara en el primer evento que cumpla payload.{field} {operator} {threshold}.
+    Regla de alarma instantánea: dispara en cada evento de
+    iot/{username}/{device_id}/{variable_id}/sdata que cumpla
+    payload.{field} {operator} {threshold}. El cuerpo lleva el rule_id para
+    que el webhook distinga varias reglas sobre la misma variable.
     """
     valid_ops = {">", "<", ">=", "<=", "=", "!="}
     if operator not in valid_ops:
@@ -155,31 +231,53 @@ async def crear_regla_alarma(
     condition = f"payload.{field} {operator} {threshold}"
 
     rawsql = (
-        f"SELECT payload.{field} AS {field}, topic "
+        f"SELECT payload.{field} AS {field}, topic, metadata.rule_id AS rule_id "
         f"FROM \"{topic}\" "
         f"WHERE {condition}"
     )
 
-    new_rule = {
+    return {
         "rawsql": rawsql,
         "actions": [
             {
                 "name": "data_to_webserver",
                 "params": {
-                    "$resource": alarmResource.get("id"),
+                    "$resource": resource_id,
                     "payload_tmpl": (
                         f'{{"device":"{device_id}",'
                         f'"variable":"{variable_id}",'
-                        f'"{field}":${{{field}}},"topic":"${{topic}}"}}'
+                        f'"{field}":${{{field}}},"topic":"${{topic}}",'
+                        f'"rule_id":"${{rule_id}}"}}'
                     )
                 }
             }
         ],
-        "description": f"ALARM {username}/{device_id}/{variable_id}/{field}{operator}{threshold}",
+        "description": f"{ALARM_RULE_PREFIX}{username}/{device_id}/{variable_id}/{field}{operator}{threshold}",
         "enabled": True
     }
 
-    logging.info("Creando regla instantánea con SQL:\n%s", rawsql)
+# ---------------------------------------------------
+# INIT creacion de alarmas (regla)
+# ---------------------------------------------------
+async def crear_regla_alarma(
+    username: str,
+    device_id: str,
+    variable_id: str,
+    field: str,
+    operator: str,
+    threshold: float
+) -> str:
+    """
+    Crea y devuelve el ID de una regla de alarma instantánea en EMQX para:
+      iot/{username}/{device_id}/{variable_id}/sdata
+    Dispara en el primer evento que cumpla payload.{field} {operator} {threshold}.
+    """
+    new_rule = construir_regla_alarma(
+        username, device_id, variable_id, field, operator, threshold,
+        alarmResource.get("id")
+    )
+
+    logging.info("Creando regla instantánea con SQL:\n%s", new_rule["rawsql"])
     resp = await emqx_post("/rules", new_rule)
     logging.info("EMQX POST /rules response: %r", resp)
 
@@ -1,9 +1,19 @@
 import os
+import copy
+import json
+import asyncio
+import hashlib
 import logging
+from functools import lru_cache
+from typing import Dict, List
+
 import httpx
 from app.models.schemas import DashboardConfig
 from dotenv import load_dotenv, set_key
 
+from app.utils.http_clients import get_http_client
+from app.apis.influx_api import build_series_query
+
 GRAFANA_URL= os.getenv("GRAFANA_URL")
 GRAFANA_API_KEY = os.getenv("GRAFANA_API_KEY")
 DATASOURCE_UID  = os.getenv("DATASOURCE_UID")
@@ -15,7 +25,7 @@ ADMIN_PASSWORD = os.getenv('GRAFANA_ADMIN_PASSWORD', 'admin123..')
 # CREAR SERVICE ACCOUNTS Y TOKEN
 #-------------------------------------------------------------
 
-def create_service_account(
+async def create_service_account(
     name: str = 'sa-my-automation',
     role: str = 'Admin',
     is_disabled: bool = False
@@ -29,11 +39,12 @@ def create_service_account(
         "role": role,
         "isDisabled": is_disabled
     }
-    resp = httpx.post(url, auth=(ADMIN_USER, ADMIN_PASSWORD), json=payload)
+    client = get_http_client("grafana")
+    resp = await client.post(url, auth=(ADMIN_USER, ADMIN_PASSWORD), json=payload)
     resp.raise_for_status()
     return resp.json()
 
-def create_service_account_token(
+async def create_service_account_token(
     service_account_id: int,
     token_name: str = 'token-for-automation',
     expiration_seconds: int = 0
@@ -46,11 +57,12 @@ def create_service_account_token(
         "name": token_name,
         "expirationSeconds": expiration_seconds
     }
-    resp = httpx.post(url, auth=(ADMIN_USER, ADMIN_PASSWORD), json=payload)
+    client = get_http_client("grafana")
+    resp = await client.post(url, auth=(ADMIN_USER, ADMIN_PASSWORD), json=payload)
     resp.raise_for_status()
     return resp.json()
 
-def setup_grafana_api_key(
+async def setup_grafana_api_key(
     sa_name: str = 'sa-my-automation',
     # ahora por defecto creamos como Admin
     sa_role: str = 'Admin',
@@ -62,11 +74,11 @@ def setup_grafana_api_key(
     y devuelve el token para almacenar en GRAFANA_API_KEY.
     """
     # 1) Creamos la cuenta en modo Admin
-    sa = create_service_account(name=sa_name, role=sa_role, is_disabled=False)
+    sa = await create_service_account(name=sa_name, role=sa_role, is_disabled=False)
     sa_id = sa.get('id')
 
     # 2) Generamos el token
-    token_resp = create_service_account_token(
+    token_resp = await create_service_account_token(
         service_account_id=sa_id,
         token_name=token_name,
         expiration_seconds=expiration_seconds
@@ -106,14 +118,14 @@ async def ensure_datasource() -> None:
         }
     }
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(f"{GRAFANA_URL}/api/datasources", headers=headers, json=payload)
-        if resp.status_code == 200:
-            logging.info("[Grafana] Datasource creado")
-        elif resp.status_code == 409:
-            logging.info("[Grafana] Datasource ya existe")
-        else:
-            resp.raise_for_status()
+    client = get_http_client("grafana")
+    resp = await client.post(f"{GRAFANA_URL}/api/datasources", headers=headers, json=payload)
+    if resp.status_code == 200:
+        logging.info("[Grafana] Datasource creado")
+    elif resp.status_code == 409:
+        logging.info("[Grafana] Datasource ya existe")
+    else:
+        resp.raise_for_status()
 #-------------------------------------------------------------
 # CREAR DASHBOARD DINAMICO
 #-------------------------------------------------------------
@@ -208,9 +220,176 @@ async def create_dashboard_dynamic(cfg: DashboardConfig) -> str:
         "overwrite": True
     }
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(f"{base_url}/api/dashboards/db", headers=headers, json=dashboard_json)
+    client = get_http_client("grafana")
+    resp = await client.post(f"{base_url}/api/dashboards/db", headers=headers, json=dashboard_json)
+    resp.raise_for_status()
+    url = resp.json().get("url")
+    logging.info(f"[Grafana] Dashboard dinámico creado: {url}")
+    return url
+
+#-------------------------------------------------------------
+# DASHBOARDS POR DISPOSITIVO (LOTE)
+#-------------------------------------------------------------
+GRAFANA_DASHBOARD_CONCURRENCY = int(os.getenv("GRAFANA_DASHBOARD_CONCURRENCY", 8))
+
+# uid de carpeta por usuario ya creado/verificado en este proceso
+_user_folders: Dict[str, str] = {}
+
+
+def _grafana_headers() -> dict:
+    grafana_api_key = os.getenv("GRAFANA_API_KEY")
+    if not grafana_api_key:
+        raise RuntimeError("Falta GRAFANA_API_KEY en el entorno")
+    return {
+        "Authorization": f"Bearer {grafana_api_key}",
+        "Content-Type": "application/json"
+    }
+
+def _grafana_uid(prefix: str, *partes: str) -> str:
+    # Grafana limita los uid a 40 caracteres: se usa un hash estable
+    return f"{prefix}-" + hashlib.sha1("/".join(partes).encode()).hexdigest()[:24]
+
+
+async def ensure_user_folder(username: str) -> str:
+    """Crea (si no existe) la carpeta de Grafana del usuario y devuelve su uid."""
+    uid = _user_folders.get(username)
+    if uid:
+        return uid
+
+    uid = _grafana_uid("user", username)
+    base_url = os.getenv("GRAFANA_URL", "http://localhost:3000").rstrip("/")
+    client = get_http_client("grafana")
+    resp = await client.post(
+        f"{base_url}/api/folders",
+        headers=_grafana_headers(),
+        json={"uid": uid, "title": f"IoT - {username}"}
+    )
+    # 409/412: la carpeta ya existe (mismo uid o mismo título)
+    if resp.status_code not in (200, 409, 412):
         resp.raise_for_status()
-        url = resp.json().get("url")
-        logging.info(f"[Grafana] Dashboard dinámico creado: {url}")
-        return url
+    _user_folders[username] = uid
+    return uid
+
+
+@lru_cache(maxsize=1)
+def _device_dashboard_template() -> str:
+    """
+    Plantilla JSON (serializada una sola vez) del dashboard de un dispositivo;
+    los paneles se generan por variable a partir de `panel`.
+    """
+    datasource_uid = os.getenv("DATASOURCE_UID", "measurements")
+    return json.dumps({
+        "dashboard": {
+            "id": None,
+            "uid": None,
+            "title": None,
+            "tags": ["iot", "device"],
+            "timezone": "browser",
+            "schemaVersion": 30,
+            "version": 0,
+            "refresh": "10s",
+            "time": {"from": "now-1h", "to": "now"},
+            "panels": []
+        },
+        "panel": {
+            "type": "timeseries",
+            "title": None,
+            "gridPos": {"h": 8, "w": 24, "x": 0, "y": 0},
+            "datasource": {"uid": datasource_uid},
+            "targets": [
+                {
+                    "refId": "A",
+                    "queryType": "flux",
+                    "datasource": {"uid": datasource_uid},
+                    "query": None
+                }
+            ],
+            "fieldConfig": {"defaults": {}, "overrides": []},
+            "options": {}
+        },
+        "folderUid": None,
+        "overwrite": True
+    })
+
+
+def build_device_dashboard(
+    username: str,
+    device_id: str,
+    device_name: str,
+    variables: List[dict],
+    folder_uid: str,
+    bucket: str,
+    range_: str = "-1h",
+    every: str = "1m",
+    fn: str = "mean"
+) -> dict:
+    """Dashboard de un dispositivo con un panel por variable."""
+    plantilla = json.loads(_device_dashboard_template())
+    panel_base = plantilla.pop("panel")
+    dashboard = plantilla["dashboard"]
+    dashboard["uid"] = _grafana_uid("dev", username, device_id)
+    dashboard["title"] = f"{device_name or device_id} ({device_id})"
+    dashboard["time"]["from"] = f"now{range_}" if range_.startswith("-") else range_
+
+    for idx, var in enumerate(variables, start=1):
+        panel = copy.deepcopy(panel_base)
+        panel["id"] = idx
+        # Variables sin variable_name: el panel se titula con su id
+        titulo = var.get("name") or var["variable_id"]
+        panel["title"] = titulo + (f" [{var['unit']}]" if var.get("unit") else "")
+        panel["gridPos"]["y"] = (idx - 1) * 8
+        # Tags escapados como literales Flux; every/fn los valida la ruta
+        panel["targets"][0]["query"] = build_series_query(
+            bucket,
+            {"username": username, "device_id": device_id, "variable_id": var["variable_id"]},
+            start="v.timeRangeStart",
+            stop="v.timeRangeStop",
+            every=every,
+            fn=fn
+        )
+        dashboard["panels"].append(panel)
+
+    plantilla["folderUid"] = folder_uid
+    return plantilla
+
+
+async def create_device_dashboards(
+    username: str,
+    devices: List[dict],
+    bucket: str,
+    range_: str = "-1h",
+    every: str = "1m",
+    fn: str = "mean"
+) -> dict:
+    """
+    Crea/actualiza en la carpeta del usuario un dashboard por dispositivo
+    (`devices`: [{device_id, name, variables: [...]}]), con como mucho
+    GRAFANA_DASHBOARD_CONCURRENCY peticiones simultáneas.
+    """
+    folder_uid = await ensure_user_folder(username)
+    base_url = os.getenv("GRAFANA_URL", "http://localhost:3000").rstrip("/")
+    headers = _grafana_headers()
+    client = get_http_client("grafana")
+    sem = asyncio.Semaphore(GRAFANA_DASHBOARD_CONCURRENCY)
+
+    async def _crear(device):
+        body = build_device_dashboard(
+            username, device["device_id"], device.get("name"), device["variables"],
+            folder_uid, bucket, range_, every, fn
+        )
+        async with sem:
+            resp = await client.post(f"{base_url}/api/dashboards/db", headers=headers, json=body)
+        resp.raise_for_status()
+        return resp.json().get("url")
+
+    resultados = await asyncio.gather(*(_crear(d) for d in devices), return_exceptions=True)
+    dashboards, errors = [], []
+    for device, res in zip(devices, resultados):
+        if isinstance(res, Exception):
+            logging.error(f"[Grafana] Error creando dashboard de {device['device_id']}: {res!r}")
+            errors.append({"device_id": device["device_id"], "error": str(res)})
+        else:
+            dashboards.append({"device_id": device["device_id"], "url": res})
+
+    logging.info(f"[Grafana] {len(dashboards)} dashboards de dispositivo creados para {username}")
+    return {"folder_uid": folder_uid, "dashboards": dashboards, "errors": errors}
@@ -1,39 +1,255 @@
 # app/utils/influx_api.py
 
 import os
+import csv
 import logging
-import aiohttp
 from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
 from dotenv import load_dotenv
+import httpx
+
+from app.utils.http_clients import get_http_client
+from app.utils.batching import BatchFlusher
 
 # (Opcional) recarga las variables del .env en cada import
 load_dotenv(".env", override=True)
 
-async def write_to_influx(measurement: str, tags: dict, fields: dict, timestamp: datetime):
+# ---------------------------------------------------
+# Configuración del writer por lotes
+# ---------------------------------------------------
+INFLUX_BATCH_SIZE = int(os.getenv("INFLUX_BATCH_SIZE", 5000))
+INFLUX_FLUSH_INTERVAL_MS = int(os.getenv("INFLUX_FLUSH_INTERVAL_MS", 200))
+INFLUX_QUEUE_MAX = int(os.getenv("INFLUX_QUEUE_MAX", 100000))
+
+# Respuestas de Influx que no mejoran reintentando (datos inválidos, p. ej.
+# conflicto de tipo de campo)
+INFLUX_PERMANENT_ERRORS = (400, 422)
+
+
+# ---------------------------------------------------
+# Protocolo de línea
+# ---------------------------------------------------
+def _escape_key(value: str) -> str:
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace(",", "\\,")
+        .replace("=", "\\=")
+        .replace(" ", "\\ ")
+    )
+
+def _format_field(value) -> str:
+    # bool antes que int: bool es subclase de int
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        # Sin sufijo "i": los valores se guardan siempre como float
+        return repr(float(value))
+    text = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{text}"'
+
+def build_line(measurement: str, tags: dict, fields: dict, timestamp: datetime) -> str:
+    """
+    Codifica un punto en protocolo de línea de Influx (precisión ns).
+    """
+    tags_str = "".join(f",{_escape_key(k)}={_escape_key(v)}" for k, v in tags.items())
+    fields_str = ",".join(f"{_escape_key(k)}={_format_field(v)}" for k, v in fields.items())
+    return f"{_escape_key(measurement)}{tags_str} {fields_str} {int(timestamp.timestamp() * 1e9)}"
+
+
+def _write_request(bucket: Optional[str] = None):
     # Leer en tiempo de ejecución
     INFLUX_URL   = os.getenv("INFLUX_URL", "http://influxdb:8086")
     INFLUX_TOKEN = os.getenv("INFLUX_AUTH_TOKEN")
     INFLUX_ORG   = os.getenv("INFLUX_ORG", "my-org")
-    INFLUX_BUCKET= os.getenv("INFLUX_BUCKET", "measurements")
+    INFLUX_BUCKET= bucket or os.getenv("INFLUX_BUCKET", "measurements")
 
     if not INFLUX_TOKEN:
         raise RuntimeError("Falta INFLUX_AUTH_TOKEN en el entorno")
 
-    # Construye la línea en protocolo de Influx
-    tags_str   = ",".join(f"{k}={v}" for k, v in tags.items())
-    fields_str = ",".join(f"{k}={v}" for k, v in fields.items())
-    line = f"{measurement},{tags_str} {fields_str} {int(timestamp.timestamp() * 1e9)}"
-
     url = f"{INFLUX_URL}/api/v2/write?org={INFLUX_ORG}&bucket={INFLUX_BUCKET}&precision=ns"
     headers = {
         "Authorization": f"Token {INFLUX_TOKEN}",
         "Content-Type": "text/plain; charset=utf-8"
     }
+    return url, headers
+
+
+async def post_lines_to_influx(lines: List[str], bucket: Optional[str] = None) -> httpx.Response:
+    """POST multilínea a /api/v2/write; devuelve la respuesta sin interpretarla."""
+    url, headers = _write_request(bucket)
+    client = get_http_client("influx")
+    return await client.post(url, headers=headers, content="\n".join(lines))
+
+
+async def write_lines_to_influx(lines: List[str], bucket: Optional[str] = None) -> bool:
+    """
+    Envía varias líneas en una sola petición (cuerpo multilínea).
+    Devuelve False si Influx no aceptó la escritura.
+    """
+    resp = await post_lines_to_influx(lines, bucket)
+    if resp.status_code != 204:
+        logging.error(f"[Influx] Error al escribir {len(lines)} líneas: {resp.status_code} {resp.text}")
+        return False
+    logging.debug("[Influx] Escritas %d líneas", len(lines))
+    return True
+
+
+async def write_to_influx(measurement: str, tags: dict, fields: dict, timestamp: datetime):
+    await write_lines_to_influx([build_line(measurement, tags, fields, timestamp)])
+
+
+# ---------------------------------------------------
+# Consultas Flux
+# ---------------------------------------------------
+def flux_string(value: str) -> str:
+    """Literal de string Flux con comillas y barras escapadas."""
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+# Funciones Flux que devuelven una fila sin _time (el resto son selectores)
+FLUX_AGGREGATES = {"mean", "sum", "count", "median"}
+
+def build_series_query(
+    bucket: str,
+    tags: Dict[str, str],
+    start: str,
+    stop: Optional[str] = None,
+    every: Optional[str] = None,
+    fn: Optional[str] = None,
+    measurement: str = "iot_data",
+    field: str = "value"
+) -> str:
+    """
+    Construye la consulta Flux de una serie (mismos filtros que los paneles
+    de create_dashboard_dynamic), opcionalmente agregada con aggregateWindow.
+    `start`, `stop` y `every` deben venir ya validados por el llamador.
+    """
+    tag_filter = " and ".join(f"r[{flux_string(k)}] == {flux_string(v)}" for k, v in tags.items())
+    rango = f"start: {start}" + (f", stop: {stop}" if stop else "")
+    flux = (
+        f"from(bucket: {flux_string(bucket)})"
+        f" |> range({rango})"
+        f" |> filter(fn: (r) => r._measurement == {flux_string(measurement)})"
+        f" |> filter(fn: (r) => r._field == {flux_string(field)})"
+        f" |> filter(fn: (r) => {tag_filter})"
+    )
+    if every:
+        flux += f" |> aggregateWindow(every: {every}, fn: {fn or 'mean'}, createEmpty: false)"
+    elif fn:
+        flux += f" |> {fn}()"
+        # Los agregados (a diferencia de los selectores) eliminan _time:
+        # el punto único se fecha al final del rango, como aggregateWindow
+        if fn in FLUX_AGGREGATES:
+            flux += ' |> duplicate(column: "_stop", as: "_time")'
+    return flux + ' |> keep(columns: ["_time", "_value"])'
+
+
+async def query_influx_points(flux: str) -> List[List[Any]]:
+    """
+    Ejecuta una consulta Flux y devuelve [[_time, _value], ...]. La respuesta
+    CSV se lee en streaming línea a línea desde el cliente compartido.
+    """
+    INFLUX_URL   = os.getenv("INFLUX_URL", "http://influxdb:8086")
+    INFLUX_TOKEN = os.getenv("INFLUX_AUTH_TOKEN")
+    INFLUX_ORG   = os.getenv("INFLUX_ORG", "my-org")
+    if not INFLUX_TOKEN:
+        raise RuntimeError("Falta INFLUX_AUTH_TOKEN en el entorno")
+
+    headers = {
+        "Authorization": f"Token {INFLUX_TOKEN}",
+        "Accept": "application/csv",
+        "Content-Type": "application/json"
+    }
+    body = {"query": flux, "dialect": {"header": True, "annotations": []}}
+
+    points: List[List[Any]] = []
+    client = get_http_client("influx")
+    async with client.stream("POST", f"{INFLUX_URL}/api/v2/query?org={INFLUX_ORG}", headers=headers, json=body) as resp:
+        if resp.status_code != 200:
+            text = (await resp.aread()).decode("utf-8", "replace")
+            raise RuntimeError(f"Influx respondió {resp.status_code}: {text}")
+
+        # Cada tabla empieza con su cabecera; las tablas se separan con una línea vacía
+        time_idx = value_idx = None
+        async for line in resp.aiter_lines():
+            if not line.strip():
+                time_idx = value_idx = None
+                continue
+            row = next(csv.reader([line]))
+            if time_idx is None:
+                time_idx, value_idx = row.index("_time"), row.index("_value")
+                continue
+            try:
+                points.append([row[time_idx], float(row[value_idx])])
+            except ValueError:
+                points.append([row[time_idx], row[value_idx]])
+    return points
+
+
+# ---------------------------------------------------
+# Writer por lotes con flush en segundo plano
+# ---------------------------------------------------
+class InfluxWriter(BatchFlusher):
+    """
+    Encola líneas y las envía en cuerpos multilínea cuando se alcanza
+    `batch_size` líneas o pasan `flush_interval` segundos desde la primera
+    línea del lote. La cola es acotada: si se llena, `write` espera.
+    Reescribir el mismo punto en Influx es idempotente, así que reenviar
+    un lote interrumpido es seguro.
+    """
+
+    name = "influx"
+
+    def __init__(
+        self,
+        bucket: Optional[str] = None,
+        batch_size: int = INFLUX_BATCH_SIZE,
+        flush_interval: float = INFLUX_FLUSH_INTERVAL_MS / 1000,
+        max_queue: int = INFLUX_QUEUE_MAX
+    ):
+        super().__init__(batch_size, flush_interval, max_queue)
+        self.bucket = bucket
+        self.spool_target = f"influx:{bucket or ''}"
+
+    async def write(self, line: str) -> None:
+        await self.put(line)
+
+    async def write_many(self, lines: Iterable[str]) -> None:
+        await self.put_many(lines)
+
+    async def _flush(self, lines: List[str]) -> None:
+        resp = await post_lines_to_influx(lines, self.bucket)
+        if resp.status_code == 204:
+            return
+        if resp.status_code in INFLUX_PERMANENT_ERRORS:
+            # Reenviarlo daría el mismo error: al spool solo va lo recuperable
+            self.discarded_items += len(lines)
+            logging.error(
+                f"[Influx] Lote de {len(lines)} líneas rechazado, se descarta: {resp.status_code} {resp.text}"
+            )
+            return
+        raise RuntimeError(f"Influx respondió {resp.status_code}: {resp.text}")
+
+
+influx_writer: Optional[InfluxWriter] = None
+
+async def start_influx_writer() -> InfluxWriter:
+    global influx_writer
+    if influx_writer is None:
+        influx_writer = InfluxWriter()
+        await influx_writer.start()
+        logging.info(
+            f"[Influx] Writer por lotes iniciado (batch={influx_writer.batch_size}, "
+            f"intervalo={influx_writer.flush_interval}s)"
+        )
+    return influx_writer
+
+async def stop_influx_writer() -> None:
+    global influx_writer
+    if influx_writer is not None:
+        await influx_writer.stop()
+        influx_writer = None
+        logging.info("[Influx] Writer por lotes detenido")
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, data=line) as resp:
-            if resp.status != 204:
-                text = await resp.text()
-                logging.error(f"[Influx] Error al escribir: {resp.status} {text}")
-            else:
-                logging.info(f"[Influx] Escrito: {line}")
+def get_influx_writer() -> Optional[InfluxWriter]:
+    return influx_writer
@@ -7,9 +7,19 @@ from dotenv import load_dotenv, set_key
 from fastapi import FastAPI
 from app.utils.services_ready import wait_influx, wait_grafana
 from app.utils.influxdb_auth import crear_token_influx
-from app.utils.db import connect_to_mongo, close_mongo_connection
-from app.apis.influx_api import write_to_influx
-from app.utils.rules_loader import cargar_alarm_rules_desde_mongo, cargar_save_rules_desde_mongo
+from app.utils.db import connect_to_mongo, close_mongo_connection, get_db
+from app.utils.timeseries import start_measurements_migration, stop_measurements_migration
+from app.utils.http_clients import init_http_clients, close_http_clients
+from app.utils.mongo_buffer import start_mongo_buffers, stop_mongo_buffers
+from app.utils.mqtt_ingest import start_mqtt_ingest, stop_mqtt_ingest
+from app.utils.alarm_engine import alarm_engine
+from app.utils.invalidation import CACHE_ALARM_RULES, CACHE_DEVICES, start_cache_versions, stop_cache_versions
+from app.utils.latest_values import latest_values, start_latest_snapshots, stop_latest_snapshots
+from app.apis.influx_api import start_influx_writer, stop_influx_writer
+from app.utils.rollups import start_rollups, stop_rollups
+from app.utils.spool import start_spool, stop_spool
+from app.utils.cascade import sincronizar_dispositivos
+from app.utils.rules_loader import cargar_alarm_rules_desde_mongo, reconciliar_reglas_emqx
 from app.apis.emqx_api import router as emqx_api_router, init_emqx_resources
 from app.apis.grafana_api import setup_grafana_api_key, ensure_datasource
 from app.routes.devices import router as device_router
@@ -19,8 +29,15 @@ from app.routes.variables import router as variable_router
 from app.routes.webhook import router as webhook_router
 from app.routes.alarms import router as alarms_router
 from app.routes.dashboard import router as grafana_router
+from app.routes.health import router as health_router
+from app.routes.data import router as data_router
+from app.routes.live import router as live_router, LiveQueryLogFilter
+from app.routes.metrics import router as metrics_router
 
 logging.basicConfig(level=logging.INFO)
+# Los tokens de /live/* viajan en la query: fuera de los logs de acceso (y del WebSocket)
+for _logger in ("uvicorn.access", "uvicorn.error"):
+    logging.getLogger(_logger).addFilter(LiveQueryLogFilter())
 load_dotenv(".env")
 
 app = FastAPI()
@@ -34,18 +51,43 @@ app.include_router(webhook_router)
 app.include_router(emqx_api_router)
 app.include_router(alarms_router)
 app.include_router(grafana_router)
+app.include_router(health_router)
+app.include_router(data_router)
+app.include_router(live_router)
+app.include_router(metrics_router)
 
 @app.on_event("startup")
 async def startup_event():
+    # Clientes HTTP compartidos (EMQX, Influx, Grafana)
+    await init_http_clients()
+
+    # Spool local en disco para los lotes que no se puedan escribir
+    await start_spool()
+
     # MongoDB
     await connect_to_mongo()
+    await start_mongo_buffers()
+    start_measurements_migration(get_db())
 
     # EMQX
     await init_emqx_resources()
 
+    # Últimos valores guardados (antes del registro, que descarta los de dispositivos borrados)
+    await latest_values.load_from_mongo()
+    start_latest_snapshots()
+
+    # Carga inicial de las cachés en memoria junto con sus versiones: los
+    # cambios hechos desde otros procesos (también durante la carga) se recargan
+    await start_cache_versions(
+        {
+            CACHE_ALARM_RULES: alarm_engine.sync_from_mongo,
+            CACHE_DEVICES: sincronizar_dispositivos,
+        },
+        initial={CACHE_ALARM_RULES: cargar_alarm_rules_desde_mongo}
+    )
+
     # Load rules
-    await cargar_alarm_rules_desde_mongo()
-    await cargar_save_rules_desde_mongo()
+    await reconciliar_reglas_emqx()
 
     # InfluxDB ready
     influx_url = os.getenv("INFLUX_URL", "http://influxdb:8086")
@@ -57,12 +99,21 @@ async def startup_event():
     set_key(".env", "INFLUX_AUTH_TOKEN", influx_token)
     logging.info(f"[Startup] INFLUX_AUTH_TOKEN set to: {influx_token}")
 
+    # Influx writer por lotes
+    await start_influx_writer()
+
+    # Cobertura de las tareas de rollup de 1m/1h (creadas junto al token)
+    await start_rollups()
+
+    # Ingesta MQTT directa (solo con INGEST_MODE=mqtt)
+    await start_mqtt_ingest()
+
     # Grafana ready
     grafana_url = os.getenv("GRAFANA_URL", "http://grafana:3000")
     await wait_grafana(grafana_url)
 
     # Create Grafana SA & token
-    grafana_token = setup_grafana_api_key()
+    grafana_token = await setup_grafana_api_key()
     os.environ["GRAFANA_API_KEY"] = grafana_token
     set_key(".env", "GRAFANA_API_KEY", grafana_token)
     logging.info(f"[Startup] GRAFANA_API_KEY set to: {grafana_token}")
@@ -72,4 +123,13 @@ async def startup_event():
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    await stop_mqtt_ingest()
+    await stop_cache_versions()
+    await stop_rollups()
+    await stop_influx_writer()
+    await stop_latest_snapshots()
+    await stop_measurements_migration()
+    await stop_mongo_buffers()
+    await stop_spool()
+    await close_http_clients()
     await close_mongo_connection()
@@ -49,6 +49,16 @@ class DispositivoOut(BaseModel):
     mqtt_password: str
 
 
+class DispositivoBulkError(BaseModel):
+    index: int
+    device_id: str
+    error: str
+
+class DispositivosBulkOut(BaseModel):
+    created: List[DispositivoOut]
+    errors: List[DispositivoBulkError]
+
+
 class StoreFlag(BaseModel):
     store_in_mongo: bool
 
@@ -75,6 +85,15 @@ class AlarmRuleIn(BaseModel):
         None,
         description="Tamaño de la ventana en segundos (si None → regla instantánea)"
     )
+    aggregate: str = Field(
+        "mean",
+        description="Agregado sobre la ventana: mean, min, max, count (solo con window_s)"
+    )
+    hysteresis: float = Field(0, ge=0, description="Margen bajo/sobre el umbral para volver a OK (solo reglas locales)")
+    min_retrigger_s: int = Field(0, ge=0, description="Segundos mínimos entre dos activaciones (solo reglas locales)")
+    cooldown_s: int = Field(
+        0, ge=0, description="Segundos que la condición debe estar despejada para volver a OK (solo reglas locales)"
+    )
 
 class AlarmRuleOut(BaseModel):
     rule_id: str = Field(..., description="ID de la regla creada en EMQX")
@@ -96,4 +115,31 @@ class DashboardConfig(BaseModel):
     panels: List[PanelConfig]
 
 class DashboardResponse(BaseModel):
-    url: str
\ No newline at end of file
+    url: str
+
+class DeviceDashboardsIn(BaseModel):
+    device_ids: Optional[List[str]] = None  # None = todos los dispositivos del usuario
+    range: str = "-1h"
+    every: str = "1m"
+    fn: str = "mean"
+
+class DeviceDashboardOut(BaseModel):
+    device_id: str
+    url: Optional[str] = None
+
+class DeviceDashboardError(BaseModel):
+    device_id: str
+    error: str
+
+class DeviceDashboardsOut(BaseModel):
+    folder_uid: str
+    dashboards: List[DeviceDashboardOut]
+    errors: List[DeviceDashboardError]
+
+class LatestValueOut(BaseModel):
+    value: Any
+    timestamp: str  # RFC3339 UTC
+
+class DeviceLatestOut(BaseModel):
+    device_id: str
+    variables: Dict[str, LatestValueOut]
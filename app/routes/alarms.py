@@ -1,10 +1,14 @@
 from fastapi import APIRouter, HTTPException, Depends
 import logging
+from bson.objectid import ObjectId
 
 from app.routes.auth import get_current_user
 from app.utils.db import get_db
 from app.models.schemas import AlarmRuleIn, AlarmRuleOut
 from app.apis.emqx_api import crear_regla_alarma
+from app.utils.alarm_engine import OPERATORS, alarm_engine, is_local_rule
+from app.utils.streaming import AGGREGATES
+from app.utils.invalidation import CACHE_ALARM_RULES, cache_versions
 
 router = APIRouter(prefix="/alarms", tags=["alarms"])
 
@@ -36,7 +40,9 @@ async def create_alarm_rule(
         "variable_id": variable_id,
         "field": payload.field,
         "operator": payload.operator,
-        "threshold": payload.threshold
+        "threshold": payload.threshold,
+        "window_s": payload.window_s,
+        "aggregate": payload.aggregate if payload.window_s else None
     }
 
     regla_existente = await db["alarmas"].find_one(filtro_alarma)
@@ -46,22 +52,45 @@ async def create_alarm_rule(
             detail="Ya existe una regla de alarma con las mismas condiciones"
         )
 
-    # Crear la regla en EMQX
-    try:
-        rule_id = await crear_regla_alarma(
-            username=user["username"],
-            device_id=payload.device_id,
-            variable_id=variable_id,
-            field=payload.field,
-            operator=payload.operator,
-            threshold=payload.threshold
-        )
-    except ValueError as ve:
-        logging.error("Parámetros inválidos: %s", ve)
-        raise HTTPException(400, str(ve))
-    except Exception as e:
-        logging.error("Error creando regla de alarma: %r", e)
-        raise HTTPException(502, "No se pudo crear la regla de alarma en EMQX")
+    if payload.window_s is not None:
+        if payload.window_s <= 0:
+            raise HTTPException(400, "window_s debe ser mayor que 0")
+        if payload.aggregate not in AGGREGATES:
+            raise HTTPException(400, f"Agregado inválido: {payload.aggregate!r}. Debe estar en {AGGREGATES}")
+
+    # El antirrebote solo lo aplica el motor local; las reglas EMQX usan ALARM_DEDUP_WINDOW_S
+    if not is_local_rule(filtro_alarma):
+        ignorados = [
+            campo for campo in ("hysteresis", "min_retrigger_s", "cooldown_s") if getattr(payload, campo)
+        ]
+        if ignorados:
+            raise HTTPException(
+                422,
+                f"{', '.join(ignorados)} solo se aplican a reglas locales (ALARM_ENGINE=local o con window_s)"
+            )
+
+    if is_local_rule(filtro_alarma):
+        # Motor local (o regla con ventana): solo se indexa en memoria, sin regla en EMQX
+        if payload.operator not in OPERATORS:
+            raise HTTPException(400, f"Operador inválido: {payload.operator!r}. Debe estar en {set(OPERATORS)}")
+        rule_id = f"local:{ObjectId()}"
+    else:
+        # Crear la regla en EMQX
+        try:
+            rule_id = await crear_regla_alarma(
+                username=user["username"],
+                device_id=payload.device_id,
+                variable_id=variable_id,
+                field=payload.field,
+                operator=payload.operator,
+                threshold=payload.threshold
+            )
+        except ValueError as ve:
+            logging.error("Parámetros inválidos: %s", ve)
+            raise HTTPException(400, str(ve))
+        except Exception as e:
+            logging.error("Error creando regla de alarma: %r", e)
+            raise HTTPException(502, "No se pudo crear la regla de alarma en EMQX")
 
     # Registrar la regla en la base de datos
     nueva_regla = {
@@ -73,7 +102,18 @@ async def create_alarm_rule(
         "operator": payload.operator,
         "threshold": payload.threshold
     }
+    if payload.window_s is not None:
+        nueva_regla["window_s"] = payload.window_s
+        nueva_regla["aggregate"] = payload.aggregate
+    if is_local_rule(nueva_regla):
+        # Antirrebote del motor local (las reglas EMQX usan ALARM_DEDUP_WINDOW_S)
+        nueva_regla["hysteresis"] = payload.hysteresis
+        nueva_regla["min_retrigger_s"] = payload.min_retrigger_s
+        nueva_regla["cooldown_s"] = payload.cooldown_s
 
     await db["alarmas"].insert_one(nueva_regla)
+    if is_local_rule(nueva_regla):
+        alarm_engine.add_rule(nueva_regla)
+        await cache_versions.bump(CACHE_ALARM_RULES)
 
     return AlarmRuleOut(rule_id=rule_id)
\ No newline at end of file
@@ -1,10 +1,18 @@
 # app/auth.py
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+
+import bcrypt
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 
+from app.utils.cache import TTLCache
+
 # Clave secreta y configuración
 SECRET_KEY = "clave super secreta"
 ALGORITHM = "HS256"
@@ -20,6 +28,23 @@ def verificar_password(password_plano, password_hash):
 def generar_hash(password):
     return pwd_context.hash(password)
 
+# bcrypt (~100-300 ms por llamada) se ejecuta en un pool acotado para no
+# bloquear el event loop; bcrypt libera el GIL, así que bastan hilos
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+_hash_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+
+def _hashpw(password: str) -> str:
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+
+def _checkpw(password: str, password_hash: str) -> bool:
+    return bcrypt.checkpw(password.encode("utf-8"), password_hash.encode("utf-8"))
+
+async def hash_password(password: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(_hash_pool, _hashpw, password)
+
+async def check_password(password: str, password_hash: str) -> bool:
+    return await asyncio.get_running_loop().run_in_executor(_hash_pool, _checkpw, password, password_hash)
+
 def crear_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=15))
@@ -36,8 +61,21 @@ def verificar_token(token: str):
 # Dependencia para proteger rutas
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login")
 
+# Payloads de tokens ya verificados; cada entrada caduca como muy tarde en su `exp`
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+TOKEN_CACHE_TTL_S = float(os.getenv("TOKEN_CACHE_TTL_S", 300))
+token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL_S)
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
+    payload = token_cache.get(token)
+    if payload is not None:
+        return dict(payload)
+
     payload = verificar_token(token)
     if payload is None:
         raise HTTPException(status_code=401, detail="Token inválido o expirado")
-    return payload
+
+    ttl = min(TOKEN_CACHE_TTL_S, payload.get("exp", 0) - time.time())
+    if ttl > 0:
+        token_cache.set(token, payload, ttl)
+    return dict(payload)
@@ -1,6 +1,12 @@
-from fastapi import APIRouter, HTTPException
-from app.models.schemas import DashboardConfig, DashboardResponse
-from app.apis.grafana_api import create_dashboard_dynamic
+import os
+import logging
+
+from fastapi import APIRouter, HTTPException, Depends
+from app.models.schemas import DashboardConfig, DashboardResponse, DeviceDashboardsIn, DeviceDashboardsOut
+from app.apis.grafana_api import create_dashboard_dynamic, create_device_dashboards
+from app.routes.auth import get_current_user
+from app.routes.data import DURATION_RE, FUNCIONES, es_duracion_positiva
+from app.utils.db import get_db
 
 
 router = APIRouter(prefix="/grafana", tags=["Grafana"])
@@ -17,3 +23,59 @@ async def create_custom_dashboard(cfg: DashboardConfig):
         return {"url": url}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/dashboards/devices", response_model=DeviceDashboardsOut)
+async def create_device_dashboards_batch(
+    cfg: DeviceDashboardsIn,
+    user: dict = Depends(get_current_user)
+):
+    """
+    Genera un dashboard por dispositivo del usuario (un panel por variable)
+    en su carpeta de Grafana. Los dashboards se envían en paralelo.
+    """
+    if not DURATION_RE.fullmatch(cfg.range) or not cfg.range.startswith("-"):
+        raise HTTPException(400, "'range' debe ser una duración negativa, p.ej. -1h")
+    if not es_duracion_positiva(cfg.every):
+        raise HTTPException(422, "'every' debe ser una duración positiva, p.ej. 1m")
+    if cfg.fn not in FUNCIONES:
+        raise HTTPException(400, f"'fn' debe ser una de {sorted(FUNCIONES)}")
+
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Base de datos no inicializada")
+
+    username = user["username"]
+    filtro = {"username": username}
+    if cfg.device_ids is not None:
+        filtro["device_id"] = {"$in": cfg.device_ids}
+
+    devices = {}
+    async for d in db["dispositivos"].find(filtro, {"device_id": 1, "name": 1}):
+        devices[d["device_id"]] = {"device_id": d["device_id"], "name": d.get("name"), "variables": []}
+    if not devices:
+        raise HTTPException(404, "No hay dispositivos para generar dashboards")
+
+    # Todas las variables en una sola consulta, agrupadas por dispositivo
+    async for v in db["variables"].find(
+        {"username": username, "device_id": {"$in": list(devices)}},
+        {"device_id": 1, "variable_id": 1, "variable_name": 1, "unit": 1}
+    ):
+        devices[v["device_id"]]["variables"].append({
+            "variable_id": v.get("variable_id") or str(v["_id"]),
+            "name": v.get("variable_name"),
+            "unit": v.get("unit")
+        })
+
+    try:
+        return await create_device_dashboards(
+            username,
+            list(devices.values()),
+            bucket=os.getenv("INFLUX_BUCKET", "measurements"),
+            range_=cfg.range,
+            every=cfg.every,
+            fn=cfg.fn
+        )
+    except Exception as e:
+        logging.error(f"[Grafana] Error generando dashboards de {username}: {e!r}")
+        raise HTTPException(status_code=502, detail="No se pudo crear la carpeta de Grafana")
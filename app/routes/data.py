@@ -0,0 +1,182 @@
+import os
+import re
+import math
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
+
+from app.routes.auth import get_current_user
+from app.utils.db import get_db
+from app.utils.cache import TTLCache
+from app.apis.influx_api import build_series_query, query_influx_points
+from app.utils.rollups import ROLLUP_MEASUREMENT, RollupTier, get_rollup_service, rollup_tier_for
+
+router = APIRouter(tags=["data"])
+
+# Caché de resultados por consulta normalizada
+QUERY_CACHE_TTL_S = float(os.getenv("QUERY_CACHE_TTL_S", 10))
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", 2048))
+query_cache = TTLCache(maxsize=QUERY_CACHE_MAX_ENTRIES, ttl=QUERY_CACHE_TTL_S)
+
+DURATION_RE = re.compile(r"-?(\d+(ns|us|ms|mo|s|m|h|d|w|y))+")
+FUNCIONES = {"mean", "min", "max", "last", "first", "sum", "count", "median"}
+
+# Segundos por unidad de duración Flux (mo/y no tienen longitud fija)
+_UNIDADES_S = {"ns": 1e-9, "us": 1e-6, "ms": 1e-3, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+# Sobre un rollup: campo que se lee y función que combina sus ventanas
+_ROLLUP_CAMPO_FN = {"mean": ("mean", "mean"), "min": ("min", "min"), "max": ("max", "max"),
+                    "count": ("count", "sum"), "last": ("last", "last")}
+
+
+def _normalizar_tiempo(valor: str, nombre: str) -> str:
+    """
+    Acepta una duración Flux relativa (-1h, -30m, 0s...), now() o una fecha
+    RFC3339, y la devuelve en forma canónica para la consulta y la caché.
+    """
+    valor = valor.strip()
+    if valor == "now()" or DURATION_RE.fullmatch(valor):
+        return valor
+    try:
+        fecha = datetime.fromisoformat(valor.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(400, f"'{nombre}' debe ser una duración (-1h) o una fecha RFC3339")
+    if fecha.tzinfo is None:
+        fecha = fecha.replace(tzinfo=timezone.utc)
+    return fecha.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def es_duracion_positiva(valor: str) -> bool:
+    """Duración Flux sin signo y mayor que cero (aggregateWindow no admite 0s)."""
+    return (
+        bool(DURATION_RE.fullmatch(valor)) and not valor.startswith("-")
+        and any(int(cantidad) > 0 for cantidad in re.findall(r"\d+", valor))
+    )
+
+
+def _duracion_s(valor: str) -> Optional[float]:
+    total = 0.0
+    for cantidad, unidad in re.findall(r"(\d+)(ns|us|ms|mo|s|m|h|d|w|y)", valor):
+        if unidad not in _UNIDADES_S:
+            return None
+        total += int(cantidad) * _UNIDADES_S[unidad]
+    return total
+
+
+def _epoch(valor: Optional[str], ahora: float) -> Optional[float]:
+    """Instante de un start/stop ya normalizado (None si la duración no tiene longitud fija)."""
+    if valor is None or valor == "now()":
+        return ahora
+    if DURATION_RE.fullmatch(valor):
+        duracion = _duracion_s(valor)
+        if duracion is None:
+            return None
+        return ahora - duracion if valor.startswith("-") else ahora + duracion
+    return datetime.fromisoformat(valor.replace("Z", "+00:00")).timestamp()
+
+
+def _rfc3339(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _tramo_rollup(
+    tier: RollupTier, every_s: float, inicio: Optional[float], fin: Optional[float]
+) -> Optional[Tuple[float, float]]:
+    """
+    Parte de [inicio, fin) que puede leerse del rollup: la que ya cubre su
+    tarea, alineada a `every` para que ninguna ventana quede partida entre
+    el rollup y los datos crudos.
+    """
+    rollups = get_rollup_service()
+    cobertura = rollups.coverage(tier) if rollups is not None else None
+    if cobertura is None or inicio is None or fin is None:
+        return None
+    desde = math.ceil(max(inicio, cobertura[0]) / every_s) * every_s
+    hasta = math.floor(min(fin, cobertura[1]) / every_s) * every_s
+    return (desde, hasta) if desde < hasta else None
+
+
+# Serie temporal de una variable (con agregación opcional)
+@router.get("/devices/{device_id}/variables/{variable_id}/data")
+async def obtener_datos_variable(
+    device_id: str,
+    variable_id: str,
+    response: Response,
+    start: str = Query("-1h", description="Inicio: duración relativa (-1h) o RFC3339"),
+    stop: Optional[str] = Query(None, description="Fin: duración relativa, now() o RFC3339"),
+    every: Optional[str] = Query(None, description="Ventana de agregación, p.ej. 1m"),
+    fn: Optional[str] = Query(None, description="Función: mean, min, max, last, first, sum, count, median"),
+    user: dict = Depends(get_current_user)
+):
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Base de datos no inicializada")
+
+    # El dispositivo debe pertenecer al usuario autenticado
+    dispositivo = await db["dispositivos"].find_one(
+        {"device_id": device_id, "username": user["username"]},
+        {"_id": 1}
+    )
+    if not dispositivo:
+        raise HTTPException(status_code=404, detail="Dispositivo no encontrado o no autorizado")
+
+    start = _normalizar_tiempo(start, "start")
+    stop = _normalizar_tiempo(stop, "stop") if stop else None
+    if every is not None and not es_duracion_positiva(every):
+        raise HTTPException(422, "'every' debe ser una duración positiva, p.ej. 1m")
+    if fn is not None and fn not in FUNCIONES:
+        raise HTTPException(400, f"'fn' debe ser una de {sorted(FUNCIONES)}")
+
+    key = (user["username"], device_id, variable_id, start, stop, every, fn)
+    resultado = query_cache.get(key)
+    if resultado is not None:
+        response.headers["X-Cache"] = "HIT"
+        return resultado
+
+    tags = {"username": user["username"], "device_id": device_id, "variable_id": variable_id}
+    crudo = {"bucket": os.getenv("INFLUX_BUCKET", "measurements"), "tags": tags, "every": every, "fn": fn}
+    consultas = [build_series_query(start=start, stop=stop, **crudo)]
+
+    # Las ventanas que coinciden con un nivel de rollup se leen de su bucket
+    # en el tramo que ya cubre su tarea; lo anterior (historia previa a la
+    # tarea) y lo posterior (ventanas aún abiertas) se leen en crudo
+    every_s = _duracion_s(every) if every else None
+    tier = rollup_tier_for(every_s, fn or "mean")
+    ahora = time.time()
+    inicio, fin = _epoch(start, ahora), _epoch(stop, ahora)
+    tramo = _tramo_rollup(tier, every_s, inicio, fin) if tier is not None else None
+    if tramo is not None:
+        desde, hasta = tramo
+        campo, combinar = _ROLLUP_CAMPO_FN[fn or "mean"]
+        consultas = [build_series_query(
+            bucket=tier.bucket, tags=tags, start=_rfc3339(desde), stop=_rfc3339(hasta), every=every,
+            fn=combinar, measurement=ROLLUP_MEASUREMENT, field=campo
+        )]
+        if inicio < desde:
+            consultas.insert(0, build_series_query(start=start, stop=_rfc3339(desde), **crudo))
+        if fin > hasta:
+            consultas.append(build_series_query(start=_rfc3339(hasta), stop=stop, **crudo))
+
+    try:
+        tramos = await asyncio.gather(*(query_influx_points(flux) for flux in consultas))
+    except Exception as e:
+        logging.error(f"[data] Error consultando Influx: {e!r}")
+        raise HTTPException(status_code=502, detail="No se pudo consultar InfluxDB")
+    points = [p for t in tramos for p in t]
+
+    resultado = {
+        "device_id": device_id,
+        "variable_id": variable_id,
+        "start": start,
+        "stop": stop,
+        "every": every,
+        "fn": fn,
+        "resolution": tier.name if tramo is not None else "raw",
+        "points": points
+    }
+    query_cache.set(key, resultado)
+    response.headers["X-Cache"] = "MISS"
+    return resultado
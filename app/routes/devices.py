@@ -1,20 +1,38 @@
-from fastapi import APIRouter, HTTPException, Depends, status
+from fastapi import APIRouter, HTTPException, Depends, Query, Response, status
 from fastapi.security import OAuth2PasswordRequestForm
+import os
+import asyncio
 import logging
 
-from typing import List
+from typing import List, Optional
 import bcrypt
 import secrets
 from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 
-from app.routes.auth import get_current_user
-from app.apis.emqx_api import emqx_post, get_resource, emqx_get, emqx_delete
-from app.models.schemas import DispositivoIn, DispositivoOut
+from app.routes.auth import get_current_user, hash_password
+from app.apis.emqx_api import emqx_post, get_resource, emqx_get, emqx_delete, save_rule_scope
+from app.models.schemas import DispositivoIn, DispositivoOut, DispositivosBulkOut, DeviceLatestOut
 from app.utils.db import get_db
+from app.utils.pagination import MAX_PAGE_SIZE, paginar, parse_fields
+from app.utils.mqtt_ingest import saver_rules_enabled
+from app.utils.alarm_engine import alarm_engine
+from app.utils.device_registry import device_registry
+from app.utils.latest_values import latest_values
+from app.utils.invalidation import CACHE_DEVICES, cache_versions
+from app.utils.rules_loader import asegurar_regla_save
+from app.utils.cascade import eliminar_dispositivos
 
 
 router = APIRouter()
+
+# Alta masiva: tamaño máximo del lote y llamadas simultáneas a EMQX
+DEVICES_BULK_MAX = int(os.getenv("DEVICES_BULK_MAX", 5000))
+DEVICES_BULK_EMQX_CONCURRENCY = int(os.getenv("DEVICES_BULK_EMQX_CONCURRENCY", 16))
+
+# Campos que puede devolver GET /devices
+DEVICE_FIELDS = ("id", "device_id", "name", "username")
 #crear dispositivo
 @router.post("/devices", response_model=DispositivoOut)
 async def crear_dispositivo(
@@ -37,96 +55,53 @@ async def crear_dispositivo(
     # 2. Generar credenciales MQTT
     mqtt_username = f"dev_{dispositivo.device_id}"
     raw_mqtt_password = secrets.token_urlsafe(16)
-    hashed = bcrypt.hashpw(raw_mqtt_password.encode(), bcrypt.gensalt()).decode()
+    hashed = await hash_password(raw_mqtt_password)
 
-    # 3. Insertar usuario MQTT
+    # 3. Registrar el dispositivo antes que sus credenciales: si un alta
+    #    concurrente del mismo device_id gana, no quedan usuarios MQTT huérfanos
+    nuevo_dispositivo = {
+        "name": dispositivo.name,
+        "device_id": dispositivo.device_id,
+        "username": user["username"],
+        "mqtt_username": mqtt_username
+    }
+    try:
+        res = await db["dispositivos"].insert_one(nuevo_dispositivo)
+    except DuplicateKeyError:
+        # Alta concurrente del mismo device_id: lo garantiza el índice único
+        raise HTTPException(status_code=400, detail="El dispositivo ya existe para este usuario")
+
+    # 4. Insertar usuario MQTT
     await db["mqtt_user"].insert_one({
         "username": mqtt_username,
         "password": hashed
     })
-    
-    # 3. Crear ACL para publicación y suscripción en cualquier subtopic
+
+    # 5. Crear ACL para publicación y suscripción en cualquier subtopic
     topic_acl = {
         "username": mqtt_username,
         "pubsub": [
             f"iot/{user['username']}/{dispositivo.device_id}/+/sdata"
         ]
     }
-
-    # 4. Insertar en colección ACL
     await db["mqtt_acl"].insert_one(topic_acl)
 
-    # 5. Registrar el dispositivo
-    nuevo_dispositivo = {
-        "name": dispositivo.name,
-        "device_id": dispositivo.device_id,
-        "username": user["username"],
-        "mqtt_username": mqtt_username
-    }
-    res = await db["dispositivos"].insert_one(nuevo_dispositivo)
-
-    saverResource, alarmResource = await get_resource()
-
-
-    # 6. Construir y crear la regla en EMQX
-    rawsql = (
-        f"SELECT  payload AS payload, topic "
-        f"FROM \"iot/{user['username']}/{dispositivo.device_id}/+/sdata\" WHERE payload.save=1"
-    )
-    new_rule = {
-        "rawsql": rawsql,
-        "actions": [
-            {
-                "name": "data_to_webserver",
-                "params": {
-                    "$resource": saverResource.get("id"),
-                    "payload_tmpl": (
-                        '{"username":"'+user["username"]+'",'
-                        '"payload":${payload},"topic":"${topic}"}'
-                    )
-                }
-            }
-        ],
-        "description": f"SAVER-RULE {user['username']}/{dispositivo.device_id}",
-        "enabled": True
-    }
-
-    try:
-        rule_resp = await emqx_post("/rules", new_rule)
-        rule_id = rule_resp["data"]["id"]
-        await db["dispositivos"].update_one(
-            {"_id": res.inserted_id},
-            {"$set": {"emqx_rule_id": rule_id}}
-        )
-        await db["emqx_save_rules"].insert_one({
-            "rule_id": rule_id,
-            "type": "save-rule",
-            "username": user["username"],
-            "device_id": dispositivo.device_id,
-            "rawsql": rawsql,
-            "description": new_rule["description"],
-            "payload_tmpl": (
-                        '{"username":"'+user["username"]+'",'
-                        '"payload":${payload},"topic":"${topic}"}'
-                    ),
-            "enabled": True,
-        })
-        
-
-    except Exception as e:
-        # Si la creación de la regla falla, opcionalmente podrías
-        # hacer rollback del insert del dispositivo o notificar
-        logging.error(f"No se pudo crear la regla EMQX: {e}")
-        raise HTTPException(
-            status_code=502,
-            detail="Dispositivo creado, pero fallo la creación de la regla en EMQX"
-        )
-    
-
-    # … después de insertar el dispositivo …
-
-    logging.info(f">>> saverResource = {saverResource!r}")
-
+    # 6. En modo webhook el dispositivo necesita una regla SAVE en EMQX
+    #    (con INGEST_MODE=mqtt la API se suscribe directamente)
+    #    (SAVE_RULE_MODE=tenant/global: se reutiliza la regla compartida)
+    device_registry.add(user["username"], dispositivo.device_id)
+    await cache_versions.bump(CACHE_DEVICES)
+    if saver_rules_enabled():
+        try:
+            await asegurar_regla_save(user["username"], dispositivo.device_id)
+        except Exception as e:
+            # Si la creación de la regla falla, opcionalmente podrías
+            # hacer rollback del insert del dispositivo o notificar
+            logging.error(f"No se pudo crear la regla EMQX: {e}")
+            raise HTTPException(
+                status_code=502,
+                detail="Dispositivo creado, pero fallo la creación de la regla en EMQX"
+            )
 
     # 7) Devolver respuesta, incluyendo el ID de la regla
     return DispositivoOut(
@@ -139,25 +114,179 @@ async def crear_dispositivo(
 
     )
 
+# alta masiva de dispositivos
+@router.post("/devices/bulk", response_model=DispositivosBulkOut)
+async def crear_dispositivos_bulk(
+    dispositivos: List[DispositivoIn],
+    user: dict = Depends(get_current_user)
+):
+    """
+    Alta de muchos dispositivos en una petición: una consulta $in para los
+    existentes, hashes en paralelo en el pool de bcrypt, insert_many en
+    dispositivos/mqtt_user/mqtt_acl y reglas SAVE con concurrencia acotada.
+    Devuelve las credenciales creadas y los errores por elemento.
+    """
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=500, detail="Base de datos no inicializada")
+    if len(dispositivos) > DEVICES_BULK_MAX:
+        raise HTTPException(status_code=413, detail=f"Máximo {DEVICES_BULK_MAX} dispositivos por petición")
+
+    username = user["username"]
+    errors = []
+
+    # 1. Existentes (una sola consulta) y repetidos dentro del lote
+    existentes = set()
+    async for d in db["dispositivos"].find(
+        {"username": username, "device_id": {"$in": [d.device_id for d in dispositivos]}},
+        {"device_id": 1}
+    ):
+        existentes.add(d["device_id"])
+
+    pendientes = []
+    vistos = set()
+    for index, dispositivo in enumerate(dispositivos):
+        if dispositivo.device_id in existentes:
+            errors.append({"index": index, "device_id": dispositivo.device_id,
+                           "error": "El dispositivo ya existe para este usuario"})
+            continue
+        if dispositivo.device_id in vistos:
+            errors.append({"index": index, "device_id": dispositivo.device_id,
+                           "error": "Dispositivo repetido en el lote"})
+            continue
+        vistos.add(dispositivo.device_id)
+        pendientes.append((index, dispositivo))
+
+    # 2. Credenciales MQTT, con los hashes en paralelo
+    passwords = [secrets.token_urlsafe(16) for _ in pendientes]
+    hashes = await asyncio.gather(*(hash_password(p) for p in passwords))
+
+    # 3. Registrar los dispositivos; el índice único resuelve altas concurrentes
+    docs = [
+        {
+            "name": dispositivo.name,
+            "device_id": dispositivo.device_id,
+            "username": username,
+            "mqtt_username": f"dev_{dispositivo.device_id}"
+        }
+        for _, dispositivo in pendientes
+    ]
+    fallidos = set()
+    if docs:
+        try:
+            await db["dispositivos"].insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            for err in e.details.get("writeErrors", []):
+                fallidos.add(err["index"])
+                index, dispositivo = pendientes[err["index"]]
+                errors.append({"index": index, "device_id": dispositivo.device_id,
+                               "error": "El dispositivo ya existe para este usuario"
+                               if err.get("code") == 11000 else err.get("errmsg", "Error insertando")})
+
+    creados = [i for i in range(len(docs)) if i not in fallidos]
+    if not creados:
+        errors.sort(key=lambda e: e["index"])
+        return {"created": [], "errors": errors}
+
+    # 4. Usuarios MQTT y ACL en bloque
+    await db["mqtt_user"].insert_many(
+        [{"username": docs[i]["mqtt_username"], "password": hashes[i]} for i in creados],
+        ordered=False
+    )
+    await db["mqtt_acl"].insert_many(
+        [
+            {
+                "username": docs[i]["mqtt_username"],
+                "pubsub": [f"iot/{username}/{docs[i]['device_id']}/+/sdata"]
+            }
+            for i in creados
+        ],
+        ordered=False
+    )
+    for i in creados:
+        device_registry.add(username, docs[i]["device_id"])
+    await cache_versions.bump(CACHE_DEVICES)
+
+    # 5. Reglas SAVE: una por ámbito (dispositivo, usuario o global), concurrentes
+    if saver_rules_enabled():
+        por_scope = {}
+        for i in creados:
+            por_scope.setdefault(save_rule_scope(username, docs[i]["device_id"]), []).append(i)
+
+        sem = asyncio.Semaphore(DEVICES_BULK_EMQX_CONCURRENCY)
+
+        async def _regla(device_id):
+            async with sem:
+                await asegurar_regla_save(username, device_id)
+
+        scopes = list(por_scope.values())
+        resultados = await asyncio.gather(
+            *(_regla(docs[indices[0]]["device_id"]) for indices in scopes),
+            return_exceptions=True
+        )
+        for indices, res in zip(scopes, resultados):
+            if isinstance(res, Exception):
+                logging.error(f"No se pudo crear la regla EMQX: {res!r}")
+                for i in indices:
+                    errors.append({"index": pendientes[i][0], "device_id": docs[i]["device_id"],
+                                   "error": "Dispositivo creado, pero fallo la creación de la regla en EMQX"})
+
+    errors.sort(key=lambda e: e["index"])
+    logging.info(f"[bulk] {len(creados)} dispositivos creados para {username}, {len(errors)} errores")
+    return {
+        "created": [
+            DispositivoOut(
+                id=str(docs[i]["_id"]),
+                name=docs[i]["name"],
+                device_id=docs[i]["device_id"],
+                username=username,
+                mqtt_username=docs[i]["mqtt_username"],
+                mqtt_password=passwords[i],
+            )
+            for i in creados
+        ],
+        "errors": errors
+    }
+
 # consultar dispositivos
+# (paginación por id con limit/after, proyección con fields y NDJSON con stream)
 @router.get("/devices")
-async def obtener_dispositivos(user: dict = Depends(get_current_user)):
+async def obtener_dispositivos(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = Query(None, description="Id del último dispositivo de la página anterior"),
+    fields: Optional[str] = Query(None, description=f"Campos separados por comas: {','.join(DEVICE_FIELDS)}"),
+    stream: bool = Query(False, description="Respuesta NDJSON en streaming"),
+    user: dict = Depends(get_current_user)
+):
     db = get_db()
     if db is None:
         raise HTTPException(status_code=500, detail="Base de datos no inicializada")
 
-    devices_cursor = db["dispositivos"].find({"username": user["username"]})
-    devices = []
-    async for device in devices_cursor:
-        devices.append({
-            "id": str(device["_id"]),
-            "device_id": device.get("device_id"),
-            "name": device.get("name"),
-            "username": device.get("username")
-        })
+    campos, projection = parse_fields(fields, DEVICE_FIELDS)
+    resultado = await paginar(
+        db["dispositivos"], {"username": user["username"]}, campos, projection, limit, after, stream
+    )
+    if stream:
+        return resultado
+
+    devices, next_after = resultado
+    if next_after:
+        response.headers["X-Next-After"] = next_after
     return devices
 
 
+# último valor de cada variable del dispositivo (caché en memoria, sin consultar Influx)
+# La caché es de este proceso: con varios procesos de ingesta refleja las muestras
+# que recibió este, más lo cargado de la snapshot al arrancar
+@router.get("/devices/{device_id}/latest", response_model=DeviceLatestOut)
+async def ultimo_valor_dispositivo(device_id: str, user: dict = Depends(get_current_user)):
+    if not await device_registry.owns(user["username"], device_id):
+        raise HTTPException(status_code=404, detail="Dispositivo no encontrado o no autorizado")
+
+    return {"device_id": device_id, "variables": latest_values.get_device(user["username"], device_id)}
+
+
 @router.delete("/devices/{device_id}")
 async def device_delete(device_id: str, user: dict = Depends(get_current_user)):
     db = get_db()
@@ -172,59 +301,14 @@ async def device_delete(device_id: str, user: dict = Depends(get_current_user)):
     if not dispositivo:
         raise HTTPException(404, "Dispositivo no encontrado")
 
-    # ✅ 2. Eliminar reglas SAVE en EMQX antes de borrarlas de Mongo
-    async for rule in db["emqx_save_rules"].find({
-        "device_id": device_id,
-        "username": user["username"]
-    }):
-        rule_id = rule.get("rule_id")
-        if rule_id:
-            try:
-                await emqx_delete(f"/rules/{rule_id}")
-                logging.info(f"[delete] Regla save-rule EMQX {rule_id} eliminada")
-            except Exception as e:
-                logging.warning(f"[delete] Error eliminando save-rule EMQX {rule_id}: {e!r}")
-
-    # ✅ 3. Eliminar reglas de ALARMAS en EMQX antes de borrarlas de Mongo
-    async for alarma in db["alarmas"].find({
-        "device_id": device_id,
-        "username": user["username"]
-    }):
-        rule_id = alarma.get("rule_id")
-        if rule_id:
-            try:
-                await emqx_delete(f"/rules/{rule_id}")
-                logging.info(f"[delete] Regla de alarma EMQX {rule_id} eliminada")
-            except Exception as e:
-                logging.warning(f"[delete] Error eliminando regla de alarma EMQX {rule_id}: {e!r}")
-
-    # 4. Eliminar save-rules en Mongo
-    await db["emqx_save_rules"].delete_many({
-        "device_id": device_id,
-        "username": user["username"]
-    })
-
-    # 5. Eliminar alarmas en Mongo
-    await db["alarmas"].delete_many({
-        "device_id": device_id,
-        "username": user["username"]
-    })
-
-    # 6. Eliminar variables
-    await db["variables"].delete_many({
-        "device_id": device_id,
-        "username": user["username"]
-    })
-
-    # 7. Eliminar usuario MQTT y ACL
-    mqtt_username = dispositivo.get("mqtt_username")
-    if mqtt_username:
-        await db["mqtt_user"].delete_many({"username": mqtt_username})
-        await db["mqtt_acl"].delete_many({"username": mqtt_username})
-        logging.info(f"[delete] MQTT user y ACL eliminados para {mqtt_username}")
-
-    # 8. Eliminar el dispositivo
-    await db["dispositivos"].delete_one({"_id": dispositivo["_id"]})
+    # 2. Reglas EMQX (en paralelo), save-rules, alarmas, variables, usuario
+    #    MQTT/ACL y el propio dispositivo (delete_many en bloque)
+    borrados = await eliminar_dispositivos(db, user["username"], [dispositivo])
     logging.info(f"[delete] Dispositivo '{device_id}' eliminado")
 
+    if borrados["emqx_rules_failed"]:
+        return {
+            "message": f"Dispositivo '{device_id}' eliminado, pero no se pudieron borrar algunas reglas de EMQX",
+            "emqx_rules_failed": borrados["emqx_rules_failed"]
+        }
     return {"message": f"Dispositivo '{device_id}' y todos sus recursos fueron eliminados correctamente"}
@@ -0,0 +1,38 @@
+from fastapi import APIRouter
+
+from app.apis.influx_api import get_influx_writer
+from app.utils.mongo_buffer import mongo_buffers
+from app.utils.mqtt_ingest import get_mqtt_worker
+from app.utils.rollups import get_rollup_service
+from app.utils.spool import get_spool
+from app.utils.live import live_hub
+
+router = APIRouter(prefix="/health", tags=["health"])
+
+# Profundidad de cola y latencia de flush de los buffers de escritura
+@router.get("/buffers")
+async def estado_buffers():
+    buffers = {}
+
+    writer = get_influx_writer()
+    if writer is not None:
+        buffers[writer.name] = writer.stats()
+
+    for buffer in mongo_buffers.values():
+        buffers[buffer.name] = buffer.stats()
+
+    worker = get_mqtt_worker()
+    if worker is not None:
+        buffers[worker.sink.name] = worker.sink.stats()
+
+    rollups = get_rollup_service()
+    if rollups is not None:
+        buffers["rollups"] = rollups.stats()
+
+    spool = get_spool()
+    if spool is not None:
+        buffers["spool"] = spool.stats()
+
+    buffers["live"] = live_hub.stats()
+
+    return buffers
@@ -0,0 +1,193 @@
+import os
+import asyncio
+import logging
+import secrets
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+
+from app.utils import fastjson
+from app.utils.db import get_db
+from app.routes.auth import get_current_user
+from app.utils.live import live_hub
+
+router = APIRouter(prefix="/live", tags=["live"])
+
+# Comentario SSE / ping enviado si no hay eventos en este intervalo
+LIVE_HEARTBEAT_S = float(os.getenv("LIVE_HEARTBEAT_S", 15))
+
+# Tickets de un solo uso para abrir SSE/WebSocket sin poner el JWT en la URL.
+# Se guardan en Mongo (el ticket puede canjearse en otro proceso) y el
+# índice TTL de `expires_at` limpia los que no se usan.
+LIVE_TICKET_TTL_S = int(os.getenv("LIVE_TICKET_TTL_S", 30))
+LIVE_TICKETS_COLLECTION = "live_tickets"
+
+
+class LiveQueryLogFilter(logging.Filter):
+    """
+    Quita la query de las rutas /live/* en los logs de uvicorn: puede
+    llevar `access_token` o `ticket`.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if isinstance(record.args, tuple):
+            record.args = tuple(
+                a.split("?", 1)[0] if isinstance(a, str) and a.startswith("/live/") else a
+                for a in record.args
+            )
+        return True
+
+
+def _patrones(topics: Optional[str]) -> List[str]:
+    return [t for t in (topics or "").split(",") if t.strip()]
+
+
+async def _canjear_ticket(ticket: str) -> dict:
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=503, detail="BD no inicializada")
+    doc = await db[LIVE_TICKETS_COLLECTION].find_one_and_delete(
+        {"_id": ticket, "expires_at": {"$gt": datetime.utcnow()}}
+    )
+    if doc is None:
+        raise HTTPException(status_code=401, detail="Ticket inválido o caducado")
+    return doc["user"]
+
+
+async def _usuario(authorization: Optional[str], access_token: Optional[str], ticket: Optional[str]) -> dict:
+    """
+    EventSource y WebSocket del navegador no pueden enviar cabeceras: se
+    acepta un `ticket` de POST /live/ticket o, por compatibilidad, el JWT
+    como parámetro `access_token`.
+    """
+    if ticket:
+        return await _canjear_ticket(ticket)
+    token = access_token
+    if authorization and authorization.lower().startswith("bearer "):
+        token = authorization[7:]
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return await get_current_user(token)
+
+
+# Ticket de un solo uso (caduca a los LIVE_TICKET_TTL_S) para ?ticket= en /live/sse y /live/ws
+@router.post("/ticket")
+async def live_ticket(user: dict = Depends(get_current_user)):
+    db = get_db()
+    if db is None:
+        raise HTTPException(status_code=503, detail="BD no inicializada")
+    ticket = secrets.token_urlsafe(32)
+    await db[LIVE_TICKETS_COLLECTION].insert_one({
+        "_id": ticket,
+        "user": {k: v for k, v in user.items() if k != "exp"},
+        "expires_at": datetime.utcnow() + timedelta(seconds=LIVE_TICKET_TTL_S)
+    })
+    return {"ticket": ticket, "expires_in": LIVE_TICKET_TTL_S}
+
+
+# Server-Sent Events: un evento `sample` por muestra
+@router.get("/sse")
+async def live_sse(
+    request: Request,
+    topics: str = Query(..., description="Patrones device_id/variable_id separados por comas (+ y # como comodines)"),
+    access_token: Optional[str] = Query(None),
+    ticket: Optional[str] = Query(None)
+):
+    user = await _usuario(request.headers.get("authorization"), access_token, ticket)
+    try:
+        sub = live_hub.connect(user["username"])
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    try:
+        live_hub.subscribe(sub, _patrones(topics))
+    except ValueError as e:
+        live_hub.disconnect(sub)
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def eventos():
+        try:
+            while not await request.is_disconnected():
+                event = await sub.get(LIVE_HEARTBEAT_S)
+                if event is None:
+                    yield b": ping\n\n"
+                    continue
+                # Lo que ya esté en cola sale en la misma escritura
+                chunk = "".join(
+                    f"event: sample\ndata: {fastjson.dumps(e)}\n\n" for e in [event, *sub.drain()]
+                )
+                yield chunk.encode("utf-8")
+        finally:
+            live_hub.disconnect(sub)
+
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# WebSocket: {"subscribe": [...]} / {"unsubscribe": [...]} y eventos {"type": "sample", ...}
+@router.websocket("/ws")
+async def live_ws(
+    ws: WebSocket,
+    topics: Optional[str] = None,
+    access_token: Optional[str] = None,
+    ticket: Optional[str] = None
+):
+    try:
+        user = await _usuario(ws.headers.get("authorization"), access_token, ticket)
+    except HTTPException:
+        await ws.close(code=1008)
+        return
+    try:
+        sub = live_hub.connect(user["username"])
+    except RuntimeError:
+        await ws.close(code=1013)
+        return
+
+    await ws.accept()
+    try:
+        if topics:
+            try:
+                activos = live_hub.subscribe(sub, _patrones(topics))
+                await ws.send_text(fastjson.dumps({"type": "subscribed", "topics": activos}))
+            except ValueError as e:
+                await ws.send_text(fastjson.dumps({"type": "error", "error": str(e)}))
+
+        async def enviar():
+            while True:
+                event = await sub.get(LIVE_HEARTBEAT_S)
+                if event is None:
+                    await ws.send_text(fastjson.dumps({"type": "ping"}))
+                    continue
+                for e in [event, *sub.drain()]:
+                    await ws.send_text(fastjson.dumps({"type": "sample", **e}))
+
+        sender = asyncio.create_task(enviar())
+        try:
+            while True:
+                raw = await ws.receive_text()
+                try:
+                    msg = fastjson.loads(raw)
+                    accion = next((a for a in ("subscribe", "unsubscribe") if isinstance(msg, dict) and a in msg), None)
+                    patrones = msg[accion] if accion else None
+                    if not isinstance(patrones, list) or not all(isinstance(p, str) for p in patrones):
+                        raise ValueError("Se espera {\"subscribe\": [...]} o {\"unsubscribe\": [...]}")
+                    if accion == "subscribe":
+                        activos = live_hub.subscribe(sub, patrones)
+                    else:
+                        activos = live_hub.unsubscribe(sub, patrones)
+                    await ws.send_text(fastjson.dumps({"type": "subscribed", "topics": activos}))
+                except ValueError as e:
+                    await ws.send_text(fastjson.dumps({"type": "error", "error": str(e)}))
+        finally:
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logging.warning(f"[live] Conexión WebSocket cerrada por error: {e!r}")
+    finally:
+        live_hub.disconnect(sub)
@@ -8,7 +8,7 @@ import secrets
 from bson.objectid import ObjectId
 
 
-from app.routes.auth import verificar_password, crear_token, get_current_user
+from app.routes.auth import verificar_password, crear_token, get_current_user, check_password
 from app.models.schemas import UsuarioOut,UsuarioIn, UsuarioUpdate, LoginIn, TokenOut, DispositivoIn, DispositivoOut, VariableIn
 from app.utils.db import get_db
 
@@ -27,7 +27,7 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
     if not usuario:
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
 
-    if not bcrypt.checkpw(form_data.password.encode("utf-8"), usuario["password"].encode("utf-8")):
+    if not await check_password(form_data.password, usuario["password"]):
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
 
     # Construir datos adicionales para el token
@@ -0,0 +1,18 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import PlainTextResponse
+
+from app.routes.health import estado_buffers
+from app.utils.metrics import METRICS_ENABLED, registry, render_gauges
+
+router = APIRouter(tags=["metrics"])
+
+# Formato de exposición de texto de Prometheus
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metricas():
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Métricas desactivadas")
+
+    # Profundidad de cola y contadores de los buffers, leídos en el momento
+    buffers = await estado_buffers()
+    body = registry.render() + render_gauges("iot_buffer", "buffer", buffers)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
@@ -3,11 +3,13 @@ from fastapi import APIRouter, HTTPException, Depends
 
 from typing import List
 import bcrypt
+from pymongo.errors import DuplicateKeyError
 
 
 from app.models.schemas import UsuarioOut,UsuarioIn, UsuarioUpdate
 from app.utils.db import get_db
-from app.routes.auth import get_current_user
+from app.routes.auth import get_current_user, hash_password
+from app.utils.cascade import iniciar_borrado_usuario, obtener_job
 
 router = APIRouter()
 
@@ -49,11 +51,11 @@ async def crear_usuario(usuario: UsuarioIn):
     if await db["usuarios"].find_one({"email": usuario.email}):
         raise HTTPException(status_code=400, detail="El correo electrónico ya está en uso")
     
-    hashed_pw = bcrypt.hashpw(usuario.password.encode("utf-8"), bcrypt.gensalt())
+    hashed_pw = await hash_password(usuario.password)
 
     nuevo_usuario = {
         "username": usuario.username,
-        "password": hashed_pw.decode("utf-8"),
+        "password": hashed_pw,
         "email": usuario.email,
         "name": usuario.name,
         "country": usuario.country,
@@ -62,11 +64,15 @@ async def crear_usuario(usuario: UsuarioIn):
         "rol": usuario.rol
     }
 
-    await db["usuarios"].insert_one(nuevo_usuario)
+    try:
+        await db["usuarios"].insert_one(nuevo_usuario)
+    except DuplicateKeyError:
+        # Alta concurrente: lo garantiza el índice único
+        raise HTTPException(status_code=400, detail="El usuario o el correo ya existen")
     return {"Usuario creado con exito"}
 
-# Eliminar un usuario (solo si está autenticado)
-@router.delete("/users/{username}")
+# Eliminar un usuario y todos sus recursos (trabajo en segundo plano)
+@router.delete("/users/{username}", status_code=202)
 async def eliminar_usuario(username: str, user: dict = Depends(get_current_user)):
     db = get_db()
     if db is None:
@@ -76,11 +82,36 @@ async def eliminar_usuario(username: str, user: dict = Depends(get_current_user)
     if username != user["username"]:
         raise HTTPException(status_code=403, detail="No tienes permiso para eliminar este usuario")
 
-    resultado = await db["usuarios"].delete_one({"username": username})
-    if resultado.deleted_count == 0:
+    if not await db["usuarios"].find_one({"username": username}, {"_id": 1}):
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
-    
-    return {"message": f"Usuario '{username}' eliminado correctamente"}
+
+    # Dispositivos, reglas EMQX, ACL, variables, alarmas e histórico se
+    # borran en segundo plano; el avance se consulta con el job_id
+    job_id = await iniciar_borrado_usuario(username)
+    return {
+        "message": f"Eliminación del usuario '{username}' en curso",
+        "job_id": job_id
+    }
+
+
+# Progreso del borrado en cascada de un usuario
+@router.get("/users/{username}/delete-jobs/{job_id}")
+async def estado_borrado_usuario(username: str, job_id: str, user: dict = Depends(get_current_user)):
+    if username != user["username"]:
+        raise HTTPException(status_code=403, detail="No tienes permiso para consultar este usuario")
+
+    job = await obtener_job(job_id)
+    if not job or job.get("username") != username:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+
+    return {
+        "job_id": job["_id"],
+        "status": job["status"],
+        "progress": job.get("progress", {}),
+        "error": job.get("error"),
+        "created_at": job.get("created_at"),
+        "finished_at": job.get("finished_at")
+    }
 
 
 # Actualizar datos de un usuario (solo si está autenticado)
@@ -105,8 +136,7 @@ async def actualizar_usuario(
     actualizaciones = {}
 
     if datos.password:
-        hashed_pw = bcrypt.hashpw(datos.password.encode("utf-8"), bcrypt.gensalt())
-        actualizaciones["password"] = hashed_pw.decode("utf-8")
+        actualizaciones["password"] = await hash_password(datos.password)
 
     if not actualizaciones:
         raise HTTPException(status_code=400, detail="No se proporcionaron datos para actualizar")
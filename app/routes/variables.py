@@ -1,10 +1,17 @@
-from fastapi import APIRouter, HTTPException, Depends
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
+from pymongo.errors import DuplicateKeyError
 from app.routes.auth import get_current_user
 from app.models.schemas import VariableIn
 from app.utils.db import get_db
+from app.utils.pagination import MAX_PAGE_SIZE, paginar, parse_fields
 
 router = APIRouter()
 
+# Campos que puede devolver GET /variables
+VARIABLE_FIELDS = ("id", "device_id", "variable_name", "unit", "description", "sampling_ms", "username")
+
 # Crear una variable
 @router.post("/variables")
 async def agregar_variable(variable: VariableIn, user: dict = Depends(get_current_user)):
@@ -41,27 +48,36 @@ async def agregar_variable(variable: VariableIn, user: dict = Depends(get_curren
         "sampling_ms": variable.sampling_ms
     }
 
-    await db["variables"].insert_one(nueva_variable)
+    try:
+        await db["variables"].insert_one(nueva_variable)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Ya existe una variable con ese nombre para el mismo dispositivo")
     return {"message": "Variable registrada correctamente"}
 
 # Obtener todas las variables del usuario autenticado
+# (paginación por id con limit/after, proyección con fields y NDJSON con stream)
 @router.get("/variables")
-async def obtener_variables(user: dict = Depends(get_current_user)):
+async def obtener_variables(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = Query(None, description="Id de la última variable de la página anterior"),
+    fields: Optional[str] = Query(None, description=f"Campos separados por comas: {','.join(VARIABLE_FIELDS)}"),
+    stream: bool = Query(False, description="Respuesta NDJSON en streaming"),
+    user: dict = Depends(get_current_user)
+):
     db = get_db()
     if db is None:
         raise HTTPException(status_code=500, detail="Base de datos no inicializada")
 
-    variables_cursor = db["variables"].find({"username": user["username"]})
-    variables = []
-    async for variable in variables_cursor:
-        variables.append({
-            "id": str(variable["_id"]),
-            "device_id": variable.get("device_id"),
-            "variable_name": variable.get("variable_name"),
-            "unit": variable.get("unit"),
-            "description": variable.get("description"),
-            "sampling_ms": variable.get("sampling_ms"),
-            "username": variable.get("username")
-        })
+    campos, projection = parse_fields(fields, VARIABLE_FIELDS)
+    resultado = await paginar(
+        db["variables"], {"username": user["username"]}, campos, projection, limit, after, stream
+    )
+    if stream:
+        return resultado
+
+    variables, next_after = resultado
+    if next_after:
+        response.headers["X-Next-After"] = next_after
     return variables
 
@@ -1,90 +1,142 @@
 # routers/webhook.py
 from fastapi import APIRouter, Request, HTTPException
-import logging, json
+import os, logging, json, itertools, time
 from datetime import datetime
-
-from app.utils.db import get_db
-from app.apis.influx_api import write_to_influx
+from typing import Any, List
+
+from app.utils import fastjson
+from app.utils.topics import parse_sdata_topic
+from app.utils.ingest import decode_saver_body, parse_saver_record, persist_samples
+from app.utils.mongo_buffer import BufferFullError, insert_documents
+from app.utils.alarm_engine import STATE_ACTIVE, alarm_deduplicator
+from app.utils.device_registry import device_registry
+from app.utils.spool import spill
+from app.utils.metrics import ALARMS, INGEST_STAGE_SECONDS, WEBHOOK_SECONDS, count_by_tenant, timed
+from app.apis.emqx_api import save_rules_consolidated
 
 router = APIRouter()
 
-@router.post("/saver-webhook")
-async def saver_webhook(req: Request):
-    body = await req.json()
-    logging.info("Saver webhook payload raw = %r", body)
-
-    topic = body.get("topic")
-    payload_str = body.get("payload")
+# Los cuerpos crudos se registran en DEBUG; en INFO solo 1 de cada N
+# mensajes (WEBHOOK_LOG_SAMPLE_N, 0 = nunca)
+WEBHOOK_LOG_SAMPLE_N = int(os.getenv("WEBHOOK_LOG_SAMPLE_N", 0))
+_log_counter = itertools.count()
 
-    if not topic or not payload_str:
-        logging.error("Faltan 'topic' o 'payload' en el body: %r", body)
-        raise HTTPException(status_code=400, detail="Falta topic o payload")
+def _log_body(msg: str, body: Any) -> None:
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug(msg, body)
+    elif WEBHOOK_LOG_SAMPLE_N and next(_log_counter) % WEBHOOK_LOG_SAMPLE_N == 0:
+        logging.info(msg, body)
 
-    try:
-        payload = json.loads(payload_str)
-    except json.JSONDecodeError:
-        logging.error("No se pudo parsear el payload como JSON: %r", payload_str)
-        raise HTTPException(status_code=400, detail="Payload inválido")
 
-    value = payload.get("value")
-    if value is None:
-        logging.error("Falta 'value' en el payload: %r", payload)
-        raise HTTPException(status_code=400, detail="Falta value")
+@router.post("/saver-webhook")
+@timed(WEBHOOK_SECONDS, "saver")
+async def saver_webhook(req: Request):
+    raw = await req.body()
+    _log_body("Saver webhook payload raw = %r", raw)
 
-    # Extraer partes del topic
     try:
-        parts = topic.split("/")
-        username = parts[1]
-        device_id = parts[2]
-        variable_id = parts[3]
-    except Exception:
-        logging.error("No se pudo parsear device/variable del topic: %r", topic)
-        raise HTTPException(status_code=400, detail="Formato de topic inválido")
-
-    logging.info(f"username: {username}, device_id: {device_id}, variable_id: {variable_id}")
+        with INGEST_STAGE_SECONDS.time("parse"):
+            sample = decode_saver_body(raw)
+    except ValueError as e:
+        logging.warning("Registro de saver inválido (%s): %r", e, raw)
+        raise HTTPException(status_code=400, detail=str(e))
 
-    saver_doc = {
-        "username": username,
-        "device_id": device_id,
-        "variable_id": variable_id,
-        "value": value,
-        "topic": topic,
-        "timestamp": datetime.utcnow()
-    }
+    # Con reglas SAVE por usuario o globales EMQX no filtra por dispositivo
+    if save_rules_consolidated() and not await device_registry.owns(sample["username"], sample["device_id"]):
+        logging.warning("Muestra de dispositivo no registrado: %s", sample["topic"])
+        raise HTTPException(status_code=403, detail="Dispositivo no registrado")
 
-    db = get_db()
-    if db is None:
+    try:
+        await persist_samples([sample])
+    except BufferFullError:
+        logging.warning("Buffer de measurements lleno, se responde 503")
+        raise HTTPException(status_code=503, detail="Buffer lleno, reintentar")
+    except RuntimeError:
         logging.error("Base de datos no inicializada en saver-webhook")
         raise HTTPException(status_code=500, detail="BD no inicializada")
-
-    try:
-        await db["measurements"].insert_one(saver_doc)
-        logging.info("data save: %r", saver_doc)
     except Exception as e:
         logging.error("Error insertando dato en MongoDB: %r", e)
         raise HTTPException(status_code=500, detail="Error guardando ")
-    
+
+    return {}
+
+#----------------------------------------------------------------------------------
+# SAVER WEBHOOK POR LOTES
+#----------------------------------------------------------------------------------
+def _decode_batch(raw: bytes, content_type: str) -> List[Any]:
+    """
+    Decodifica el cuerpo del lote: array JSON o NDJSON (un registro por línea).
+    En NDJSON una línea ilegible se devuelve como None para reportarla.
+    """
+    text = raw.decode("utf-8")
+    if "ndjson" not in content_type and text.lstrip().startswith("["):
+        records = fastjson.loads(text)
+        if not isinstance(records, list):
+            raise ValueError("Se esperaba un array JSON")
+        return records
+
+    records = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            records.append(fastjson.loads(line))
+        except json.JSONDecodeError:
+            records.append(None)
+    return records
+
+@router.post("/saver-webhook/batch")
+@timed(WEBHOOK_SECONDS, "saver-batch")
+async def saver_webhook_batch(req: Request):
+    """
+    Recibe muchos registros {topic, payload[, timestamp]} en una sola petición,
+    como array JSON o NDJSON (Content-Type: application/x-ndjson).
+    Cada registro se valida por separado; los válidos se guardan con un único
+    insert_many y una única escritura multilínea en Influx.
+    """
+    inicio = time.perf_counter()
     try:
-        await write_to_influx(
-            measurement="iot_data",
-            tags={
-                "username": username,
-                "device_id": device_id,
-                "variable_id": variable_id
-            },
-            fields={
-                "value": value
-            },
-            timestamp=datetime.utcnow()
-        )
+        records = _decode_batch(await req.body(), req.headers.get("content-type", ""))
+    except (ValueError, UnicodeDecodeError) as e:
+        logging.error("No se pudo decodificar el lote del saver: %r", e)
+        raise HTTPException(status_code=400, detail="Lote inválido")
+
+    samples = []
+    indices = []
+    errors = []
+    for index, record in enumerate(records):
+        try:
+            samples.append(parse_saver_record(record))
+            indices.append(index)
+        except ValueError as e:
+            errors.append({"index": index, "error": str(e)})
+    INGEST_STAGE_SECONDS.observe(time.perf_counter() - inicio, "parse")
+
+    if save_rules_consolidated() and samples:
+        samples, rejected = await device_registry.split_owned(samples)
+        errors.extend({"index": indices[i], "error": "Dispositivo no registrado"} for i in rejected)
+        errors.sort(key=lambda e: e["index"])
+
+    try:
+        await persist_samples(samples)
+    except BufferFullError:
+        logging.warning("Buffer de measurements lleno, lote de %d rechazado con 503", len(samples))
+        raise HTTPException(status_code=503, detail="Buffer lleno, reintentar")
+    except RuntimeError:
+        logging.error("Base de datos no inicializada en saver-webhook/batch")
+        raise HTTPException(status_code=500, detail="BD no inicializada")
     except Exception as e:
-        logging.error("Error escribiendo en InfluxDB: %r", e)
+        logging.error("Error insertando lote en MongoDB: %r", e)
+        raise HTTPException(status_code=500, detail="Error guardando lote")
+
+    logging.info("Lote del saver: %d aceptados, %d rechazados", len(samples), len(errors))
+    return {"accepted": len(samples), "rejected": len(errors), "errors": errors}
 
-    return {}
 #----------------------------------------------------------------------------------
 # ALARM WEBHOOK
 #----------------------------------------------------------------------------------
 @router.post("/alarms-webhook")
+@timed(WEBHOOK_SECONDS, "alarms")
 async def alarms_webhook(req: Request):
     """
     Recibe POST de EMQX cuando una regla de alarma se dispara.
@@ -96,8 +148,15 @@ async def alarms_webhook(req: Request):
     Aquí extraemos device_id y variable_id del topic si no vienen en el payload.
     """
 
-    body = await req.json()
-    logging.info("Alarm webhook payload raw = %r", body)
+    raw = await req.body()
+    _log_body("Alarm webhook payload raw = %r", raw)
+    try:
+        body = fastjson.loads(raw)
+    except json.JSONDecodeError:
+        logging.warning("Cuerpo de alarma no es JSON: %r", raw)
+        raise HTTPException(status_code=400, detail="Cuerpo JSON inválido")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Cuerpo JSON inválido")
 
     # Value y topic siempre deben venir
     value = body.get("value")
@@ -106,17 +165,19 @@ async def alarms_webhook(req: Request):
         logging.error("Faltan 'value' o 'topic' en el payload de alarma: %r", body)
         raise HTTPException(status_code=400, detail="Falta value o topic")
 
-
-
     try:
-        parts=topic.split("/")
-        username=parts[1]
-        device_id=parts[2]
-        variable_id=parts[3]
-    except Exception:
+        username, device_id, variable_id = parse_sdata_topic(topic)
+    except ValueError:
         logging.error("No se pudo parsear device/variable del topic: %r", topic)
         raise HTTPException(status_code=400, detail="Formato de topic inválido")
 
+    # Solo se persiste la activación; los disparos repetidos de la misma
+    # regla se descartan (otra regla sobre la variable es otra alarma)
+    rule_id = body.get("rule_id") or None
+    now = datetime.utcnow()
+    if not alarm_deduplicator.should_persist((username, device_id, variable_id, rule_id), now.timestamp()):
+        return {}
+
     # Construir documento de alarma
     alarm_doc = {
         "username": username,
@@ -124,19 +185,26 @@ async def alarms_webhook(req: Request):
         "variable_id": variable_id,
         "value":       value,
         "topic":       topic,
-        "timestamp":   datetime.utcnow()
+        "rule_id":     rule_id,
+        "state":       STATE_ACTIVE,
+        "timestamp":   now
     }
+    count_by_tenant(ALARMS, [alarm_doc])
 
-    # Persistir en MongoDB
-    db = get_db()
-    if db is None:
-        logging.error("Base de datos no inicializada en alarms-webhook")
-        raise HTTPException(status_code=500, detail="BD no inicializada")
-
+    # Persistir en MongoDB (write-behind si está activo)
     try:
-        await db["alarms"].insert_one(alarm_doc)
-        logging.info("Alarma guardada: %r", alarm_doc)
+        await insert_documents("alarms", [alarm_doc])
+        logging.debug("Alarma guardada: %r", alarm_doc)
+    except BufferFullError:
+        logging.warning("Buffer de alarms lleno, se responde 503")
+        raise HTTPException(status_code=503, detail="Buffer lleno, reintentar")
     except Exception as e:
+        # Sin MongoDB la alarma queda en el spool local para reenviarla
+        if await spill("mongo:alarms", [alarm_doc]):
+            return {}
+        if isinstance(e, RuntimeError):
+            logging.error("Base de datos no inicializada en alarms-webhook")
+            raise HTTPException(status_code=500, detail="BD no inicializada")
         logging.error("Error insertando alarma en MongoDB: %r", e)
         raise HTTPException(status_code=500, detail="Error guardando alarma")
 
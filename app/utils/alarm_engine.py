@@ -0,0 +1,352 @@
+import os
+import logging
+import operator
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.utils.db import get_db
+from app.utils.streaming import AGGREGATES, SlidingWindow
+
+# ---------------------------------------------------
+# Motor de alarmas en proceso
+# ---------------------------------------------------
+# emqx:  cada alarma es una regla del rule engine de EMQX (comportamiento original).
+# local: las reglas se indexan en memoria por (username, device_id, variable_id)
+#        y se evalúan en el camino de ingesta, sin reglas en EMQX.
+# Las reglas con ventana (window_s) siempre se evalúan aquí: EMQX no puede.
+# Cada proceso mantiene su propio índice; se carga de `alarmas` al arrancar.
+ALARM_ENGINE = os.getenv("ALARM_ENGINE", "emqx").lower()
+ALARM_WINDOW_MAX_SAMPLES = int(os.getenv("ALARM_WINDOW_MAX_SAMPLES", 10000))
+
+# Estados de una regla; solo las transiciones se guardan en `alarms`
+STATE_OK = "OK"
+STATE_ACTIVE = "ACTIVE"
+
+OPERATORS = {
+    ">": operator.gt,
+    "<": operator.lt,
+    ">=": operator.ge,
+    "<=": operator.le,
+    "=": operator.eq,
+    "!=": operator.ne,
+}
+
+SeriesKey = Tuple[str, str, str]
+# (username, device_id, variable_id, rule_id) de una regla EMQX
+RuleSeriesKey = Tuple[str, str, str, Optional[str]]
+
+# Campos que definen una regla: si alguno cambia en `alarmas`, se reconstruye
+_RULE_FIELDS = (
+    "username", "device_id", "variable_id", "field", "operator", "threshold",
+    "window_s", "aggregate", "hysteresis", "min_retrigger_s", "cooldown_s"
+)
+
+
+def _rule_spec(doc: Dict[str, Any]) -> Tuple[Any, ...]:
+    return tuple(doc.get(campo) for campo in _RULE_FIELDS)
+
+
+def local_alarms_enabled() -> bool:
+    return ALARM_ENGINE == "local"
+
+def is_local_rule(doc: Dict[str, Any]) -> bool:
+    """True si la regla se evalúa en proceso y no como regla de EMQX."""
+    return local_alarms_enabled() or bool(doc.get("window_s"))
+
+
+class AlarmRule:
+    __slots__ = (
+        "rule_id", "spec", "key", "field", "operator", "threshold", "window_s", "aggregate", "_compare",
+        "hysteresis", "min_retrigger_s", "cooldown_s", "active", "activated_at", "clear_since"
+    )
+
+    def __init__(self, doc: Dict[str, Any]):
+        op = doc["operator"]
+        if op not in OPERATORS:
+            raise ValueError(f"Operador inválido: {op!r}. Debe estar en {set(OPERATORS)}")
+        self.rule_id = doc["rule_id"]
+        self.spec = _rule_spec(doc)
+        self.key: SeriesKey = (doc["username"], doc["device_id"], doc["variable_id"])
+        self.field = doc.get("field", "value")
+        self.operator = op
+        self.threshold = float(doc["threshold"])
+        self._compare = OPERATORS[op]
+
+        # Reglas con ventana: se compara el agregado, no la muestra
+        self.window_s = doc.get("window_s") or None
+        self.aggregate = doc.get("aggregate") or "mean"
+        if self.window_s is not None:
+            if self.window_s <= 0:
+                raise ValueError("window_s debe ser mayor que 0")
+            if self.aggregate not in AGGREGATES:
+                raise ValueError(f"Agregado inválido: {self.aggregate!r}. Debe estar en {AGGREGATES}")
+
+        # Antirrebote: banda de histéresis para volver a OK, intervalo mínimo
+        # entre activaciones y tiempo que la condición debe estar despejada
+        self.hysteresis = float(doc.get("hysteresis") or 0)
+        self.min_retrigger_s = float(doc.get("min_retrigger_s") or 0)
+        self.cooldown_s = float(doc.get("cooldown_s") or 0)
+        self.active = False
+        self.activated_at: Optional[float] = None
+        self.clear_since: Optional[float] = None
+
+    @property
+    def window_key(self) -> Tuple[str, float]:
+        return (self.field, self.window_s)
+
+    def matches(self, value: Any) -> bool:
+        try:
+            return self._compare(float(value), self.threshold)
+        except (TypeError, ValueError):
+            return False
+
+    def is_clear(self, value: Any) -> bool:
+        try:
+            v = float(value)
+        except (TypeError, ValueError):
+            return False
+        if self.operator in (">", ">="):
+            return v < self.threshold - self.hysteresis
+        if self.operator in ("<", "<="):
+            return v > self.threshold + self.hysteresis
+        return not self._compare(v, self.threshold)
+
+    def transition(self, value: Any, ts: float) -> Optional[str]:
+        """
+        Avanza la máquina OK/ACTIVE con un nuevo valor y devuelve el nuevo
+        estado si hubo transición, o None si no cambia.
+        """
+        if not self.active:
+            if not self.matches(value):
+                return None
+            if self.activated_at is not None and ts - self.activated_at < self.min_retrigger_s:
+                return None
+            self.active = True
+            self.activated_at = ts
+            self.clear_since = None
+            return STATE_ACTIVE
+
+        if not self.is_clear(value):
+            self.clear_since = None
+            return None
+        if self.clear_since is None:
+            self.clear_since = ts
+        if ts - self.clear_since < self.cooldown_s:
+            return None
+        self.active = False
+        self.clear_since = None
+        return STATE_OK
+
+
+class AlarmEngine:
+    """
+    Índice de reglas por serie: evaluar una muestra es una sola búsqueda
+    en un dict más la comparación de los umbrales de esa serie.
+    """
+
+    def __init__(self):
+        self._index: Dict[SeriesKey, List[AlarmRule]] = {}
+        self._by_id: Dict[str, AlarmRule] = {}
+        # Ventanas compartidas por las reglas de una serie con el mismo (field, window_s)
+        self._windows: Dict[SeriesKey, Dict[Tuple[str, float], SlidingWindow]] = {}
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def add_rule(self, doc: Dict[str, Any]) -> AlarmRule:
+        rule = AlarmRule(doc)
+        self.remove_rule(rule.rule_id)
+        self._index.setdefault(rule.key, []).append(rule)
+        self._by_id[rule.rule_id] = rule
+        if rule.window_s is not None:
+            windows = self._windows.setdefault(rule.key, {})
+            if rule.window_key not in windows:
+                windows[rule.window_key] = SlidingWindow(rule.window_s, ALARM_WINDOW_MAX_SAMPLES)
+        return rule
+
+    def remove_rule(self, rule_id: str) -> None:
+        rule = self._by_id.pop(rule_id, None)
+        if rule is None:
+            return
+        rules = self._index.get(rule.key, [])
+        rules[:] = [r for r in rules if r.rule_id != rule_id]
+        if not rules:
+            self._index.pop(rule.key, None)
+
+        # Liberar la ventana si ya ninguna regla la usa
+        if rule.window_s is not None and not any(r.window_key == rule.window_key for r in rules):
+            windows = self._windows.get(rule.key, {})
+            windows.pop(rule.window_key, None)
+            if not windows:
+                self._windows.pop(rule.key, None)
+
+    def remove_device(self, username: str, device_id: str) -> None:
+        for key in [k for k in self._index if k[0] == username and k[1] == device_id]:
+            for rule in self._index.pop(key):
+                self._by_id.pop(rule.rule_id, None)
+            self._windows.pop(key, None)
+
+    def clear(self) -> None:
+        self._index.clear()
+        self._by_id.clear()
+        self._windows.clear()
+
+    def evaluate(self, sample: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Devuelve los documentos de alarma (formato de la colección `alarms`)
+        de las reglas que cambian de estado con esta muestra.
+        """
+        key = (sample["username"], sample["device_id"], sample["variable_id"])
+        rules = self._index.get(key)
+        if not rules:
+            return []
+
+        payload = sample.get("payload") or {}
+
+        # 1) Actualizar una sola vez cada ventana de la serie
+        ts = sample["timestamp"].timestamp()
+        windows = self._windows.get(key)
+        if windows:
+            for (field, _), window in windows.items():
+                raw = sample["value"] if field == "value" else payload.get(field)
+                try:
+                    window.add(ts, float(raw))
+                except (TypeError, ValueError):
+                    pass
+
+        # 2) Evaluar los umbrales; solo las transiciones generan documento
+        alarms = []
+        for rule in rules:
+            if rule.window_s is None:
+                value = sample["value"] if rule.field == "value" else payload.get(rule.field)
+            else:
+                value = windows[rule.window_key].aggregate(rule.aggregate)
+            if value is None:
+                continue
+            state = rule.transition(value, ts)
+            if state is not None:
+                alarm = {
+                    "rule_id": rule.rule_id,
+                    "state": state,
+                    "username": sample["username"],
+                    "device_id": sample["device_id"],
+                    "variable_id": sample["variable_id"],
+                    "value": value,
+                    "topic": sample["topic"],
+                    "timestamp": sample["timestamp"]
+                }
+                if rule.window_s is not None:
+                    alarm["aggregate"] = rule.aggregate
+                    alarm["window_s"] = rule.window_s
+                alarms.append(alarm)
+        return alarms
+
+    def evaluate_many(self, samples: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        if not self._index:
+            return []
+        alarms = []
+        for sample in samples:
+            alarms.extend(self.evaluate(sample))
+        return alarms
+
+    async def load_from_mongo(self) -> None:
+        db = get_db()
+        if db is None:
+            logging.warning("[alarm-engine] No se pudo obtener la conexión a MongoDB")
+            return
+
+        self.clear()
+        async for regla in db["alarmas"].find({}):
+            if not is_local_rule(regla):
+                continue
+            try:
+                self.add_rule(regla)
+            except (KeyError, ValueError) as e:
+                logging.error(f"[alarm-engine] Regla {regla.get('_id')} ignorada: {e!r}")
+        await self._restore_states(db)
+        logging.info(f"[alarm-engine] {len(self)} reglas cargadas en {len(self._index)} series")
+
+    async def sync_from_mongo(self) -> None:
+        """
+        Aplica los cambios de `alarmas` hechos desde otros procesos: añade
+        las reglas nuevas o modificadas y quita las borradas. Las reglas que
+        no cambian conservan su estado y sus ventanas.
+        """
+        db = get_db()
+        if db is None:
+            return
+
+        vistas = set()
+        cambios = 0
+        async for regla in db["alarmas"].find({}):
+            if not is_local_rule(regla):
+                continue
+            vistas.add(regla.get("rule_id"))
+            actual = self._by_id.get(regla.get("rule_id"))
+            if actual is not None and actual.spec == _rule_spec(regla):
+                continue
+            try:
+                self.add_rule(regla)
+                cambios += 1
+            except (KeyError, ValueError) as e:
+                logging.error(f"[alarm-engine] Regla {regla.get('_id')} ignorada: {e!r}")
+        for rule_id in [r for r in self._by_id if r not in vistas]:
+            self.remove_rule(rule_id)
+            cambios += 1
+        if cambios:
+            logging.info(f"[alarm-engine] {cambios} reglas sincronizadas; {len(self)} en {len(self._index)} series")
+
+    async def _restore_states(self, db) -> None:
+        """
+        Recupera el último estado persistido de cada regla para no volver a
+        emitir ACTIVE tras un reinicio si la alarma ya estaba activa.
+        """
+        pipeline = [
+            {"$match": {"rule_id": {"$in": list(self._by_id)}, "state": {"$exists": True}}},
+            {"$sort": {"timestamp": -1}},
+            {"$group": {"_id": "$rule_id", "state": {"$first": "$state"}, "timestamp": {"$first": "$timestamp"}}}
+        ]
+        try:
+            async for last in db["alarms"].aggregate(pipeline):
+                rule = self._by_id.get(last["_id"])
+                if rule is not None and last["state"] == STATE_ACTIVE:
+                    rule.active = True
+                    rule.activated_at = last["timestamp"].timestamp()
+        except Exception as e:
+            logging.warning(f"[alarm-engine] No se pudo recuperar el estado de las alarmas: {e!r}")
+
+
+class AlarmDeduplicator:
+    """
+    Para alarmas de reglas EMQX, que solo notifican disparos (nunca la
+    vuelta a la normalidad): una serie se considera ACTIVE para una regla
+    mientras sigan llegando disparos de esa regla separados menos de
+    `window_s`; solo se persiste la activación.
+    """
+
+    def __init__(self, window_s: float, max_series: int = 100000):
+        self.window_s = window_s
+        self.max_series = max_series
+        # Orden de último disparo: las series inactivas quedan al principio
+        self._last_seen: "OrderedDict[RuleSeriesKey, float]" = OrderedDict()
+
+    def should_persist(self, key: RuleSeriesKey, ts: float) -> bool:
+        last = self._last_seen.pop(key, None)
+        self._last_seen[key] = ts
+        self._purge(ts)
+        return last is None or ts - last >= self.window_s
+
+    def _purge(self, now: float) -> None:
+        # Series caducadas y, por encima de max_series, las más antiguas
+        limite = now - self.window_s
+        while self._last_seen:
+            last = next(iter(self._last_seen.values()))
+            if last >= limite and len(self._last_seen) <= self.max_series:
+                break
+            self._last_seen.popitem(last=False)
+
+alarm_engine = AlarmEngine()
+alarm_deduplicator = AlarmDeduplicator(float(os.getenv("ALARM_DEDUP_WINDOW_S", 60)))
+
+def get_alarm_engine() -> Optional[AlarmEngine]:
+    return alarm_engine if len(alarm_engine) else None
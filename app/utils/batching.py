@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+# ---------------------------------------------------
+# Base de los writers por lotes (Influx, MongoDB)
+# ---------------------------------------------------
+
+class BufferFullError(Exception):
+    """La cola del buffer está llena; el llamador debe reintentar más tarde."""
+
+
+# Spool en disco (app.utils.spool) registrado al arrancar; se inyecta para
+# no importar aquí los clientes de Influx/MongoDB
+_spool = None
+
+def set_spool(spool) -> None:
+    global _spool
+    _spool = spool
+
+
+class BatchFlusher:
+    """
+    Cola acotada que se vacía en segundo plano por lotes: se envía cuando
+    hay `batch_size` elementos o pasan `flush_interval` segundos desde el
+    primer elemento del lote. Las subclases implementan `_flush`.
+    """
+
+    name = "batch"
+    # Destino en el spool ("influx:<bucket>", "mongo:<colección>") de los
+    # lotes que no se pudieron enviar; None = se descartan
+    spool_target: Optional[str] = None
+
+    def __init__(self, batch_size: int, flush_interval: float, max_queue: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._pending: List[Any] = []
+        self._task: Optional[asyncio.Task] = None
+
+        # Métricas
+        self.flushed_items = 0
+        self.flushed_batches = 0
+        self.failed_batches = 0
+        self.rejected_items = 0
+        # Descartados por el destino (datos inválidos): ni se reintentan ni van al spool
+        self.discarded_items = 0
+        self.spooled_items = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Detiene el bucle y envía todo lo que quede en cola.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+        resto = self._pending
+        self._pending = []
+        while not self._queue.empty():
+            resto.append(self._queue.get_nowait())
+        for i in range(0, len(resto), self.batch_size):
+            await self._timed_flush(resto[i:i + self.batch_size])
+
+    # --- Productores ---
+    async def put(self, item: Any) -> None:
+        """Encola esperando si la cola está llena (backpressure)."""
+        await self._queue.put(item)
+
+    async def put_many(self, items: Iterable[Any]) -> None:
+        for item in items:
+            await self._queue.put(item)
+
+    def put_nowait(self, item: Any) -> None:
+        """Encola sin esperar; lanza BufferFullError si la cola está llena."""
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.rejected_items += 1
+            raise BufferFullError(f"Buffer '{self.name}' lleno")
+
+    def put_many_nowait(self, items: List[Any]) -> None:
+        """Encola todos o ninguno; lanza BufferFullError si no caben."""
+        if self.max_queue > 0 and self._queue.qsize() + len(items) > self.max_queue:
+            self.rejected_items += len(items)
+            raise BufferFullError(f"Buffer '{self.name}' lleno")
+        for item in items:
+            self._queue.put_nowait(item)
+
+    # --- Consumidor ---
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            # El lote en formación ya no está en la cola: si nos cancelan
+            # mientras se completa o se envía, stop() lo reenvía
+            self._pending = batch
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._timed_flush(batch)
+            self._pending = []
+
+    async def _timed_flush(self, batch: List[Any]) -> None:
+        if not batch:
+            return
+        start = time.perf_counter()
+        try:
+            # Con atrasos en el spool el lote va directo a disco, detrás de ellos
+            if self.spool_target and _spool is not None and _spool.diverting(self.spool_target):
+                if await self._spill(batch):
+                    return
+            await self._flush(batch)
+            self.flushed_items += len(batch)
+            self.flushed_batches += 1
+        except Exception as e:
+            self.failed_batches += 1
+            if await self._spill(batch):
+                logging.warning(f"[{self.name}] Lote de {len(batch)} elementos guardado en el spool: {e!r}")
+            else:
+                logging.error(f"[{self.name}] Lote de {len(batch)} elementos descartado: {e!r}")
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.last_flush_ms = elapsed
+            self.total_flush_ms += elapsed
+            self.max_flush_ms = max(self.max_flush_ms, elapsed)
+
+    async def _flush(self, batch: List[Any]) -> None:
+        raise NotImplementedError
+
+    async def _spill(self, batch: List[Any]) -> bool:
+        if not self.spool_target or _spool is None:
+            return False
+        try:
+            await _spool.append(self.spool_target, batch)
+        except Exception as e:
+            logging.error(f"[{self.name}] No se pudo guardar el lote en el spool: {e!r}")
+            return False
+        self.spooled_items += len(batch)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        batches = self.flushed_batches + self.failed_batches
+        return {
+            "queue_depth": self.qsize(),
+            "queue_max": self.max_queue,
+            "flushed_items": self.flushed_items,
+            "flushed_batches": self.flushed_batches,
+            "failed_batches": self.failed_batches,
+            "rejected_items": self.rejected_items,
+            "discarded_items": self.discarded_items,
+            "spooled_items": self.spooled_items,
+            "last_flush_ms": round(self.last_flush_ms, 3),
+            "max_flush_ms": round(self.max_flush_ms, 3),
+            "avg_flush_ms": round(self.total_flush_ms / batches, 3) if batches else 0.0
+        }
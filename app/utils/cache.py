@@ -0,0 +1,51 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+# ---------------------------------------------------
+# Caché LRU con caducidad (TTL)
+# ---------------------------------------------------
+
+class TTLCache:
+    """
+    Caché en memoria acotada a `maxsize` entradas (se expulsa la menos
+    usada) donde cada entrada caduca `ttl` segundos después de guardarse.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 10.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires, value = item
+        if expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, predicate=None) -> None:
+        """Borra todo, o solo las claves para las que `predicate(key)` es cierto."""
+        if predicate is None:
+            self._data.clear()
+            return
+        for key in [k for k in self._data if predicate(k)]:
+            del self._data[key]
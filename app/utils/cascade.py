@@ -0,0 +1,259 @@
+import os
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import httpx
+from bson.objectid import ObjectId
+from pymongo.errors import OperationFailure
+
+from app.utils.db import get_db
+from app.apis.emqx_api import emqx_delete
+from app.utils.alarm_engine import alarm_engine
+from app.utils.device_registry import device_registry
+from app.utils.latest_values import latest_values
+from app.utils.invalidation import CACHE_ALARM_RULES, CACHE_DEVICES, cache_versions
+from app.utils.timeseries import MEASUREMENTS_TIMESERIES
+
+# ---------------------------------------------------
+# Borrado en cascada de dispositivos y usuarios
+# ---------------------------------------------------
+# Las reglas de EMQX se borran en paralelo (acotado) y los documentos de
+# Mongo con un delete_many por colección, dentro de una transacción si el
+# despliegue la soporta (replica set o mongos).
+CASCADE_EMQX_CONCURRENCY = int(os.getenv("CASCADE_EMQX_CONCURRENCY", 16))
+CASCADE_BATCH_SIZE = int(os.getenv("CASCADE_BATCH_SIZE", 500))
+
+# None = sin comprobar todavía
+_transactions_supported: Optional[bool] = None
+
+
+async def eliminar_reglas_emqx(rule_ids: Iterable[str]) -> Tuple[int, List[str]]:
+    """
+    Borra reglas de EMQX con concurrencia acotada. Devuelve cuántas se
+    borraron y los rule_id que fallaron (una regla que ya no existe cuenta
+    como borrada).
+    """
+    # Las reglas locales (motor en proceso) no existen en EMQX
+    rule_ids = [r for r in set(rule_ids) if r and not r.startswith("local:")]
+    sem = asyncio.Semaphore(CASCADE_EMQX_CONCURRENCY)
+
+    async def _borrar(rule_id):
+        async with sem:
+            try:
+                await emqx_delete(f"/rules/{rule_id}")
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code != 404:
+                    raise
+
+    borradas, fallidas = 0, []
+    for rule_id, res in zip(rule_ids, await asyncio.gather(*(_borrar(r) for r in rule_ids), return_exceptions=True)):
+        if isinstance(res, Exception):
+            fallidas.append(rule_id)
+            logging.warning(f"[delete] Error eliminando regla EMQX {rule_id}: {res!r}")
+        else:
+            borradas += 1
+    return borradas, fallidas
+
+
+async def _borrar_en_bloque(db, ops: List[Tuple[str, Dict[str, Any]]]) -> Dict[str, int]:
+    """
+    Ejecuta un delete_many por (colección, filtro). Se intenta en una
+    transacción; en un Mongo standalone se hace sin ella.
+    """
+    global _transactions_supported
+    client = getattr(db, "client", None)
+
+    if client is not None and _transactions_supported is not False:
+        try:
+            borrados = {}
+            async with await client.start_session() as session:
+                async with session.start_transaction():
+                    for coll, filtro in ops:
+                        res = await db[coll].delete_many(filtro, session=session)
+                        borrados[coll] = borrados.get(coll, 0) + res.deleted_count
+            _transactions_supported = True
+            return borrados
+        except OperationFailure as e:
+            # 20 = IllegalOperation: transacciones no soportadas en standalone
+            if e.code != 20:
+                raise
+            _transactions_supported = False
+            logging.info("[delete] MongoDB sin soporte de transacciones: borrado sin transacción")
+
+    borrados = {}
+    for coll, filtro in ops:
+        res = await db[coll].delete_many(filtro)
+        borrados[coll] = borrados.get(coll, 0) + res.deleted_count
+    return borrados
+
+
+async def eliminar_dispositivos(db, username: str, dispositivos: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Borra en cascada los dispositivos dados (documentos de `dispositivos`):
+    reglas SAVE/ALARM en EMQX, save-rules, alarmas, variables, últimos
+    valores, usuarios y ACL MQTT y el propio dispositivo. Las reglas EMQX
+    que no se pudieron borrar se devuelven en `emqx_rules_failed`.
+    """
+    if not dispositivos:
+        return {}
+
+    device_ids = [d["device_id"] for d in dispositivos]
+    mqtt_usernames = [d["mqtt_username"] for d in dispositivos if d.get("mqtt_username")]
+    filtro = {"username": username, "device_id": {"$in": device_ids}}
+
+    # 1. Reglas de EMQX (por dispositivo) antes de perder sus ids
+    rule_ids = []
+    async for rule in db["emqx_save_rules"].find(filtro, {"rule_id": 1}):
+        rule_ids.append(rule.get("rule_id"))
+    async for alarma in db["alarmas"].find(filtro, {"rule_id": 1}):
+        rule_ids.append(alarma.get("rule_id"))
+    reglas, reglas_fallidas = await eliminar_reglas_emqx(rule_ids)
+
+    # 2. Documentos de Mongo en bloque
+    ops = [
+        ("emqx_save_rules", filtro),
+        ("alarmas", filtro),
+        ("variables", filtro),
+        ("latest_values", filtro),
+        ("dispositivos", {"_id": {"$in": [d["_id"] for d in dispositivos]}}),
+    ]
+    if mqtt_usernames:
+        ops += [
+            ("mqtt_user", {"username": {"$in": mqtt_usernames}}),
+            ("mqtt_acl", {"username": {"$in": mqtt_usernames}}),
+        ]
+    borrados = await _borrar_en_bloque(db, ops)
+
+    # 3. Estado en memoria (este proceso; el resto se entera por cache_versions)
+    for device_id in device_ids:
+        alarm_engine.remove_device(username, device_id)
+        device_registry.remove(username, device_id)
+        latest_values.remove_device(username, device_id)
+    await cache_versions.bump(CACHE_ALARM_RULES)
+    await cache_versions.bump(CACHE_DEVICES)
+
+    borrados["emqx_rules"] = reglas
+    borrados["emqx_rules_failed"] = reglas_fallidas
+    logging.info(f"[delete] {len(device_ids)} dispositivos de {username} eliminados: {borrados}")
+    if reglas_fallidas:
+        # Sin documento que las reclame: la reconciliación del arranque las borra
+        logging.error(
+            f"[delete] {len(reglas_fallidas)} reglas EMQX de {username} sin borrar: {reglas_fallidas}"
+        )
+    return borrados
+
+
+
+async def sincronizar_dispositivos() -> None:
+    """
+    Recarga (vía cache_versions) tras altas o borrados hechos en otro
+    proceso: registro de dispositivos y últimos valores de los borrados.
+    """
+    await device_registry.load_from_mongo()
+    latest_values.retain_devices(device_registry)
+
+
+async def _eliminar_historico(db, username: str) -> None:
+    """
+    Borra measurements y alarms del usuario. Fuera de la transacción: las
+    colecciones time-series no admiten borrados transaccionales y en
+    MongoDB 5.0 ni siquiera borrados por filtro (los eliminará el TTL).
+    """
+    campo = "meta.username" if MEASUREMENTS_TIMESERIES else "username"
+    for coll, filtro in (("measurements", {campo: username}), ("alarms", {"username": username})):
+        try:
+            await db[coll].delete_many(filtro)
+        except OperationFailure as e:
+            logging.warning(f"[delete] No se pudo borrar {coll} de {username} ({e}); quedará para el TTL")
+
+
+# ---------------------------------------------------
+# Trabajos de borrado de usuarios
+# ---------------------------------------------------
+# El progreso se guarda en la colección `jobs` para que cualquier proceso
+# pueda consultarlo.
+_running_jobs: set = set()
+
+async def _actualizar_job(db, job_id: str, campos: Dict[str, Any]) -> None:
+    await db["jobs"].update_one({"_id": job_id}, {"$set": campos})
+
+async def _cascada_usuario(job_id: str, username: str) -> None:
+    db = get_db()
+    progreso = {"devices_total": 0, "devices_deleted": 0, "emqx_rules_deleted": 0, "emqx_rules_failed": []}
+    try:
+        progreso["devices_total"] = await db["dispositivos"].count_documents({"username": username})
+        await _actualizar_job(db, job_id, {"status": "running", "progress": progreso})
+
+        # 1. Dispositivos por lotes, informando del avance tras cada uno
+        while True:
+            lote = await db["dispositivos"].find(
+                {"username": username}, {"device_id": 1, "mqtt_username": 1}
+            ).limit(CASCADE_BATCH_SIZE).to_list(length=CASCADE_BATCH_SIZE)
+            if not lote:
+                break
+            borrados = await eliminar_dispositivos(db, username, lote)
+            progreso["devices_deleted"] += len(lote)
+            progreso["emqx_rules_deleted"] += borrados.get("emqx_rules", 0)
+            progreso["emqx_rules_failed"] += borrados.get("emqx_rules_failed", [])
+            await _actualizar_job(db, job_id, {"progress": progreso})
+
+        # 2. Recursos a nivel de usuario: regla SAVE por usuario y restos huérfanos
+        rule_ids = []
+        async for rule in db["emqx_save_rules"].find({"username": username}, {"rule_id": 1}):
+            rule_ids.append(rule.get("rule_id"))
+        async for alarma in db["alarmas"].find({"username": username}, {"rule_id": 1}):
+            rule_ids.append(alarma.get("rule_id"))
+        borradas, fallidas = await eliminar_reglas_emqx(rule_ids)
+        progreso["emqx_rules_deleted"] += borradas
+        progreso["emqx_rules_failed"] += fallidas
+        await _borrar_en_bloque(db, [
+            ("emqx_save_rules", {"username": username}),
+            ("alarmas", {"username": username}),
+            ("variables", {"username": username}),
+            ("latest_values", {"username": username}),
+            ("usuarios", {"username": username}),
+        ])
+        await _eliminar_historico(db, username)
+
+        # partial: todo borrado en Mongo, pero quedan reglas en EMQX (progress.emqx_rules_failed)
+        await _actualizar_job(db, job_id, {
+            "status": "partial" if progreso["emqx_rules_failed"] else "done",
+            "progress": progreso,
+            "finished_at": datetime.utcnow()
+        })
+        logging.info(f"[delete] Usuario '{username}' eliminado en cascada: {progreso}")
+    except Exception as e:
+        logging.error(f"[delete] Error en el borrado en cascada de '{username}': {e!r}")
+        await _actualizar_job(db, job_id, {
+            "status": "failed", "error": str(e), "progress": progreso, "finished_at": datetime.utcnow()
+        })
+
+
+async def iniciar_borrado_usuario(username: str) -> str:
+    """Registra el trabajo en `jobs`, lo lanza en segundo plano y devuelve su id."""
+    db = get_db()
+    if db is None:
+        raise RuntimeError("BD no inicializada")
+
+    job_id = str(ObjectId())
+    await db["jobs"].insert_one({
+        "_id": job_id,
+        "type": "user-cascade-delete",
+        "username": username,
+        "status": "pending",
+        "progress": {},
+        "created_at": datetime.utcnow(),
+    })
+    task = asyncio.create_task(_cascada_usuario(job_id, username))
+    _running_jobs.add(task)
+    task.add_done_callback(_running_jobs.discard)
+    return job_id
+
+
+async def obtener_job(job_id: str) -> Optional[Dict[str, Any]]:
+    db = get_db()
+    if db is None:
+        raise RuntimeError("BD no inicializada")
+    return await db["jobs"].find_one({"_id": job_id})
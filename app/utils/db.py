@@ -2,6 +2,9 @@ from motor.motor_asyncio import AsyncIOMotorClient
 from pymongo.errors import PyMongoError
 import os
 
+from app.utils.mongo_indexes import ensure_indexes
+from app.utils.timeseries import ensure_measurements_collection
+
 client = None
 db = None
 
@@ -19,6 +22,8 @@ async def connect_to_mongo():
         client = AsyncIOMotorClient(uri)
         db = client[mongo_db]
         print("✅ Conectado a MongoDB con Motor")
+        await ensure_measurements_collection(db)
+        await ensure_indexes(db)
     except PyMongoError as e:
         print("❌ Error de conexión a MongoDB:", e)
 
@@ -0,0 +1,96 @@
+import os
+import time
+import logging
+from typing import Any, Dict, List, Set, Tuple
+
+from fastapi import HTTPException
+
+from app.utils.db import get_db
+
+# ---------------------------------------------------
+# Registro de dispositivos en memoria
+# ---------------------------------------------------
+# Con reglas SAVE consolidadas (o ingesta MQTT) EMQX ya no filtra por
+# dispositivo: la API comprueba que (username, device_id) del topic existe.
+# Los fallos se confirman contra Mongo (otro proceso pudo crear el
+# dispositivo) y se recuerdan DEVICE_REGISTRY_MISS_TTL_S segundos.
+DEVICE_REGISTRY_MISS_TTL_S = float(os.getenv("DEVICE_REGISTRY_MISS_TTL_S", 30))
+
+DeviceKey = Tuple[str, str]
+
+
+class DeviceRegistry:
+
+    def __init__(self, miss_ttl: float):
+        self.miss_ttl = miss_ttl
+        self._devices: Set[DeviceKey] = set()
+        self._misses: Dict[DeviceKey, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._devices)
+
+    def __contains__(self, key: DeviceKey) -> bool:
+        return key in self._devices
+
+    def add(self, username: str, device_id: str) -> None:
+        key = (username, device_id)
+        self._devices.add(key)
+        self._misses.pop(key, None)
+
+    def remove(self, username: str, device_id: str) -> None:
+        self._devices.discard((username, device_id))
+
+    async def load_from_mongo(self) -> None:
+        db = get_db()
+        if db is None:
+            logging.warning("[device-registry] No se pudo obtener la conexión a MongoDB")
+            return
+
+        devices = set()
+        async for d in db["dispositivos"].find({}, {"username": 1, "device_id": 1, "_id": 0}):
+            devices.add((d["username"], d["device_id"]))
+        self._devices = devices
+        self._misses.clear()
+        logging.info(f"[device-registry] {len(devices)} dispositivos cargados")
+
+    async def owns(self, username: str, device_id: str) -> bool:
+        key = (username, device_id)
+        if key in self._devices:
+            return True
+
+        now = time.monotonic()
+        expires = self._misses.get(key)
+        if expires is not None and expires > now:
+            return False
+
+        db = get_db()
+        if db is None:
+            # Sin BD no se puede confirmar: 503 para que EMQX/el cliente reintente
+            raise HTTPException(status_code=503, detail="BD no inicializada")
+        if await db["dispositivos"].find_one({"username": username, "device_id": device_id}, {"_id": 1}):
+            self.add(username, device_id)
+            return True
+        if len(self._misses) > 100000:
+            self._misses = {k: t for k, t in self._misses.items() if t > now}
+        self._misses[key] = now + self.miss_ttl
+        return False
+
+    async def split_owned(self, samples: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[int]]:
+        """
+        Separa las muestras de dispositivos registrados. Devuelve las muestras
+        válidas y los índices de las descartadas.
+        """
+        owned, rejected = [], []
+        checked: Dict[DeviceKey, bool] = {}
+        for index, sample in enumerate(samples):
+            key = (sample["username"], sample["device_id"])
+            if key not in checked:
+                checked[key] = await self.owns(*key)
+            if checked[key]:
+                owned.append(sample)
+            else:
+                rejected.append(index)
+        return owned, rejected
+
+
+device_registry = DeviceRegistry(DEVICE_REGISTRY_MISS_TTL_S)
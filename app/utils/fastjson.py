@@ -0,0 +1,26 @@
+import json
+
+# ---------------------------------------------------
+# Backend JSON: orjson si está instalado, si no el módulo estándar
+# ---------------------------------------------------
+# orjson.JSONDecodeError hereda de json.JSONDecodeError, así que los
+# llamadores pueden capturar siempre json.JSONDecodeError / ValueError.
+try:
+    import orjson
+
+    JSON_BACKEND = "orjson"
+
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumps(obj) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+except ImportError:
+    JSON_BACKEND = "json"
+
+    def loads(data):
+        return json.loads(data)
+
+    def dumps(obj) -> str:
+        return json.dumps(obj, separators=(",", ":"))
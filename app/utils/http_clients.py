@@ -0,0 +1,60 @@
+import os
+import logging
+from typing import Dict
+import httpx
+
+from app.utils.metrics import METRICS_ENABLED, InstrumentedTransport
+
+# ---------------------------------------------------
+# Clientes HTTP compartidos por backend
+# ---------------------------------------------------
+# Cada backend tiene su propio pool (límite de conexiones, keep-alive y
+# timeouts). Se puede ajustar con HTTP_<BACKEND>_MAX_CONNECTIONS,
+# HTTP_<BACKEND>_MAX_KEEPALIVE, HTTP_<BACKEND>_KEEPALIVE_S y HTTP_<BACKEND>_TIMEOUT_S.
+HTTP_BACKENDS: Dict[str, Dict[str, float]] = {
+    "emqx":    {"max_connections": 20, "max_keepalive": 10, "keepalive_s": 30, "timeout_s": 10},
+    "influx":  {"max_connections": 50, "max_keepalive": 20, "keepalive_s": 30, "timeout_s": 10},
+    "grafana": {"max_connections": 10, "max_keepalive": 5,  "keepalive_s": 30, "timeout_s": 30},
+}
+
+_clients: Dict[str, httpx.AsyncClient] = {}
+
+
+def _backend_setting(name: str, key: str) -> float:
+    default = HTTP_BACKENDS[name][key]
+    return float(os.getenv(f"HTTP_{name.upper()}_{key.upper()}", default))
+
+def _build_client(name: str) -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=int(_backend_setting(name, "max_connections")),
+        max_keepalive_connections=int(_backend_setting(name, "max_keepalive")),
+        keepalive_expiry=_backend_setting(name, "keepalive_s")
+    )
+    timeout = httpx.Timeout(_backend_setting(name, "timeout_s"))
+    transport = httpx.AsyncHTTPTransport(limits=limits)
+    if METRICS_ENABLED:
+        transport = InstrumentedTransport(name, transport)
+    return httpx.AsyncClient(transport=transport, timeout=timeout)
+
+
+async def init_http_clients() -> None:
+    for name in HTTP_BACKENDS:
+        get_http_client(name)
+    logging.info(f"[http] Clientes HTTP creados: {', '.join(_clients)}")
+
+async def close_http_clients() -> None:
+    for name, client in list(_clients.items()):
+        await client.aclose()
+    _clients.clear()
+    logging.info("[http] Clientes HTTP cerrados")
+
+def get_http_client(name: str) -> httpx.AsyncClient:
+    """
+    Devuelve el cliente compartido del backend `name` ("emqx", "influx" o
+    "grafana"). Si aún no existe (p.ej. antes del startup) se crea al vuelo.
+    """
+    client = _clients.get(name)
+    if client is None or client.is_closed:
+        client = _build_client(name)
+        _clients[name] = client
+    return client
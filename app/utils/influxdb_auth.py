@@ -1,14 +1,76 @@
 import os
 import logging
-import httpx
 from dotenv import load_dotenv, set_key
 
+from app.utils.http_clients import get_http_client
+from app.utils.rollups import ROLLUPS_ENABLED, ROLLUP_TIERS, rollup_task_flux, rollup_task_name
+
 load_dotenv(".env")
 
 INFLUX_ADMIN_TOKEN = os.getenv("INFLUX_ADMIN_TOKEN")
 INFLUX_ORG = os.getenv("INFLUX_ORG", "my-org")
 INFLUX_BUCKET = os.getenv("INFLUX_BUCKET", "measurements")
 
+
+async def asegurar_bucket(client, url: str, headers: dict, org_id: str, nombre: str, retention_s: int) -> str:
+    """
+    Devuelve el id del bucket `nombre`, creándolo si no existe y ajustando
+    su retención (segundos, 0 = infinita) si cambió.
+    """
+    reglas = [{"type": "expire", "everySeconds": retention_s}] if retention_s > 0 else []
+
+    resp = await client.get(f"{url}/api/v2/buckets?name={nombre}&orgID={org_id}", headers=headers)
+    resp.raise_for_status()
+    buckets = resp.json().get("buckets", [])
+    if not buckets:
+        resp = await client.post(f"{url}/api/v2/buckets", headers=headers, json={
+            "orgID": org_id, "name": nombre, "retentionRules": reglas
+        })
+        resp.raise_for_status()
+        logging.info(f"[InfluxDB] Bucket '{nombre}' creado (retención={retention_s}s)")
+        return resp.json()["id"]
+
+    bucket = buckets[0]
+    actual = [r.get("everySeconds", 0) for r in bucket.get("retentionRules", []) if r.get("type") == "expire"]
+    if (actual[0] if actual else 0) != retention_s:
+        resp = await client.patch(f"{url}/api/v2/buckets/{bucket['id']}", headers=headers, json={
+            "retentionRules": reglas
+        })
+        resp.raise_for_status()
+        logging.info(f"[InfluxDB] Retención del bucket '{nombre}' actualizada a {retention_s}s")
+    return bucket["id"]
+
+async def asegurar_tarea(client, url: str, headers: dict, org_id: str, nombre: str, flux: str) -> str:
+    """
+    Devuelve el id de la tarea `nombre`, creándola si no existe o
+    actualizando su Flux si cambió. Si varios procesos la crearon a la vez,
+    se conserva la más antigua y se borran las demás.
+    """
+    async def listar():
+        resp = await client.get(f"{url}/api/v2/tasks", params={"name": nombre, "orgID": org_id}, headers=headers)
+        resp.raise_for_status()
+        return sorted(resp.json().get("tasks", []), key=lambda t: (t.get("createdAt", ""), t["id"]))
+
+    tareas = await listar()
+    if not tareas:
+        resp = await client.post(f"{url}/api/v2/tasks", headers=headers, json={
+            "orgID": org_id, "flux": flux, "status": "active"
+        })
+        resp.raise_for_status()
+        logging.info(f"[InfluxDB] Tarea '{nombre}' creada")
+        tareas = await listar()
+
+    tarea, duplicadas = tareas[0], tareas[1:]
+    for extra in duplicadas:
+        resp = await client.delete(f"{url}/api/v2/tasks/{extra['id']}", headers=headers)
+        if resp.status_code not in (204, 404):
+            resp.raise_for_status()
+    if tarea.get("flux") != flux:
+        resp = await client.patch(f"{url}/api/v2/tasks/{tarea['id']}", headers=headers, json={"flux": flux})
+        resp.raise_for_status()
+        logging.info(f"[InfluxDB] Flux de la tarea '{nombre}' actualizado")
+    return tarea["id"]
+
 async def crear_token_influx(url: str = os.getenv("INFLUX_URL", "http://influxdb:8086")) -> str:
     if not INFLUX_ADMIN_TOKEN:
         raise RuntimeError("Falta INFLUX_ADMIN_TOKEN en el entorno")
@@ -18,44 +80,57 @@ async def crear_token_influx(url: str = os.getenv("INFLUX_URL", "http://influxdb
         "Content-Type": "application/json"
     }
 
-    async with httpx.AsyncClient() as client:
-        # 1. Obtener orgID
-        resp_orgs = await client.get(f"{url}/api/v2/orgs?org={INFLUX_ORG}", headers=headers)
-        resp_orgs.raise_for_status()
-        orgs = resp_orgs.json().get("orgs", [])
-        if not orgs:
-            raise RuntimeError(f"Organización '{INFLUX_ORG}' no encontrada")
-        org_id = orgs[0]["id"]
-        logging.info(f"[InfluxDB] Organización ID: {org_id}")
-
-        # 2. Obtener bucketID
-        resp_buckets = await client.get(f"{url}/api/v2/buckets?name={INFLUX_BUCKET}", headers=headers)
-        resp_buckets.raise_for_status()
-        buckets = resp_buckets.json().get("buckets", [])
-        if not buckets:
-            raise RuntimeError(f"Bucket '{INFLUX_BUCKET}' no encontrado")
-        bucket_id = buckets[0]["id"]
-        logging.info(f"[InfluxDB] Bucket ID: {bucket_id}")
-
-        # 3. Crear token con permisos read/write
-        payload = {
-            "description": f"auto-token-{INFLUX_BUCKET}",
-            "orgID": org_id,
-            "permissions": [
-                {"action": "read", "resource": {"type": "buckets", "orgID": org_id, "id": bucket_id}},
-                {"action": "write", "resource": {"type": "buckets", "orgID": org_id, "id": bucket_id}}
-            ]
-        }
-        resp_token = await client.post(f"{url}/api/v2/authorizations", headers=headers, json=payload)
-        resp_token.raise_for_status()
-        token = resp_token.json().get("token")
-        if not token:
-            raise RuntimeError("No se recibió token al crear autorización")
-        logging.info("[InfluxDB] Token generado correctamente")
-
-        # 4. Persistir en .env
-        set_key(".env", "INFLUX_AUTH_TOKEN", token)
-        os.environ["INFLUX_AUTH_TOKEN"] = token
-        logging.info("[InfluxDB] INFLUX_AUTH_TOKEN guardado en .env y env vars")
-
-        return token
+    client = get_http_client("influx")
+
+    # 1. Obtener orgID
+    resp_orgs = await client.get(f"{url}/api/v2/orgs?org={INFLUX_ORG}", headers=headers)
+    resp_orgs.raise_for_status()
+    orgs = resp_orgs.json().get("orgs", [])
+    if not orgs:
+        raise RuntimeError(f"Organización '{INFLUX_ORG}' no encontrada")
+    org_id = orgs[0]["id"]
+    logging.info(f"[InfluxDB] Organización ID: {org_id}")
+
+    # 2. Obtener bucketID
+    resp_buckets = await client.get(f"{url}/api/v2/buckets?name={INFLUX_BUCKET}", headers=headers)
+    resp_buckets.raise_for_status()
+    buckets = resp_buckets.json().get("buckets", [])
+    if not buckets:
+        raise RuntimeError(f"Bucket '{INFLUX_BUCKET}' no encontrado")
+    bucket_id = buckets[0]["id"]
+    logging.info(f"[InfluxDB] Bucket ID: {bucket_id}")
+
+    # 3. Buckets de rollups, cada uno con la retención de su nivel, y sus tareas
+    bucket_ids = [bucket_id]
+    if ROLLUPS_ENABLED:
+        for tier in ROLLUP_TIERS:
+            bucket_ids.append(await asegurar_bucket(client, url, headers, org_id, tier.bucket, tier.retention_s))
+            await asegurar_tarea(
+                client, url, headers, org_id, rollup_task_name(tier),
+                rollup_task_flux(tier, INFLUX_BUCKET, INFLUX_ORG)
+            )
+
+    # 4. Crear token con permisos read/write sobre todos ellos (y lectura de
+    #    tareas para conocer la cobertura de los rollups)
+    payload = {
+        "description": f"auto-token-{INFLUX_BUCKET}",
+        "orgID": org_id,
+        "permissions": [
+            {"action": action, "resource": {"type": "buckets", "orgID": org_id, "id": bid}}
+            for bid in bucket_ids
+            for action in ("read", "write")
+        ] + [{"action": "read", "resource": {"type": "tasks", "orgID": org_id}}]
+    }
+    resp_token = await client.post(f"{url}/api/v2/authorizations", headers=headers, json=payload)
+    resp_token.raise_for_status()
+    token = resp_token.json().get("token")
+    if not token:
+        raise RuntimeError("No se recibió token al crear autorización")
+    logging.info("[InfluxDB] Token generado correctamente")
+
+    # 5. Persistir en .env
+    set_key(".env", "INFLUX_AUTH_TOKEN", token)
+    os.environ["INFLUX_AUTH_TOKEN"] = token
+    logging.info("[InfluxDB] INFLUX_AUTH_TOKEN guardado en .env y env vars")
+
+    return token
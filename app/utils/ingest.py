@@ -0,0 +1,188 @@
+import json
+import math
+import logging
+from datetime import datetime
+from typing import Any, Dict, List
+
+from app.utils import fastjson
+from app.utils.topics import parse_sdata_topic
+from app.utils.timeseries import MEASUREMENTS_TIMESERIES
+from app.utils.mongo_buffer import BufferFullError, insert_documents
+from app.utils.alarm_engine import get_alarm_engine
+from app.utils.spool import spill
+from app.utils.latest_values import latest_values
+from app.utils.live import live_hub
+from app.utils.metrics import ALARMS, INGEST_SAMPLES, INGEST_STAGE_SECONDS, count_by_tenant
+from app.apis.influx_api import INFLUX_PERMANENT_ERRORS, build_line, get_influx_writer, post_lines_to_influx
+
+# ---------------------------------------------------
+# Pipeline de ingesta de muestras (saver)
+# ---------------------------------------------------
+
+def parse_saver_record(body: Any) -> Dict[str, Any]:
+    """
+    Valida un registro {topic, payload} del saver y devuelve la muestra
+    {username, device_id, variable_id, value, topic, timestamp, payload}.
+    Lanza ValueError con el motivo si el registro no es válido.
+    """
+    if not isinstance(body, dict):
+        raise ValueError("Registro inválido")
+
+    topic = body.get("topic")
+    payload = body.get("payload")
+    if not topic or not payload:
+        raise ValueError("Falta topic o payload")
+
+    # EMQX puede entregar el payload como string JSON o ya decodificado
+    if isinstance(payload, (str, bytes)):
+        try:
+            payload = fastjson.loads(payload)
+        except json.JSONDecodeError:
+            raise ValueError("Payload inválido")
+    if not isinstance(payload, dict):
+        raise ValueError("Payload inválido")
+
+    value = payload.get("value")
+    if value is None:
+        raise ValueError("Falta value")
+    # Solo números: en Influx el campo `value` es float y un string (o un
+    # bool) en la misma serie haría rechazar el lote por conflicto de tipo
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        raise ValueError("value debe ser numérico")
+    # NaN/Infinity (o enteros fuera del rango de float) dejarían para
+    # siempre en NaN/inf las sumas de las ventanas de alarma
+    try:
+        finito = math.isfinite(value)
+    except OverflowError:
+        finito = False
+    if not finito:
+        raise ValueError("value debe ser un número finito")
+
+    username, device_id, variable_id = parse_sdata_topic(topic)
+
+    # Marca de tiempo opcional del registro (epoch en ms), útil para lotes de gateways
+    ts = body.get("timestamp")
+    if ts is None:
+        timestamp = datetime.utcnow()
+    elif isinstance(ts, (int, float)) and not isinstance(ts, bool):
+        # Fuera de rango (o NaN) lanza OverflowError/OSError según la plataforma
+        try:
+            timestamp = datetime.utcfromtimestamp(ts / 1000)
+        except (ValueError, OverflowError, OSError):
+            raise ValueError("Timestamp fuera de rango (se esperan ms desde epoch)")
+    else:
+        raise ValueError("Timestamp inválido (se esperan ms desde epoch)")
+
+    return {
+        "username": username,
+        "device_id": device_id,
+        "variable_id": variable_id,
+        "value": value,
+        "topic": topic,
+        "timestamp": timestamp,
+        "payload": payload
+    }
+
+
+def decode_saver_body(raw: bytes) -> Dict[str, Any]:
+    """
+    Camino rápido del saver: decodifica el cuerpo HTTP en una sola pasada
+    (orjson si está disponible) y valida el registro.
+    """
+    try:
+        body = fastjson.loads(raw)
+    except json.JSONDecodeError:
+        raise ValueError("Cuerpo JSON inválido")
+    return parse_saver_record(body)
+
+
+def build_measurement_doc(sample: Dict[str, Any]) -> Dict[str, Any]:
+    # Formato time-series: la serie va en metaField y el topic se deduce de ella
+    if MEASUREMENTS_TIMESERIES:
+        return {
+            "timestamp": sample["timestamp"],
+            "meta": {
+                "username": sample["username"],
+                "device_id": sample["device_id"],
+                "variable_id": sample["variable_id"]
+            },
+            "value": sample["value"]
+        }
+    return {
+        "username": sample["username"],
+        "device_id": sample["device_id"],
+        "variable_id": sample["variable_id"],
+        "value": sample["value"],
+        "topic": sample["topic"],
+        "timestamp": sample["timestamp"]
+    }
+
+def build_influx_line(sample: Dict[str, Any]) -> str:
+    return build_line(
+        "iot_data",
+        {
+            "username": sample["username"],
+            "device_id": sample["device_id"],
+            "variable_id": sample["variable_id"]
+        },
+        {"value": sample["value"]},
+        sample["timestamp"]
+    )
+
+
+async def persist_samples(samples: List[Dict[str, Any]]) -> None:
+    """
+    Guarda un lote de muestras: un único insert en MongoDB (o write-behind)
+    y una única escritura multilínea en Influx (vía writer por lotes si está
+    activo). Si un backend falla, el lote se guarda en el spool local para
+    reenviarlo; sin spool, los errores de MongoDB y BufferFullError se
+    propagan y los de Influx solo se registran.
+    """
+    if not samples:
+        return
+
+    docs = [build_measurement_doc(s) for s in samples]
+    with INGEST_STAGE_SECONDS.time("mongo"):
+        try:
+            await insert_documents("measurements", docs)
+        except BufferFullError:
+            raise
+        except Exception as e:
+            if not await spill("mongo:measurements", docs):
+                raise
+            logging.warning("MongoDB no disponible (%r): %d muestras guardadas en el spool", e, len(docs))
+    count_by_tenant(INGEST_SAMPLES, samples)
+
+    latest_values.update_many(samples)
+    live_hub.publish(samples)
+
+    lines = [build_influx_line(s) for s in samples]
+    with INGEST_STAGE_SECONDS.time("influx"):
+        try:
+            writer = get_influx_writer()
+            if writer is not None:
+                await writer.write_many(lines)
+            else:
+                resp = await post_lines_to_influx(lines)
+                if resp.status_code in INFLUX_PERMANENT_ERRORS:
+                    logging.error("InfluxDB rechazó %d líneas (%s %s)", len(lines), resp.status_code, resp.text)
+                elif resp.status_code != 204:
+                    await spill("influx:", lines)
+        except Exception as e:
+            if not await spill("influx:", lines):
+                logging.error("Error escribiendo en InfluxDB: %r", e)
+
+    # Alarmas evaluadas en proceso (ALARM_ENGINE=local)
+    engine = get_alarm_engine()
+    if engine is not None:
+        with INGEST_STAGE_SECONDS.time("alarms"):
+            alarm_docs = engine.evaluate_many(samples)
+        count_by_tenant(ALARMS, alarm_docs)
+        if alarm_docs:
+            try:
+                await insert_documents("alarms", alarm_docs)
+            except BufferFullError:
+                logging.error("Buffer de alarms lleno: %d alarmas descartadas", len(alarm_docs))
+            except Exception as e:
+                if not await spill("mongo:alarms", alarm_docs):
+                    logging.error("Error guardando alarmas: %r", e)
@@ -0,0 +1,111 @@
+import os
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+from app.utils.db import get_db
+
+# ---------------------------------------------------
+# Invalidación entre procesos de las cachés en memoria
+# ---------------------------------------------------
+# Cada caché que se modifica desde una ruta (reglas de alarma, registro de
+# dispositivos...) tiene un contador en `cache_versions`. Quien la modifica
+# aplica el cambio en su proceso e incrementa el contador; el resto de
+# procesos consulta los contadores cada CACHE_VERSION_POLL_S y recarga las
+# cachés cuyo contador cambió. Se usa sondeo porque los change streams
+# requieren replica set y el compose arranca Mongo standalone.
+CACHE_VERSION_POLL_S = float(os.getenv("CACHE_VERSION_POLL_S", 2))
+VERSIONS_COLLECTION = "cache_versions"
+
+CACHE_ALARM_RULES = "alarm_rules"
+CACHE_DEVICES = "devices"
+
+Reloader = Callable[[], Awaitable[None]]
+
+
+class CacheVersions:
+
+    def __init__(self):
+        self._reloaders: Dict[str, Reloader] = {}
+        self._known: Dict[str, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.reloads = 0
+        self.reload_errors = 0
+
+    async def _read(self) -> Dict[str, int]:
+        db = get_db()
+        if db is None:
+            return {}
+        versiones = {}
+        async for doc in db[VERSIONS_COLLECTION].find({"_id": {"$in": list(self._reloaders)}}):
+            versiones[doc["_id"]] = doc.get("version", 0)
+        return versiones
+
+    async def start(self, reloaders: Dict[str, Reloader], initial: Optional[Dict[str, Reloader]] = None) -> None:
+        """
+        Hace la carga inicial de cada caché (`initial`, o su recarga si no
+        tiene una propia) y empieza a vigilar sus versiones. Las versiones se
+        leen antes de cargar: un cambio hecho durante la carga se recarga.
+        """
+        self._reloaders = dict(reloaders)
+        self._known = await self._read()
+        for name, reloader in self._reloaders.items():
+            await (initial or {}).get(name, reloader)()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(CACHE_VERSION_POLL_S)
+            try:
+                await self.check()
+            except Exception as e:
+                logging.warning(f"[cache-versions] Error comprobando versiones: {e!r}")
+
+    async def check(self) -> None:
+        for name, version in (await self._read()).items():
+            if self._known.get(name, 0) == version:
+                continue
+            try:
+                await self._reloaders[name]()
+            except Exception as e:
+                # Sin apuntar la versión: se reintenta en la siguiente consulta
+                self.reload_errors += 1
+                logging.warning(f"[cache-versions] Error recargando '{name}': {e!r}")
+                continue
+            # La versión leída antes de recargar: un cambio durante la recarga provoca otra
+            self._known[name] = version
+            self.reloads += 1
+
+    async def bump(self, name: str) -> None:
+        """Señala a los demás procesos que la caché `name` cambió (este ya la aplicó)."""
+        db = get_db()
+        if db is None:
+            return
+        try:
+            doc = await db[VERSIONS_COLLECTION].find_one_and_update(
+                {"_id": name}, {"$inc": {"version": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+            )
+        except PyMongoError as e:
+            logging.error(f"[cache-versions] No se pudo señalar el cambio de '{name}': {e!r}")
+            return
+        # Solo si nadie más la cambió entretanto; si no, la recarga lo resuelve
+        if doc["version"] == self._known.get(name, 0) + 1:
+            self._known[name] = doc["version"]
+
+
+cache_versions = CacheVersions()
+
+async def start_cache_versions(reloaders: Dict[str, Reloader], initial: Optional[Dict[str, Reloader]] = None) -> None:
+    await cache_versions.start(reloaders, initial)
+
+async def stop_cache_versions() -> None:
+    await cache_versions.stop()
@@ -0,0 +1,174 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+from app.utils.db import get_db
+
+# ---------------------------------------------------
+# Último valor por variable
+# ---------------------------------------------------
+# Se actualiza en el pipeline del saver: {(username, device_id):
+# {variable_id: (epoch_s, value)}}. Los dispositivos modificados se
+# vuelcan cada LATEST_SNAPSHOT_INTERVAL_S a `latest_values` (un documento
+# por dispositivo) para recargar la caché al arrancar.
+# La caché es de cada proceso: con varios procesos de ingesta cada uno solo
+# ve las muestras que recibió él, hasta que se recarga desde la snapshot.
+# Por eso la snapshot fusiona por variable y gana la marca de tiempo más
+# reciente, sin importar qué proceso escriba último.
+LATEST_SNAPSHOT_ENABLED = os.getenv("LATEST_SNAPSHOT_ENABLED", "true").lower() in ("1", "true", "yes")
+LATEST_SNAPSHOT_INTERVAL_S = float(os.getenv("LATEST_SNAPSHOT_INTERVAL_S", 10))
+LATEST_COLLECTION = "latest_values"
+
+DeviceKey = Tuple[str, str]
+
+
+def _merge_values(nuevos: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Expresión de agregación que fusiona `nuevos` ([{id, t, v}]) con
+    `values` del documento: por variable se queda la entrada con mayor `t`.
+    """
+    # $literal: ids o valores que empiecen por "$" no son rutas de campo
+    nuevos = {"$literal": nuevos}
+    return {"$let": {
+        "vars": {"actuales": {"$ifNull": ["$values", []]}},
+        "in": {"$concatArrays": [
+            # Entradas guardadas que ninguna nueva supera
+            {"$filter": {"input": "$$actuales", "as": "a", "cond": {"$not": [{"$anyElementTrue": [
+                {"$map": {"input": nuevos, "as": "n", "in": {"$and": [
+                    {"$eq": ["$$a.id", "$$n.id"]}, {"$lte": ["$$a.t", "$$n.t"]}
+                ]}}}
+            ]}]}}},
+            # Entradas nuevas que ninguna guardada supera
+            {"$filter": {"input": nuevos, "as": "n", "cond": {"$not": [{"$anyElementTrue": [
+                {"$map": {"input": "$$actuales", "as": "a", "in": {"$and": [
+                    {"$eq": ["$$a.id", "$$n.id"]}, {"$gt": ["$$a.t", "$$n.t"]}
+                ]}}}
+            ]}]}}}
+        ]}
+    }}
+
+
+def _epoch(ts: datetime) -> float:
+    # Las marcas de tiempo del pipeline son UTC sin zona
+    return ts.replace(tzinfo=timezone.utc).timestamp() if ts.tzinfo is None else ts.timestamp()
+
+
+class LatestValues:
+
+    def __init__(self):
+        self._devices: Dict[DeviceKey, Dict[str, Tuple[float, Any]]] = {}
+        self._dirty: Set[DeviceKey] = set()
+
+    def __len__(self) -> int:
+        return len(self._devices)
+
+    def update_many(self, samples: List[Dict[str, Any]]) -> None:
+        for sample in samples:
+            key = (sample["username"], sample["device_id"])
+            ts = _epoch(sample["timestamp"])
+            variables = self._devices.get(key)
+            if variables is None:
+                variables = self._devices[key] = {}
+            actual = variables.get(sample["variable_id"])
+            # Muestras de gateways pueden llegar desordenadas: gana la más reciente
+            if actual is None or ts >= actual[0]:
+                variables[sample["variable_id"]] = (ts, sample["value"])
+                self._dirty.add(key)
+
+    def get_device(self, username: str, device_id: str) -> Dict[str, Dict[str, Any]]:
+        variables = self._devices.get((username, device_id), {})
+        return {
+            variable_id: {
+                "value": value,
+                "timestamp": datetime.fromtimestamp(ts, timezone.utc).isoformat().replace("+00:00", "Z")
+            }
+            for variable_id, (ts, value) in variables.items()
+        }
+
+    def remove_device(self, username: str, device_id: str) -> None:
+        self._devices.pop((username, device_id), None)
+        self._dirty.discard((username, device_id))
+
+    def retain_devices(self, devices) -> None:
+        """Descarta los dispositivos que ya no están en `devices` (borrados en otro proceso)."""
+        for key in [key for key in self._devices if key not in devices]:
+            self.remove_device(*key)
+
+    async def load_from_mongo(self) -> None:
+        db = get_db()
+        if db is None:
+            logging.warning("[latest] No se pudo obtener la conexión a MongoDB")
+            return
+
+        devices = {}
+        async for doc in db[LATEST_COLLECTION].find({}, {"_id": 0}):
+            devices[(doc["username"], doc["device_id"])] = {
+                v["id"]: (v["t"], v["v"]) for v in doc.get("values", [])
+            }
+        # Lo recibido antes de cargar es más reciente que la snapshot
+        for key, variables in self._devices.items():
+            devices.setdefault(key, {}).update(variables)
+        self._devices = devices
+        logging.info(f"[latest] Últimos valores de {len(devices)} dispositivos cargados")
+
+    async def snapshot(self) -> int:
+        """Guarda en Mongo los dispositivos modificados desde la última snapshot."""
+        if not self._dirty:
+            return 0
+        db = get_db()
+        if db is None:
+            return 0
+
+        dirty, self._dirty = self._dirty, set()
+        ops = []
+        for username, device_id in dirty:
+            variables = self._devices.get((username, device_id))
+            if variables is None:
+                continue
+            # Pipeline de actualización: otro proceso pudo guardar valores más recientes
+            ops.append(UpdateOne(
+                {"username": username, "device_id": device_id},
+                [{"$set": {"values": _merge_values([
+                    {"id": variable_id, "t": ts, "v": value} for variable_id, (ts, value) in variables.items()
+                ])}}],
+                upsert=True
+            ))
+        if not ops:
+            return 0
+        try:
+            await db[LATEST_COLLECTION].bulk_write(ops, ordered=False)
+        except PyMongoError as e:
+            # Se reintentan en la siguiente snapshot
+            self._dirty |= dirty
+            logging.error(f"[latest] Error guardando la snapshot: {e!r}")
+            return 0
+        return len(ops)
+
+
+latest_values = LatestValues()
+
+
+_snapshot_task: Optional[asyncio.Task] = None
+
+async def _snapshot_loop() -> None:
+    while True:
+        await asyncio.sleep(LATEST_SNAPSHOT_INTERVAL_S)
+        await latest_values.snapshot()
+
+def start_latest_snapshots() -> None:
+    global _snapshot_task
+    if LATEST_SNAPSHOT_ENABLED and _snapshot_task is None:
+        _snapshot_task = asyncio.create_task(_snapshot_loop())
+
+async def stop_latest_snapshots() -> None:
+    global _snapshot_task
+    if _snapshot_task is not None:
+        _snapshot_task.cancel()
+        await asyncio.gather(_snapshot_task, return_exceptions=True)
+        _snapshot_task = None
+        await latest_values.snapshot()
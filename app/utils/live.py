@@ -0,0 +1,197 @@
+import os
+import asyncio
+from datetime import timezone
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+# ---------------------------------------------------
+# Difusión en vivo de muestras (WebSocket / SSE)
+# ---------------------------------------------------
+# Cada conexión se suscribe a patrones "device_id/variable_id" del usuario
+# autenticado ("+" = cualquier valor en ese nivel, "#" = todo lo que siga).
+# Los patrones se indexan en un trie por niveles username/device/variable:
+# publicar una muestra recorre solo las ramas que pueden coincidir.
+# Cada conexión tiene una cola acotada: si el cliente no consume, se
+# descartan los eventos más antiguos en lugar de frenar la ingesta.
+LIVE_QUEUE_MAX = int(os.getenv("LIVE_QUEUE_MAX", 1000))
+LIVE_MAX_PATTERNS = int(os.getenv("LIVE_MAX_PATTERNS", 100))
+LIVE_MAX_CONNECTIONS = int(os.getenv("LIVE_MAX_CONNECTIONS", 1000))
+
+
+def parse_pattern(pattern: str) -> Tuple[str, ...]:
+    """
+    Valida un patrón "device_id/variable_id" y devuelve sus niveles.
+    Lanza ValueError con el motivo si no es válido.
+    """
+    niveles = tuple(pattern.strip().split("/"))
+    if not niveles or len(niveles) > 2 or any(n == "" for n in niveles):
+        raise ValueError(f"Patrón inválido '{pattern}': se espera device_id/variable_id")
+    for i, nivel in enumerate(niveles):
+        if "#" in nivel and (nivel != "#" or i != len(niveles) - 1):
+            raise ValueError(f"Patrón inválido '{pattern}': '#' solo como último nivel")
+        if "+" in nivel and nivel != "+":
+            raise ValueError(f"Patrón inválido '{pattern}': '+' debe ocupar un nivel completo")
+    return niveles
+
+
+class _Node:
+    __slots__ = ("children", "subscribers")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        self.subscribers: Set["LiveSubscription"] = set()
+
+
+class TopicTrie:
+
+    def __init__(self):
+        self._root = _Node()
+
+    def add(self, levels: Tuple[str, ...], sub: "LiveSubscription") -> None:
+        node = self._root
+        for level in levels:
+            node = node.children.setdefault(level, _Node())
+        node.subscribers.add(sub)
+
+    def remove(self, levels: Tuple[str, ...], sub: "LiveSubscription") -> None:
+        # Se poda la rama si queda vacía
+        path = [self._root]
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].subscribers.discard(sub)
+        for i in range(len(levels), 0, -1):
+            if path[i].subscribers or path[i].children:
+                break
+            del path[i - 1].children[levels[i - 1]]
+
+    def match(self, levels: Tuple[str, ...]) -> Set["LiveSubscription"]:
+        found: Set[LiveSubscription] = set()
+        nodes = [self._root]
+        for level in levels:
+            siguientes = []
+            for node in nodes:
+                todo = node.children.get("#")
+                if todo is not None:
+                    found |= todo.subscribers
+                for key in (level, "+"):
+                    child = node.children.get(key)
+                    if child is not None:
+                        siguientes.append(child)
+            nodes = siguientes
+            if not nodes:
+                return found
+        for node in nodes:
+            found |= node.subscribers
+            todo = node.children.get("#")
+            if todo is not None:
+                found |= todo.subscribers
+        return found
+
+
+class LiveSubscription:
+    """Cola acotada de eventos de una conexión; descarta los más antiguos si se llena."""
+
+    def __init__(self, username: str, maxsize: int = LIVE_QUEUE_MAX):
+        self.username = username
+        self.patterns: Set[Tuple[str, ...]] = set()
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def offer(self, event: Dict[str, Any]) -> None:
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self._queue.get_nowait()
+            self._queue.put_nowait(event)
+            self.dropped += 1
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Siguiente evento, o None si pasa `timeout` sin eventos."""
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def drain(self) -> List[Dict[str, Any]]:
+        eventos = []
+        while not self._queue.empty():
+            eventos.append(self._queue.get_nowait())
+        return eventos
+
+
+class LiveHub:
+
+    def __init__(self):
+        self._trie = TopicTrie()
+        self._subs: Set[LiveSubscription] = set()
+        self.published = 0
+        self.delivered = 0
+
+    def __len__(self) -> int:
+        return len(self._subs)
+
+    def connect(self, username: str) -> LiveSubscription:
+        if len(self._subs) >= LIVE_MAX_CONNECTIONS:
+            raise RuntimeError("Demasiadas conexiones en vivo")
+        sub = LiveSubscription(username)
+        self._subs.add(sub)
+        return sub
+
+    def disconnect(self, sub: LiveSubscription) -> None:
+        for levels in list(sub.patterns):
+            self._trie.remove((sub.username,) + levels, sub)
+        sub.patterns.clear()
+        self._subs.discard(sub)
+
+    def subscribe(self, sub: LiveSubscription, patterns: Iterable[str]) -> List[str]:
+        """Añade patrones (validados antes de aplicar ninguno); devuelve los activos."""
+        nuevos = [parse_pattern(p) for p in patterns]
+        if len(sub.patterns | set(nuevos)) > LIVE_MAX_PATTERNS:
+            raise ValueError(f"Máximo {LIVE_MAX_PATTERNS} patrones por conexión")
+        for levels in nuevos:
+            if levels not in sub.patterns:
+                sub.patterns.add(levels)
+                self._trie.add((sub.username,) + levels, sub)
+        return sorted("/".join(p) for p in sub.patterns)
+
+    def unsubscribe(self, sub: LiveSubscription, patterns: Iterable[str]) -> List[str]:
+        for pattern in patterns:
+            levels = parse_pattern(pattern)
+            if levels in sub.patterns:
+                sub.patterns.discard(levels)
+                self._trie.remove((sub.username,) + levels, sub)
+        return sorted("/".join(p) for p in sub.patterns)
+
+    def publish(self, samples: List[Dict[str, Any]]) -> None:
+        if not self._subs:
+            return
+        for sample in samples:
+            subs = self._trie.match((sample["username"], sample["device_id"], sample["variable_id"]))
+            if not subs:
+                continue
+            ts = sample["timestamp"]
+            if ts.tzinfo is None:
+                ts = ts.replace(tzinfo=timezone.utc)
+            event = {
+                "device_id": sample["device_id"],
+                "variable_id": sample["variable_id"],
+                "value": sample["value"],
+                "timestamp": ts.isoformat().replace("+00:00", "Z")
+            }
+            for sub in subs:
+                sub.offer(event)
+            self.published += 1
+            self.delivered += len(subs)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "connections": len(self._subs),
+            "published": self.published,
+            "delivered": self.delivered,
+            "dropped": sum(s.dropped for s in self._subs),
+        }
+
+
+live_hub = LiveHub()
@@ -0,0 +1,231 @@
+import os
+import math
+import time
+import functools
+from bisect import bisect_left
+from typing import Any, Dict, List, Tuple, Union
+
+import httpx
+
+# ---------------------------------------------------
+# Métricas en formato Prometheus (sin dependencias)
+# ---------------------------------------------------
+# Contadores e histogramas preagregados: observar un valor es una búsqueda
+# en un dict y unas sumas, sin crear objetos. Las series se identifican
+# por el valor de su etiqueta (o una tupla si hay varias). Las
+# profundidades de cola se leen al hacer scrape (render_gauges).
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+# Etiqueta `username` en los contadores por tenant (desactivar con muchos usuarios)
+METRICS_TENANT_LABELS = os.getenv("METRICS_TENANT_LABELS", "true").lower() in ("1", "true", "yes")
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Union[str, Tuple[str, ...]]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    if not names and not extra:
+        return ""
+    if isinstance(values, str):
+        values = (values,)
+    pares = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pares.append(extra)
+    return "{" + ",".join(pares) + "}"
+
+
+def _fmt(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, labels: LabelValues = "", amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_labels(self.label_names, labels)} {_fmt(value)}")
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.buckets = buckets
+        # Por serie: [cuentas por bucket (no acumuladas)..., +Inf, suma]
+        self._series: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, labels: LabelValues = "") -> None:
+        serie = self._series.get(labels)
+        if serie is None:
+            serie = self._series[labels] = [0] * (len(self.buckets) + 2)
+        serie[bisect_left(self.buckets, value)] += 1
+        serie[-1] += value
+
+    def time(self, labels: LabelValues = "") -> "_Timer":
+        return _Timer(self, labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, serie in self._series.items():
+            acumulado = 0
+            for limite, cuenta in zip((*self.buckets, math.inf), serie[:-1]):
+                acumulado += cuenta
+                le = 'le="' + _fmt(limite) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, labels, le)} {acumulado}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {_fmt(serie[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {acumulado}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: Histogram, labels: LabelValues):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, self.labels)
+        return False
+
+
+def timed(histogram: Histogram, labels: LabelValues):
+    """Decorador para rutas async: observa la duración de cada llamada."""
+    def decorador(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with histogram.time(labels):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorador
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics: List[Union[Counter, Histogram]] = []
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# --- Ingesta ---
+INGEST_STAGE_SECONDS = registry.histogram(
+    "iot_ingest_stage_seconds", "Duración de cada etapa del pipeline del saver", ("stage",)
+)
+WEBHOOK_SECONDS = registry.histogram(
+    "iot_webhook_seconds", "Duración total de los webhooks de EMQX", ("endpoint",)
+)
+INGEST_SAMPLES = registry.counter(
+    "iot_ingest_samples_total", "Muestras persistidas por tenant", ("username",)
+)
+ALARMS = registry.counter(
+    "iot_alarms_total", "Alarmas registradas por tenant", ("username",)
+)
+
+# --- Backends HTTP ---
+BACKEND_SECONDS = registry.histogram(
+    "iot_backend_request_seconds", "Latencia de las llamadas HTTP a EMQX, Influx y Grafana", ("backend",)
+)
+BACKEND_ERRORS = registry.counter(
+    "iot_backend_errors_total", "Errores de las llamadas HTTP por backend y tipo", ("backend", "kind")
+)
+
+
+def count_by_tenant(counter: Counter, docs: List[dict]) -> None:
+    """Suma al contador las muestras/alarmas de un lote agrupando tramos del mismo usuario."""
+    if not METRICS_ENABLED or not docs:
+        return
+    if not METRICS_TENANT_LABELS:
+        counter.inc("*", len(docs))
+        return
+    actual, n = docs[0]["username"], 0
+    for doc in docs:
+        if doc["username"] != actual:
+            counter.inc(actual, n)
+            actual, n = doc["username"], 0
+        n += 1
+    counter.inc(actual, n)
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """Transporte httpx que mide la latencia y cuenta los errores de un backend."""
+
+    def __init__(self, backend: str, transport: httpx.AsyncBaseTransport):
+        self.backend = backend
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        start = time.perf_counter()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except httpx.TimeoutException:
+            BACKEND_ERRORS.inc((self.backend, "timeout"))
+            raise
+        except httpx.TransportError:
+            BACKEND_ERRORS.inc((self.backend, "connect"))
+            raise
+        finally:
+            BACKEND_SECONDS.observe(time.perf_counter() - start, self.backend)
+        if response.status_code >= 500:
+            BACKEND_ERRORS.inc((self.backend, "5xx"))
+        elif response.status_code >= 400:
+            BACKEND_ERRORS.inc((self.backend, "4xx"))
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+def render_gauges(prefix: str, label: str, series: Dict[str, Dict[str, Any]]) -> str:
+    """
+    Gauges leídos en el momento del scrape: un nombre `<prefix>_<campo>` por
+    cada campo numérico de las estadísticas de cada serie (p.ej. buffers).
+    """
+    por_campo: Dict[str, List[str]] = {}
+    for serie, stats in series.items():
+        for campo, valor in stats.items():
+            if isinstance(valor, bool) or not isinstance(valor, (int, float)):
+                continue
+            por_campo.setdefault(campo, []).append(f"{prefix}_{campo}{_labels((label,), serie)} {_fmt(valor)}")
+    lines: List[str] = []
+    for campo, valores in por_campo.items():
+        lines += [f"# TYPE {prefix}_{campo} gauge", *valores]
+    return "\n".join(lines) + "\n" if lines else ""
@@ -0,0 +1,95 @@
+import os
+import logging
+from typing import Any, Dict, List, Optional
+from pymongo.errors import BulkWriteError
+
+from app.utils.db import get_db
+from app.utils.batching import BatchFlusher, BufferFullError
+
+# ---------------------------------------------------
+# Write-behind para colecciones de alta frecuencia
+# ---------------------------------------------------
+MONGO_BUFFER_ENABLED = os.getenv("MONGO_BUFFER_ENABLED", "true").lower() in ("1", "true", "yes")
+MONGO_BUFFER_BATCH_SIZE = int(os.getenv("MONGO_BUFFER_BATCH_SIZE", 1000))
+MONGO_BUFFER_FLUSH_INTERVAL_MS = int(os.getenv("MONGO_BUFFER_FLUSH_INTERVAL_MS", 200))
+MONGO_BUFFER_MAX_QUEUE = int(os.getenv("MONGO_BUFFER_MAX_QUEUE", 50000))
+
+BUFFERED_COLLECTIONS = ("measurements", "alarms")
+
+
+class MongoWriteBuffer(BatchFlusher):
+    """
+    Agrupa documentos de una colección en insert_many no ordenados.
+    Los productores usan `put_nowait`/`put_many_nowait`: si la cola está
+    llena se lanza BufferFullError (los webhooks responden 503).
+    """
+
+    def __init__(
+        self,
+        collection: str,
+        batch_size: int = MONGO_BUFFER_BATCH_SIZE,
+        flush_interval: float = MONGO_BUFFER_FLUSH_INTERVAL_MS / 1000,
+        max_queue: int = MONGO_BUFFER_MAX_QUEUE
+    ):
+        super().__init__(batch_size, flush_interval, max_queue)
+        self.collection = collection
+        self.name = f"mongo:{collection}"
+        self.spool_target = f"mongo:{collection}"
+
+    async def _flush(self, docs: List[Dict[str, Any]]) -> None:
+        db = get_db()
+        if db is None:
+            raise RuntimeError("BD no inicializada")
+        try:
+            await db[self.collection].insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # Con ordered=False el resto del lote sí se insertó
+            errores = e.details.get("writeErrors", [])
+            logging.error(f"[{self.name}] {len(errores)} documentos rechazados de {len(docs)}")
+
+
+mongo_buffers: Dict[str, MongoWriteBuffer] = {}
+
+async def start_mongo_buffers() -> None:
+    if not MONGO_BUFFER_ENABLED:
+        logging.info("[mongo-buffer] Write-behind desactivado (MONGO_BUFFER_ENABLED=false)")
+        return
+    for collection in BUFFERED_COLLECTIONS:
+        if collection not in mongo_buffers:
+            buffer = MongoWriteBuffer(collection)
+            await buffer.start()
+            mongo_buffers[collection] = buffer
+    logging.info(
+        f"[mongo-buffer] Write-behind iniciado para {', '.join(mongo_buffers)} "
+        f"(batch={MONGO_BUFFER_BATCH_SIZE}, max_cola={MONGO_BUFFER_MAX_QUEUE})"
+    )
+
+async def stop_mongo_buffers() -> None:
+    for buffer in mongo_buffers.values():
+        await buffer.stop()
+    mongo_buffers.clear()
+
+def get_mongo_buffer(collection: str) -> Optional[MongoWriteBuffer]:
+    return mongo_buffers.get(collection)
+
+
+async def insert_documents(collection: str, docs: List[Dict[str, Any]]) -> None:
+    """
+    Inserta vía write-behind si está activo para la colección; si no,
+    directamente en MongoDB. Lanza BufferFullError si el buffer está lleno.
+    """
+    if not docs:
+        return
+    buffer = get_mongo_buffer(collection)
+    if buffer is not None:
+        buffer.put_many_nowait(docs)
+        return
+
+    db = get_db()
+    if db is None:
+        raise RuntimeError("BD no inicializada")
+    if len(docs) == 1:
+        await db[collection].insert_one(docs[0])
+    else:
+        await db[collection].insert_many(docs, ordered=False)
+
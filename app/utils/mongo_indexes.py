@@ -0,0 +1,185 @@
+import asyncio
+import json
+import logging
+from typing import Any, Dict, List, Set
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from app.utils.timeseries import MEASUREMENTS_TIMESERIES
+
+# ---------------------------------------------------
+# Índices gestionados de MongoDB
+# ---------------------------------------------------
+# Registro declarativo: se aplica al conectar (create_indexes es idempotente)
+# y las unicidades reflejan las comprobaciones que ya hacen las rutas.
+# mqtt_user / mqtt_acl los consulta el plugin emqx_auth_mongo en cada
+# conexión y publicación.
+INDEXES: Dict[str, List[IndexModel]] = {
+    "usuarios": [
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    ],
+    "dispositivos": [
+        IndexModel([("username", ASCENDING), ("device_id", ASCENDING)],
+                   name="username_device_unique", unique=True),
+        IndexModel([("username", ASCENDING), ("_id", ASCENDING)], name="username_id"),
+    ],
+    "variables": [
+        IndexModel([("username", ASCENDING), ("device_id", ASCENDING), ("variable_name", ASCENDING)],
+                   name="username_device_variable_unique", unique=True),
+        IndexModel([("username", ASCENDING), ("_id", ASCENDING)], name="username_id"),
+    ],
+    "alarmas": [
+        IndexModel([("username", ASCENDING), ("device_id", ASCENDING), ("variable_id", ASCENDING)],
+                   name="username_device_variable"),
+    ],
+    "emqx_save_rules": [
+        # Un documento por ámbito (device_id/username ausentes en tenant/global)
+        IndexModel([("username", ASCENDING), ("device_id", ASCENDING)],
+                   name="username_device_unique", unique=True),
+    ],
+    "latest_values": [
+        IndexModel([("username", ASCENDING), ("device_id", ASCENDING)], name="username_device_unique", unique=True),
+    ],
+    "mqtt_user": [
+        IndexModel([("username", ASCENDING)], name="username"),
+    ],
+    "mqtt_acl": [
+        IndexModel([("username", ASCENDING)], name="username"),
+    ],
+    "measurements": [
+        IndexModel([("meta.username", ASCENDING), ("meta.device_id", ASCENDING), ("meta.variable_id", ASCENDING),
+                    ("timestamp", DESCENDING)], name="series_timestamp")
+        if MEASUREMENTS_TIMESERIES else
+        IndexModel([("username", ASCENDING), ("device_id", ASCENDING), ("variable_id", ASCENDING),
+                    ("timestamp", DESCENDING)], name="series_timestamp"),
+    ],
+    "alarms": [
+        IndexModel([("username", ASCENDING), ("device_id", ASCENDING), ("variable_id", ASCENDING),
+                    ("timestamp", DESCENDING)], name="series_timestamp"),
+        IndexModel([("rule_id", ASCENDING), ("timestamp", DESCENDING)], name="rule_timestamp"),
+    ],
+    "live_tickets": [
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+}
+
+# Índices sustituidos por otros del registro con la misma clave: se borran
+# antes de crear los nuevos (Mongo no admite dos con la misma clave)
+OBSOLETE_INDEXES: Dict[str, List[str]] = {
+    "emqx_save_rules": ["username_device"],
+}
+
+
+async def ensure_indexes(db) -> Dict[str, List[str]]:
+    """
+    Crea los índices del registro que falten. Un fallo (p.ej. duplicados
+    previos que impiden un índice único) se registra y no detiene el arranque.
+    """
+    creados: Dict[str, List[str]] = {}
+    for coll, models in INDEXES.items():
+        try:
+            existentes = await db[coll].index_information()
+            for name in OBSOLETE_INDEXES.get(coll, []):
+                if name in existentes:
+                    await db[coll].drop_index(name)
+                    logging.info(f"[mongo-indexes] Índice obsoleto {coll}.{name} eliminado")
+            creados[coll] = await db[coll].create_indexes(models)
+        except OperationFailure as e:
+            logging.error(f"[mongo-indexes] No se pudieron crear los índices de {coll}: {e}")
+    logging.info(f"[mongo-indexes] Índices verificados en {len(creados)}/{len(INDEXES)} colecciones")
+    return creados
+
+
+# ---------------------------------------------------
+# Auditoría de planes de consulta
+# ---------------------------------------------------
+# Formas de las consultas calientes de la API y del plugin de auth de EMQX.
+# Los valores son de ejemplo: solo importa qué campos se filtran y ordenan.
+# Se audita solo desde la CLI (python -m app.utils.mongo_indexes): ejecuta
+# explain en todas las colecciones calientes y expone su esquema de índices.
+QUERY_SHAPES: List[Dict[str, Any]] = [
+    {"name": "login / usuario actual", "collection": "usuarios", "filter": {"username": "u"}},
+    {"name": "alta de usuario (email)", "collection": "usuarios", "filter": {"email": "u@example.com"}},
+    {"name": "dispositivo del usuario", "collection": "dispositivos",
+     "filter": {"username": "u", "device_id": "d"}},
+    {"name": "dispositivos del usuario", "collection": "dispositivos", "filter": {"username": "u"},
+     "sort": {"_id": 1}},
+    {"name": "variable por nombre", "collection": "variables",
+     "filter": {"username": "u", "device_id": "d", "variable_name": "v"}},
+    {"name": "variables del usuario", "collection": "variables", "filter": {"username": "u"},
+     "sort": {"_id": 1}},
+    {"name": "alarmas del dispositivo", "collection": "alarmas",
+     "filter": {"username": "u", "device_id": "d"}},
+    {"name": "regla de alarma duplicada", "collection": "alarmas",
+     "filter": {"username": "u", "device_id": "d", "variable_id": "v", "field": "value",
+                "operator": ">", "threshold": 1.0}},
+    {"name": "save-rules del dispositivo", "collection": "emqx_save_rules",
+     "filter": {"username": "u", "device_id": "d"}},
+    {"name": "emqx auth (mqtt_user)", "collection": "mqtt_user", "filter": {"username": "dev_d"}},
+    {"name": "emqx acl (mqtt_acl)", "collection": "mqtt_acl", "filter": {"username": "dev_d"}},
+    {"name": "histórico de una variable", "collection": "measurements",
+     "filter": {"meta.username": "u", "meta.device_id": "d", "meta.variable_id": "v"}
+     if MEASUREMENTS_TIMESERIES else {"username": "u", "device_id": "d", "variable_id": "v"},
+     "sort": {"timestamp": -1}},
+    {"name": "último estado de alarmas", "collection": "alarms",
+     "filter": {"rule_id": {"$in": ["r"]}}, "sort": {"timestamp": -1}},
+]
+
+
+def _plan_stages(plan: Any, stages: Set[str]) -> Set[str]:
+    """Recorre el árbol del plan (clásico o SBE) y recoge los nombres de etapa."""
+    if isinstance(plan, dict):
+        if isinstance(plan.get("stage"), str):
+            stages.add(plan["stage"])
+        for value in plan.values():
+            _plan_stages(value, stages)
+    elif isinstance(plan, list):
+        for value in plan:
+            _plan_stages(value, stages)
+    return stages
+
+
+async def audit_query_plans(db) -> List[Dict[str, Any]]:
+    """
+    Ejecuta explain() sobre cada forma de consulta conocida y marca las que
+    el planificador resuelve con un recorrido completo de la colección.
+    """
+    resultados = []
+    for shape in QUERY_SHAPES:
+        find = {"find": shape["collection"], "filter": shape["filter"]}
+        if shape.get("sort"):
+            find["sort"] = shape["sort"]
+        try:
+            explain = await db.command({"explain": find, "verbosity": "queryPlanner"})
+        except OperationFailure as e:
+            resultados.append({"name": shape["name"], "collection": shape["collection"], "error": str(e)})
+            continue
+
+        winning = explain.get("queryPlanner", {}).get("winningPlan", {})
+        stages = _plan_stages(winning, set())
+        resultados.append({
+            "name": shape["name"],
+            "collection": shape["collection"],
+            "stages": sorted(stages),
+            "collscan": "COLLSCAN" in stages,
+        })
+    return resultados
+
+
+if __name__ == "__main__":
+    # python -m app.utils.mongo_indexes  → aplica los índices y audita los planes
+    from app.utils.db import connect_to_mongo, close_mongo_connection, get_db
+
+    async def _main():
+        await connect_to_mongo()
+        try:
+            resultados = await audit_query_plans(get_db())
+        finally:
+            await close_mongo_connection()
+        print(json.dumps(resultados, indent=2, ensure_ascii=False))
+        return any(r.get("collscan") for r in resultados)
+
+    logging.basicConfig(level=logging.INFO)
+    raise SystemExit(1 if asyncio.run(_main()) else 0)
@@ -0,0 +1,227 @@
+import os
+import socket
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import paho.mqtt.client as mqtt
+
+from app.utils import fastjson
+from app.utils.db import get_db
+from app.utils.batching import BatchFlusher, BufferFullError
+from app.utils.ingest import parse_saver_record, persist_samples
+from app.utils.device_registry import device_registry
+from app.routes.auth import hash_password
+
+# ---------------------------------------------------
+# Modo de ingesta
+# ---------------------------------------------------
+# webhook: EMQX reenvía cada mensaje a /saver-webhook mediante una regla por dispositivo.
+# mqtt:    la API se suscribe con una suscripción compartida y no se crean reglas SAVE.
+INGEST_MODE = os.getenv("INGEST_MODE", "webhook").lower()
+
+MQTT_HOST = os.getenv("MQTT_HOST", "emqx")
+MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
+MQTT_INGEST_USERNAME = os.getenv("MQTT_INGEST_USERNAME", "api_ingest")
+MQTT_INGEST_PASSWORD = os.getenv("MQTT_INGEST_PASSWORD")
+MQTT_SHARE_GROUP = os.getenv("MQTT_SHARE_GROUP", "iot-ingest")
+MQTT_INGEST_TOPIC = "iot/+/+/+/sdata"
+MQTT_INGEST_QOS = int(os.getenv("MQTT_INGEST_QOS", 1))
+MQTT_INGEST_BATCH_SIZE = int(os.getenv("MQTT_INGEST_BATCH_SIZE", 1000))
+MQTT_INGEST_FLUSH_INTERVAL_MS = int(os.getenv("MQTT_INGEST_FLUSH_INTERVAL_MS", 100))
+MQTT_INGEST_MAX_QUEUE = int(os.getenv("MQTT_INGEST_MAX_QUEUE", 20000))
+# Espera máxima por sitio en la cola antes de descartar un mensaje
+MQTT_INGEST_PUT_TIMEOUT_S = float(os.getenv("MQTT_INGEST_PUT_TIMEOUT_S", 5))
+# Mensajes que pueden esperar sitio a la vez fuera de la cola (cada uno retiene su payload)
+MQTT_INGEST_MAX_WAITING = int(os.getenv("MQTT_INGEST_MAX_WAITING", 1000))
+
+
+def saver_rules_enabled() -> bool:
+    """Las reglas SAVE de EMQX solo se usan en modo webhook."""
+    return INGEST_MODE != "mqtt"
+
+
+class MqttSampleSink(BatchFlusher):
+    """
+    Recibe (topic, payload) del hilo de paho y los persiste por lotes con el
+    mismo pipeline que /saver-webhook. Igual que la regla SAVE, solo se
+    guardan los mensajes con payload.save == 1.
+    """
+
+    name = "mqtt-ingest"
+
+    def __init__(self):
+        super().__init__(
+            MQTT_INGEST_BATCH_SIZE,
+            MQTT_INGEST_FLUSH_INTERVAL_MS / 1000,
+            MQTT_INGEST_MAX_QUEUE
+        )
+        self.invalid_messages = 0
+        self.unknown_devices = 0
+        self.dropped_messages = 0
+        self._waiting: Set[asyncio.Task] = set()
+
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    def offer(self, item: Tuple[str, bytes]) -> None:
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # El hilo de paho vio sitio pero otros mensajes llegaron antes: se
+            # espera, con un número acotado de esperas para no perder el límite de memoria
+            if len(self._waiting) >= MQTT_INGEST_MAX_WAITING:
+                self.dropped_messages += 1
+                logging.warning("[mqtt-ingest] Cola y esperas llenas, mensaje descartado")
+                return
+            task = asyncio.create_task(self.offer_wait(item))
+            self._waiting.add(task)
+            task.add_done_callback(self._waiting.discard)
+
+    async def offer_wait(self, item: Tuple[str, bytes]) -> bool:
+        """Encola esperando como mucho MQTT_INGEST_PUT_TIMEOUT_S; si no, descarta y lo cuenta."""
+        try:
+            await asyncio.wait_for(self.put(item), MQTT_INGEST_PUT_TIMEOUT_S)
+            return True
+        except asyncio.TimeoutError:
+            self.dropped_messages += 1
+            logging.warning(
+                f"[mqtt-ingest] Cola llena durante {MQTT_INGEST_PUT_TIMEOUT_S}s, mensaje descartado"
+            )
+            return False
+
+    async def stop(self) -> None:
+        # Los mensajes que esperan sitio entran antes del vaciado final
+        await asyncio.gather(*self._waiting, return_exceptions=True)
+        await super().stop()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **super().stats(),
+            "invalid_messages": self.invalid_messages,
+            "unknown_devices": self.unknown_devices,
+            "dropped_messages": self.dropped_messages,
+            "waiting_messages": len(self._waiting)
+        }
+
+    async def _flush(self, batch: List[Tuple[str, bytes]]) -> None:
+        samples = []
+        for topic, raw in batch:
+            try:
+                payload = fastjson.loads(raw)
+                if not isinstance(payload, dict) or payload.get("save") != 1:
+                    continue
+                samples.append(parse_saver_record({"topic": topic, "payload": payload}))
+            except ValueError:
+                self.invalid_messages += 1
+
+        # La suscripción cubre todos los topics: solo dispositivos registrados
+        samples, rejected = await device_registry.split_owned(samples)
+        self.unknown_devices += len(rejected)
+
+        # Si el write-behind de Mongo está lleno se reintenta: la cola se
+        # llena y el hilo de paho se bloquea (backpressure hacia EMQX)
+        while True:
+            try:
+                await persist_samples(samples)
+                return
+            except BufferFullError:
+                await asyncio.sleep(0.1)
+
+
+class MqttIngestWorker:
+    """
+    Cliente MQTT que se suscribe a $share/<grupo>/iot/+/+/+/sdata. Varios
+    procesos con el mismo grupo se reparten los mensajes en EMQX.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self.sink = MqttSampleSink()
+        # Por encima de este nivel el hilo de red espera a que haya sitio
+        self._high_water = int(MQTT_INGEST_MAX_QUEUE * 0.9)
+        self.client_id = f"api-ingest-{socket.gethostname()}-{os.getpid()}"
+        self.subscription = f"$share/{MQTT_SHARE_GROUP}/{MQTT_INGEST_TOPIC}"
+
+        if hasattr(mqtt, "CallbackAPIVersion"):  # paho-mqtt >= 2.0
+            self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=self.client_id)
+        else:
+            self._client = mqtt.Client(client_id=self.client_id)
+        self._client.username_pw_set(MQTT_INGEST_USERNAME, MQTT_INGEST_PASSWORD)
+        self._client.on_connect = self._on_connect
+        self._client.on_message = self._on_message
+        self._client.reconnect_delay_set(min_delay=1, max_delay=30)
+
+    async def start(self) -> None:
+        await self.sink.start()
+        self._client.connect_async(MQTT_HOST, MQTT_PORT, keepalive=30)
+        self._client.loop_start()
+        logging.info(f"[mqtt-ingest] {self.client_id} conectando a {MQTT_HOST}:{MQTT_PORT}")
+
+    async def stop(self) -> None:
+        self._client.disconnect()
+        await asyncio.to_thread(self._client.loop_stop)
+        await self.sink.stop()
+
+    # --- Callbacks (hilo de paho) ---
+    def _on_connect(self, client, userdata, flags, reason_code, properties=None):
+        if reason_code != 0:
+            logging.error(f"[mqtt-ingest] Conexión rechazada: {reason_code}")
+            return
+        client.subscribe(self.subscription, qos=MQTT_INGEST_QOS)
+        logging.info(f"[mqtt-ingest] Suscrito a {self.subscription}")
+
+    def _on_message(self, client, userdata, msg):
+        item = (msg.topic, msg.payload)
+        # Con mensajes ya esperando sitio, este también espera (en este hilo)
+        if self.sink.qsize() < self._high_water and not self.sink.waiting():
+            self._loop.call_soon_threadsafe(self.sink.offer, item)
+        else:
+            # Espera acotada: el hilo no deja de atender keepalives indefinidamente
+            asyncio.run_coroutine_threadsafe(self.sink.offer_wait(item), self._loop).result()
+
+
+async def asegurar_usuario_mqtt_ingesta() -> None:
+    """
+    Crea/actualiza el usuario MQTT del worker y su ACL de suscripción en las
+    colecciones que usa el plugin emqx_auth_mongo.
+    """
+    db = get_db()
+    if db is None:
+        raise RuntimeError("BD no inicializada")
+
+    hashed = await hash_password(MQTT_INGEST_PASSWORD)
+    await db["mqtt_user"].update_one(
+        {"username": MQTT_INGEST_USERNAME},
+        {"$set": {"password": hashed}},
+        upsert=True
+    )
+    await db["mqtt_acl"].update_one(
+        {"username": MQTT_INGEST_USERNAME},
+        {"$set": {"subscribe": [MQTT_INGEST_TOPIC]}},
+        upsert=True
+    )
+
+
+mqtt_worker: Optional[MqttIngestWorker] = None
+
+async def start_mqtt_ingest() -> None:
+    global mqtt_worker
+    if INGEST_MODE != "mqtt":
+        return
+    if not MQTT_INGEST_PASSWORD:
+        raise RuntimeError("INGEST_MODE=mqtt requiere MQTT_INGEST_PASSWORD")
+
+    await asegurar_usuario_mqtt_ingesta()
+    mqtt_worker = MqttIngestWorker(asyncio.get_running_loop())
+    await mqtt_worker.start()
+
+async def stop_mqtt_ingest() -> None:
+    global mqtt_worker
+    if mqtt_worker is not None:
+        await mqtt_worker.stop()
+        mqtt_worker = None
+        logging.info("[mqtt-ingest] Worker detenido")
+
+def get_mqtt_worker() -> Optional[MqttIngestWorker]:
+    return mqtt_worker
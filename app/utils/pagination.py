@@ -0,0 +1,80 @@
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+from app.utils import fastjson
+
+# ---------------------------------------------------
+# Paginación por clave (_id), proyección y streaming NDJSON
+# ---------------------------------------------------
+# La paginación por _id (after = último id recibido) usa el índice
+# (username, _id) y no se degrada con el número de página como skip().
+
+MAX_PAGE_SIZE = 1000
+
+
+def parse_fields(fields: Optional[str], allowed: Tuple[str, ...]) -> Tuple[List[str], Dict[str, int]]:
+    """
+    Valida la lista `fields` (separada por comas) y devuelve los campos
+    pedidos y la proyección de Mongo. Sin `fields` se devuelven todos.
+    """
+    if not fields:
+        campos = list(allowed)
+    else:
+        campos = [f.strip() for f in fields.split(",") if f.strip()]
+        invalidos = [f for f in campos if f not in allowed]
+        if invalidos:
+            raise HTTPException(400, f"Campos no válidos: {invalidos}. Permitidos: {list(allowed)}")
+    projection = {"_id": 1, **{f: 1 for f in campos if f != "id"}}
+    return campos, projection
+
+
+def keyset_filter(filtro: Dict[str, Any], after: Optional[str]) -> Dict[str, Any]:
+    if after is None:
+        return filtro
+    try:
+        return {**filtro, "_id": {"$gt": ObjectId(after)}}
+    except (InvalidId, TypeError):
+        raise HTTPException(400, "'after' debe ser un id devuelto por una página anterior")
+
+
+def serializer(campos: List[str]) -> Callable[[Dict[str, Any]], Dict[str, Any]]:
+    def _serializar(doc: Dict[str, Any]) -> Dict[str, Any]:
+        return {f: (str(doc["_id"]) if f == "id" else doc.get(f)) for f in campos}
+    return _serializar
+
+
+async def _ndjson(cursor, serializar) -> AsyncIterator[bytes]:
+    async for doc in cursor:
+        yield (fastjson.dumps(serializar(doc)) + "\n").encode("utf-8")
+
+
+async def paginar(
+    collection,
+    filtro: Dict[str, Any],
+    campos: List[str],
+    projection: Dict[str, int],
+    limit: Optional[int],
+    after: Optional[str],
+    stream: bool
+):
+    """
+    Lista documentos de `collection` ordenados por _id. Con `limit` devuelve
+    una página y el id para pedir la siguiente; con `stream` devuelve NDJSON
+    generado a medida que el cursor de Motor entrega los documentos.
+    Devuelve (items, next_after) o un StreamingResponse.
+    """
+    cursor = collection.find(keyset_filter(filtro, after), projection).sort("_id", 1)
+    if limit is not None:
+        cursor = cursor.limit(limit)
+    serializar = serializer(campos)
+
+    if stream:
+        return StreamingResponse(_ndjson(cursor, serializar), media_type="application/x-ndjson")
+
+    docs = await cursor.to_list(length=limit)
+    next_after = str(docs[-1]["_id"]) if limit is not None and len(docs) == limit else None
+    return [serializar(d) for d in docs], next_after
@@ -0,0 +1,201 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+from app.utils.http_clients import get_http_client
+from app.apis.influx_api import flux_string
+
+# ---------------------------------------------------
+# Rollups (downsampling continuo) de iot_data
+# ---------------------------------------------------
+# Cada nivel es una tarea de Influx que se ejecuta al cerrar cada periodo
+# (con ROLLUP_GRACE_S de margen para las muestras que llegan tarde) y
+# recalcula desde el bucket crudo las últimas ventanas: un punto
+# `iot_rollup` con mean/min/max/count/last por (username, device_id,
+# variable_id) en el bucket del nivel, cada uno con su propia retención.
+# Como cada punto se recalcula siempre a partir de los datos crudos,
+# reescribirlo es idempotente: no importa cuántos procesos de ingesta haya
+# ni que se reinicien. Los procesos de la API solo leen el estado de las
+# tareas para saber qué intervalo cubre ya cada bucket (cobertura).
+ROLLUPS_ENABLED = os.getenv("ROLLUPS_ENABLED", "true").lower() in ("1", "true", "yes")
+ROLLUP_MEASUREMENT = "iot_rollup"
+ROLLUP_FIELDS = ("mean", "min", "max", "count", "last")
+ROLLUP_GRACE_S = float(os.getenv("ROLLUP_GRACE_S", 10))
+# Ventanas que recalcula cada ejecución (la última y las anteriores, por si llegaron muestras tarde)
+ROLLUP_RECOMPUTE_WINDOWS = int(os.getenv("ROLLUP_RECOMPUTE_WINDOWS", 2))
+# Cada cuánto se consulta el estado de las tareas
+ROLLUP_REFRESH_S = float(os.getenv("ROLLUP_REFRESH_S", 30))
+
+
+class RollupTier(NamedTuple):
+    name: str
+    period_s: int
+    bucket: str
+    retention_s: int
+
+
+ROLLUP_TIERS: Tuple[RollupTier, ...] = (
+    RollupTier(
+        "1m", 60,
+        os.getenv("ROLLUP_1M_BUCKET", "measurements_1m"),
+        int(float(os.getenv("ROLLUP_1M_RETENTION_DAYS", 90)) * 86400)
+    ),
+    RollupTier(
+        "1h", 3600,
+        os.getenv("ROLLUP_1H_BUCKET", "measurements_1h"),
+        int(float(os.getenv("ROLLUP_1H_RETENTION_DAYS", 730)) * 86400)
+    ),
+)
+
+
+def rollup_task_name(tier: RollupTier) -> str:
+    return f"rollup_{tier.name}"
+
+
+def rollup_task_flux(tier: RollupTier, source_bucket: str, org: str) -> str:
+    """
+    Flux de la tarea del nivel. now() es la hora programada de la ejecución
+    (múltiplo del periodo), así que el rango contiene solo ventanas cerradas.
+    Cada punto se fecha al inicio de su ventana.
+    """
+    agregados = ",\n".join(
+        f"    agregado(fn: {campo}, campo: {flux_string(campo)})" for campo in ROLLUP_FIELDS
+    )
+    return (
+        'import "types"\n\n'
+        f"option task = {{name: {flux_string(rollup_task_name(tier))}, "
+        f"every: {tier.period_s}s, offset: {int(ROLLUP_GRACE_S * 1000)}ms}}\n\n"
+        f"datos = from(bucket: {flux_string(source_bucket)})\n"
+        f"    |> range(start: -{tier.period_s * ROLLUP_RECOMPUTE_WINDOWS}s)\n"
+        '    |> filter(fn: (r) => r._measurement == "iot_data" and r._field == "value")\n'
+        '    |> filter(fn: (r) => types.isType(v: r._value, type: "float") or types.isType(v: r._value, type: "int"))\n'
+        "    |> toFloat()\n\n"
+        "agregado = (fn, campo) => datos\n"
+        f'    |> aggregateWindow(every: {tier.period_s}s, fn: fn, createEmpty: false, timeSrc: "_start")\n'
+        '    |> set(key: "_field", value: campo)\n\n'
+        f"union(tables: [\n{agregados}\n])\n"
+        f"    |> set(key: \"_measurement\", value: {flux_string(ROLLUP_MEASUREMENT)})\n"
+        f"    |> to(bucket: {flux_string(tier.bucket)}, org: {flux_string(org)})\n"
+    )
+
+
+def _epoch(valor: Optional[str]) -> Optional[float]:
+    # Influx devuelve RFC3339 con hasta nanosegundos: basta con segundos
+    if not valor:
+        return None
+    return datetime.fromisoformat(valor[:19]).replace(tzinfo=timezone.utc).timestamp()
+
+
+class RollupService:
+    """
+    Cobertura de cada bucket de rollup según el estado de su tarea:
+    [primer periodo completo tras crearse la tarea, última ejecución
+    completada). Las consultas leen del rollup solo ese intervalo.
+    """
+
+    def __init__(self):
+        self._coverage: Dict[str, Tuple[float, float]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.refresh_errors = 0
+
+    async def start(self) -> None:
+        await self.refresh()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(ROLLUP_REFRESH_S)
+            await self.refresh()
+
+    async def refresh(self) -> None:
+        INFLUX_URL   = os.getenv("INFLUX_URL", "http://influxdb:8086")
+        INFLUX_TOKEN = os.getenv("INFLUX_AUTH_TOKEN")
+        INFLUX_ORG   = os.getenv("INFLUX_ORG", "my-org")
+        headers = {"Authorization": f"Token {INFLUX_TOKEN}"}
+        client = get_http_client("influx")
+
+        coverage: Dict[str, Tuple[float, float]] = {}
+        try:
+            for tier in ROLLUP_TIERS:
+                resp = await client.get(
+                    f"{INFLUX_URL}/api/v2/tasks",
+                    params={"name": rollup_task_name(tier), "org": INFLUX_ORG},
+                    headers=headers
+                )
+                resp.raise_for_status()
+                tareas = sorted(resp.json().get("tasks", []), key=lambda t: t.get("createdAt", ""))
+                if not tareas:
+                    continue
+                tarea = tareas[0]
+                # Tarea pausada o fallando: no se confía en lo que haya en el bucket
+                if tarea.get("status") != "active" or tarea.get("lastRunStatus") == "failed":
+                    continue
+                creada, completada = _epoch(tarea.get("createdAt")), _epoch(tarea.get("latestCompleted"))
+                if creada is None or completada is None:
+                    continue
+                desde = -(-creada // tier.period_s) * tier.period_s
+                hasta = completada // tier.period_s * tier.period_s
+                if hasta > desde:
+                    coverage[tier.name] = (desde, hasta)
+        except Exception as e:
+            self.refresh_errors += 1
+            logging.warning(f"[rollups] No se pudo consultar el estado de las tareas: {e!r}")
+            return
+        self._coverage = coverage
+
+    def coverage(self, tier: RollupTier) -> Optional[Tuple[float, float]]:
+        """Intervalo [desde, hasta) en epoch que ya contiene el bucket del nivel, o None."""
+        return self._coverage.get(tier.name)
+
+    def stats(self) -> Dict[str, Any]:
+        ahora = time.time()
+        stats: Dict[str, Any] = {"refresh_errors": self.refresh_errors}
+        for tier in ROLLUP_TIERS:
+            cobertura = self._coverage.get(tier.name)
+            stats[f"lag_{tier.name}_s"] = round(ahora - cobertura[1], 1) if cobertura else None
+        return stats
+
+
+rollup_service: Optional[RollupService] = None
+
+async def start_rollups() -> None:
+    global rollup_service
+    if ROLLUPS_ENABLED and rollup_service is None:
+        rollup_service = RollupService()
+        await rollup_service.start()
+        logging.info(f"[rollups] Rollups activos: {', '.join(t.name + '->' + t.bucket for t in ROLLUP_TIERS)}")
+
+async def stop_rollups() -> None:
+    global rollup_service
+    if rollup_service is not None:
+        await rollup_service.stop()
+        rollup_service = None
+        logging.info("[rollups] Rollups detenidos")
+
+def get_rollup_service() -> Optional[RollupService]:
+    return rollup_service
+
+
+def rollup_tier_for(every_s: Optional[float], fn: str) -> Optional[RollupTier]:
+    """
+    Nivel de rollup que responde exactamente a aggregateWindow(every, fn):
+    min/max/count/last admiten cualquier múltiplo del periodo; mean solo
+    el periodo exacto (la media de medias no es la media).
+    """
+    if not ROLLUPS_ENABLED or not every_s:
+        return None
+    for tier in sorted(ROLLUP_TIERS, key=lambda t: -t.period_s):
+        if fn == "mean" and every_s == tier.period_s:
+            return tier
+        if fn in ("min", "max", "count", "last") and every_s % tier.period_s == 0:
+            return tier
+    return None
@@ -1,107 +1,389 @@
+import os
+import time
+import socket
 import logging
-from app.utils.db import get_db
-from app.apis.emqx_api import emqx_post, get_resource, emqx_get
 import asyncio
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from app.utils.db import get_db
+from app.apis.emqx_api import (
+    emqx_post, emqx_put, emqx_delete, get_resource, emqx_get,
+    construir_regla_save, construir_regla_alarma, SAVE_RULE_PREFIX, ALARM_RULE_PREFIX,
+    SAVE_RULE_MODE, save_rule_scope
+)
+from app.utils.mqtt_ingest import saver_rules_enabled
+from app.utils.alarm_engine import alarm_engine, local_alarms_enabled, is_local_rule
+
+# ---------------------------------------------------
+# Reconciliación de reglas EMQX
+# ---------------------------------------------------
+# Al arrancar se compara el estado deseado (Mongo) con las reglas que ya
+# existen en EMQX y solo se crea, actualiza o borra lo que difiere, con un
+# número acotado de llamadas concurrentes. Solo se tocan las reglas que
+# gestiona la API (descripción "SAVER-RULE ..." o "ALARM ...").
+# Con varios procesos solo reconcilia el que toma el lease en `locks` (como
+# el de la migración de measurements); el resto lo omite.
+EMQX_RECONCILE_CONCURRENCY = int(os.getenv("EMQX_RECONCILE_CONCURRENCY", 16))
+EMQX_RULES_PAGE_SIZE = int(os.getenv("EMQX_RULES_PAGE_SIZE", 500))
+EMQX_RECONCILE_LEASE_S = float(os.getenv("EMQX_RECONCILE_LEASE_S", 300))
+RECONCILE_LOCK_ID = "emqx_reconcile"
+PROCESS_OWNER = f"{socket.gethostname()}-{os.getpid()}"
+
+# Una regla SAVE se crea tras reservar su documento en emqx_save_rules
+# (único por ámbito): quien no tiene la reserva espera a su rule_id como
+# mucho SAVE_RULE_CLAIM_TIMEOUT_S; pasado ese tiempo la reserva caduca.
+SAVE_RULE_CLAIM_TIMEOUT_S = float(os.getenv("SAVE_RULE_CLAIM_TIMEOUT_S", 15))
+
+MANAGED_PREFIXES = (SAVE_RULE_PREFIX, ALARM_RULE_PREFIX)
 
 
-async def cargar_save_rules_desde_mongo():
-    logging.info("[startup] Cargando reglas de tipo SAVE desde MongoDB...")
+async def cargar_alarm_rules_desde_mongo():
+    # Reglas evaluadas en proceso: todas con ALARM_ENGINE=local, si no solo las de ventana
+    await alarm_engine.load_from_mongo()
+    if local_alarms_enabled():
+        logging.info("[startup] ALARM_ENGINE=local: reglas ALARM cargadas en memoria, no en EMQX")
+
+
+async def listar_reglas_emqx() -> List[Dict[str, Any]]:
+    """Lista todas las reglas de EMQX recorriendo las páginas de /rules."""
+    reglas: List[Dict[str, Any]] = []
+    page = 1
+    while True:
+        resp = await emqx_get(f"/rules?_page={page}&_limit={EMQX_RULES_PAGE_SIZE}")
+        data = resp.get("data") or []
+        reglas.extend(data)
+
+        # Sin paginación (meta ausente) la respuesta ya trae todas las reglas
+        meta = resp.get("meta")
+        if not meta or len(data) < EMQX_RULES_PAGE_SIZE:
+            return reglas
+        if meta.get("count") is not None and len(reglas) >= meta["count"]:
+            return reglas
+        page += 1
+
+
+def _rule_signature(rule: Dict[str, Any]) -> Tuple:
+    """Lo que determina si una regla existente coincide con la deseada."""
+    actions = tuple(
+        (
+            a.get("name"),
+            (a.get("params") or {}).get("$resource"),
+            (a.get("params") or {}).get("payload_tmpl"),
+        )
+        for a in rule.get("actions") or []
+    )
+    return (rule.get("rawsql", "").strip(), bool(rule.get("enabled")), actions)
 
+
+def _scope_filter(username: Optional[str], device_id: Optional[str]) -> Dict[str, Any]:
+    filtro = {"username": username, "device_id": device_id}
+    return {k: (v if v is not None else {"$exists": False}) for k, v in filtro.items()}
+
+
+def _reserva_activa(doc: Dict[str, Any], ahora: datetime) -> bool:
+    """True si otro intento está creando la regla del documento."""
+    claimed_at = doc.get("claimed_at")
+    return (
+        not doc.get("rule_id") and bool(doc.get("claim")) and claimed_at is not None
+        and claimed_at > ahora - timedelta(seconds=SAVE_RULE_CLAIM_TIMEOUT_S)
+    )
+
+
+def _save_rule_doc(username: Optional[str], device_id: Optional[str]) -> Dict[str, Any]:
+    doc = {"type": "save-rule", "scope": SAVE_RULE_MODE}
+    if username is not None:
+        doc["username"] = username
+    if device_id is not None:
+        doc["device_id"] = device_id
+    return doc
+
+
+async def _guardar_regla_save(db, doc: Dict[str, Any], rule: Dict[str, Any], rule_id: str) -> None:
+    """Inserta o actualiza en emqx_save_rules la regla SAVE con su rule_id."""
+    campos = {
+        "rule_id": rule_id,
+        "rawsql": rule["rawsql"],
+        "description": rule["description"],
+        "payload_tmpl": rule["actions"][0]["params"]["payload_tmpl"],
+        "enabled": rule["enabled"],
+    }
+    cambios = {"$set": campos, "$unset": {"claim": "", "claimed_at": ""}}
+    if "_id" in doc:
+        await db["emqx_save_rules"].update_one({"_id": doc["_id"]}, cambios)
+    else:
+        # Índice único por ámbito: si el documento ya existe se actualiza
+        filtro = _scope_filter(doc.get("username"), doc.get("device_id"))
+        try:
+            await db["emqx_save_rules"].update_one(filtro, {**cambios, "$setOnInsert": doc}, upsert=True)
+        except DuplicateKeyError:
+            await db["emqx_save_rules"].update_one(filtro, cambios)
+
+    if doc.get("device_id"):
+        await db["dispositivos"].update_one(
+            {"username": doc["username"], "device_id": doc["device_id"]},
+            {"$set": {"emqx_rule_id": rule_id}}
+        )
+
+
+async def asegurar_regla_save(username: str, device_id: str) -> str:
+    """
+    Garantiza que existe la regla SAVE que cubre al dispositivo y devuelve
+    su rule_id. Solo en modo device se crea una regla nueva por dispositivo;
+    en tenant/global se reutiliza la del usuario o la global. Entre procesos
+    la crea solo quien reserva el documento del ámbito en emqx_save_rules.
+    """
     db = get_db()
     if db is None:
-        logging.warning("[startup] No se pudo obtener la conexión a MongoDB")
-        return
-
-    saverResource, _ = await get_resource()   
-    cursor = db["emqx_save_rules"].find({})
-    async for regla in cursor:
-        username = regla["username"]
-        device_id = regla["device_id"]
-
-        rawsql = (
-            f"SELECT payload AS payload, topic "
-            f"FROM \"iot/{username}/{device_id}/+/sdata\" "
-            f"WHERE payload.save = 1"
+        raise RuntimeError("BD no inicializada")
+
+    scope = save_rule_scope(username, device_id)
+    filtro = _scope_filter(*scope)
+    coleccion = db["emqx_save_rules"]
+
+    # Reservar el documento del ámbito (o encontrar el de otro proceso)
+    claim = str(ObjectId())
+    limite = time.monotonic() + SAVE_RULE_CLAIM_TIMEOUT_S
+    while True:
+        if time.monotonic() > limite:
+            raise RuntimeError(f"La regla SAVE de {scope} sigue en creación en otro proceso")
+        ahora = datetime.utcnow()
+        try:
+            doc = await coleccion.find_one_and_update(
+                filtro,
+                {"$setOnInsert": {**_save_rule_doc(*scope), "claim": claim, "claimed_at": ahora}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Otro proceso insertó el documento a la vez: se relee
+            continue
+        if doc.get("rule_id"):
+            return doc["rule_id"]
+        if doc.get("claim") == claim:
+            break
+        if not _reserva_activa(doc, ahora):
+            # Reserva caducada (o sin reserva): se toma si nadie se adelanta
+            tomada = await coleccion.update_one(
+                {"_id": doc["_id"], "rule_id": doc.get("rule_id"), "claim": doc.get("claim")},
+                {"$set": {"claim": claim, "claimed_at": ahora}}
+            )
+            if tomada.modified_count:
+                break
+            continue
+        await asyncio.sleep(0.2)
+
+    try:
+        saverResource, _ = await get_resource()
+        rule = construir_regla_save(*scope, saverResource.get("id"))
+        resp = await emqx_post("/rules", rule)
+        rule_id = resp["data"]["id"]
+    except Exception:
+        # Se libera la reserva: el siguiente intento no espera a que caduque
+        await coleccion.update_one({"_id": doc["_id"], "claim": claim}, {"$unset": {"claim": "", "claimed_at": ""}})
+        raise
+    await _guardar_regla_save(db, doc, rule, rule_id)
+    logging.info(f"[rules] Regla SAVE {rule['description']} creada: rule:{rule_id}")
+    return rule_id
+
+async def _reglas_deseadas(db, obsoletos: List[Any]) -> List[Dict[str, Any]]:
+    """
+    Construye las reglas que deberían existir en EMQX a partir de Mongo.
+    Cada entrada lleva la colección y el documento de origen para poder
+    guardar el rule_id resultante. Los _id de emqx_save_rules que ya no
+    corresponden al modo actual se añaden a `obsoletos`.
+    """
+    saverResource, alarmResource = await get_resource()
+    deseadas: List[Dict[str, Any]] = []
+
+    if saver_rules_enabled():
+        # Una regla por ámbito de SAVE_RULE_MODE; los documentos de
+        # emqx_save_rules de otro ámbito (p.ej. tras cambiar de modo) se
+        # migran: sus reglas quedan sin reclamar y se borran
+        scopes = {(None, None)} if SAVE_RULE_MODE == "global" else set()
+        async for disp in db["dispositivos"].find({}, {"username": 1, "device_id": 1}):
+            scopes.add(save_rule_scope(disp["username"], disp["device_id"]))
+
+        async for regla in db["emqx_save_rules"].find({}):
+            scope = (regla.get("username"), regla.get("device_id"))
+            if scope not in scopes:
+                obsoletos.append(regla["_id"])
+                continue
+            scopes.discard(scope)
+            deseadas.append({
+                "coll": "emqx_save_rules",
+                "doc": regla,
+                "rule": construir_regla_save(*scope, saverResource.get("id"))
+            })
+        for username, device_id in scopes:
+            deseadas.append({
+                "coll": "emqx_save_rules",
+                "doc": _save_rule_doc(username, device_id),
+                "rule": construir_regla_save(username, device_id, saverResource.get("id"))
+            })
+
+    if not local_alarms_enabled():
+        async for regla in db["alarmas"].find({}):
+            if is_local_rule(regla):
+                continue
+            try:
+                rule = construir_regla_alarma(
+                    regla["username"], regla["device_id"], regla["variable_id"],
+                    regla["field"], regla["operator"], regla["threshold"],
+                    alarmResource.get("id")
+                )
+            except (KeyError, ValueError) as e:
+                logging.error(f"[reconcile] Regla de alarma {regla.get('_id')} ignorada: {e!r}")
+                continue
+            deseadas.append({"coll": "alarmas", "doc": regla, "rule": rule})
+
+    return deseadas
+
+
+async def _tomar_lease(db) -> bool:
+    """Toma el lease de la reconciliación con una operación atómica; False si lo tiene otro proceso."""
+    ahora = datetime.utcnow()
+    try:
+        await db["locks"].find_one_and_update(
+            {
+                "_id": RECONCILE_LOCK_ID,
+                "$or": [{"owner": PROCESS_OWNER}, {"lease_until": {"$not": {"$gt": ahora}}}],
+            },
+            {"$set": {"owner": PROCESS_OWNER, "lease_until": ahora + timedelta(seconds=EMQX_RECONCILE_LEASE_S)}},
+            upsert=True
         )
+    except DuplicateKeyError:
+        # El documento existe pero no cumple el filtro: lease ajeno y vigente
+        return False
+    return True
 
-        new_rule = {
-            "rawsql": rawsql,
-            "actions": [
-                {
-                    "name": "data_to_webserver",
-                    "params": {
-                        "$resource": saverResource.get("id"),
-                        "payload_tmpl": (
-                            f'{{"username":"{username}",'
-                            f'"payload":${{payload}},'
-                            f'"topic":"${{topic}}"}}'
-                        )
-                    }
-                }
-            ],
-            "description": f"SAVER-RULE {username}/{device_id}",
-            "enabled": True
-        }
-
-        logging.info(f"[startup] Creando regla SAVE para {device_id}")
-        resp = await emqx_post("/rules", new_rule)
-        rule_id = resp.get("data", {}).get("id")
-        if rule_id:
-            logging.info(f"[startup] SAVE-rule creada y activada: rule:{rule_id}")
-        else:
-            logging.error(f"[startup] No se pudo obtener el ID de la regla SAVE para {device_id}")
 
+async def _soltar_lease(db) -> None:
+    await db["locks"].update_one(
+        {"_id": RECONCILE_LOCK_ID, "owner": PROCESS_OWNER},
+        {"$set": {"lease_until": datetime.utcnow()}}
+    )
 
-async def cargar_alarm_rules_desde_mongo():
-    logging.info("[startup] Cargando reglas de tipo ALARM desde MongoDB...")
+
+async def reconciliar_reglas_emqx() -> Dict[str, int]:
+    """
+    Lleva las reglas SAVE/ALARM de EMQX al estado que describe Mongo.
+    Devuelve el número de reglas creadas, actualizadas, borradas y sin cambios.
+    """
+    resumen = {"created": 0, "updated": 0, "deleted": 0, "unchanged": 0, "failed": 0}
 
     db = get_db()
     if db is None:
-        logging.warning("[startup] No se pudo obtener la conexión a MongoDB")
-        return
-
-    _, alarmResource = await get_resource()
-    cursor = db["alarmas"].find({})
-    async for regla in cursor:
-        username = regla["username"]
-        device_id = regla["device_id"]
-        variable_id = regla["variable_id"]
-        field = regla["field"]
-        operator = regla["operator"]
-        threshold = regla["threshold"]
-
-        topic = f"iot/{username}/{device_id}/{variable_id}/sdata"
-        condition = f"payload.{field} {operator} {threshold}"
-        rawsql = (
-            f"SELECT payload.{field} AS {field}, topic "
-            f"FROM \"{topic}\" "
-            f"WHERE {condition}"
-        )
+        logging.warning("[reconcile] No se pudo obtener la conexión a MongoDB")
+        return resumen
+
+    # Dos procesos reconciliando a la vez crearían las reglas compartidas
+    # dos veces o borrarían cada uno las del otro
+    if not await _tomar_lease(db):
+        logging.info("[reconcile] Otro proceso está reconciliando las reglas EMQX; se omite")
+        return resumen
+    try:
+        return await _reconciliar(db, resumen)
+    finally:
+        await _soltar_lease(db)
 
-        new_rule = {
-            "rawsql": rawsql,
-            "actions": [
-                {
-                    "name": "data_to_webserver",
-                    "params": {
-                        "$resource": alarmResource.get("id"),
-                        "payload_tmpl": (
-                            f'{{"device":"{device_id}",'
-                            f'"variable":"{variable_id}",'
-                            f'"{field}":${{{field}}},'
-                            f'"topic":"${{topic}}"}}'
-                        )
-                    }
-                }
-            ],
-            "description": f"ALARM {username}/{device_id}/{variable_id}/{field}{operator}{threshold}",
-            "enabled": True
-        }
-
-        logging.info(f"[startup] Creando regla ALARM para {device_id}/{variable_id}")
-        resp = await emqx_post("/rules", new_rule)
+
+async def _reconciliar(db, resumen: Dict[str, int]) -> Dict[str, int]:
+    existentes = [
+        r for r in await listar_reglas_emqx()
+        if (r.get("description") or "").startswith(MANAGED_PREFIXES)
+    ]
+    by_id = {r["id"]: r for r in existentes}
+    by_desc: Dict[str, List[Dict[str, Any]]] = {}
+    for r in existentes:
+        by_desc.setdefault(r["description"], []).append(r)
+
+    obsoletos: List[Any] = []
+    deseadas = await _reglas_deseadas(db, obsoletos)
+
+    # 1) Emparejar cada regla deseada con una existente: primero por el
+    #    rule_id guardado en Mongo y si no por la descripción
+    reclamadas = set()
+    crear, actualizar, sin_cambios = [], [], []
+    ahora = datetime.utcnow()
+    for d in deseadas:
+        actual: Optional[Dict[str, Any]] = by_id.get(d["doc"].get("rule_id"))
+        if actual is None or actual["id"] in reclamadas:
+            actual = next(
+                (r for r in by_desc.get(d["rule"]["description"], []) if r["id"] not in reclamadas),
+                None
+            )
+        if actual is None:
+            # La está creando asegurar_regla_save en otro proceso
+            if not _reserva_activa(d["doc"], ahora):
+                crear.append(d)
+            continue
+        reclamadas.add(actual["id"])
+        d["rule_id"] = actual["id"]
+        if _rule_signature(actual) == _rule_signature(d["rule"]):
+            sin_cambios.append(d)
+        else:
+            actualizar.append(d)
+
+    # 2) Lo que nadie reclama (duplicados, huérfanas o modo deshabilitado) se borra
+    borrar = [r["id"] for r in existentes if r["id"] not in reclamadas]
+
+    sem = asyncio.Semaphore(EMQX_RECONCILE_CONCURRENCY)
+
+    async def _crear(d):
+        async with sem:
+            resp = await emqx_post("/rules", d["rule"])
         rule_id = resp.get("data", {}).get("id")
-        if rule_id:
-            logging.info(f"[startup] ALARM-rule creada y activada: rule:{rule_id}")
+        if not rule_id:
+            raise RuntimeError(f"EMQX no devolvió id para {d['rule']['description']}")
+        d["rule_id"] = rule_id
+        resumen["created"] += 1
+
+    async def _actualizar(d):
+        async with sem:
+            await emqx_put(f"/rules/{d['rule_id']}", d["rule"])
+        resumen["updated"] += 1
+
+    async def _borrar(rule_id):
+        async with sem:
+            await emqx_delete(f"/rules/{rule_id}")
+        resumen["deleted"] += 1
+
+    tareas = (
+        [_crear(d) for d in crear]
+        + [_actualizar(d) for d in actualizar]
+        + [_borrar(rule_id) for rule_id in borrar]
+    )
+    for res in await asyncio.gather(*tareas, return_exceptions=True):
+        if isinstance(res, Exception):
+            resumen["failed"] += 1
+            logging.error(f"[reconcile] Error sincronizando regla EMQX: {res!r}")
+    resumen["unchanged"] = len(sin_cambios)
+
+    # 3) Guardar en Mongo los rule_id que cambiaron
+    for d in crear + actualizar + sin_cambios:
+        rule_id = d.get("rule_id")
+        if not rule_id or rule_id == d["doc"].get("rule_id"):
+            continue
+        if d["coll"] == "emqx_save_rules":
+            await _guardar_regla_save(db, d["doc"], d["rule"], rule_id)
         else:
-            logging.error(f"[startup] No se pudo obtener el ID de la regla ALARM para {device_id}/{variable_id}")
+            await db[d["coll"]].update_one({"_id": d["doc"]["_id"]}, {"$set": {"rule_id": rule_id}})
+
+    if obsoletos:
+        await db["emqx_save_rules"].delete_many({"_id": {"$in": obsoletos}})
+        if SAVE_RULE_MODE != "device":
+            await db["dispositivos"].update_many(
+                {"emqx_rule_id": {"$exists": True}}, {"$unset": {"emqx_rule_id": ""}}
+            )
+        logging.info(f"[reconcile] {len(obsoletos)} reglas SAVE migradas a modo {SAVE_RULE_MODE}")
+
+    logging.info(
+        "[reconcile] Reglas EMQX: %(created)d creadas, %(updated)d actualizadas, "
+        "%(deleted)d borradas, %(unchanged)d sin cambios, %(failed)d con error", resumen
+    )
+    return resumen
@@ -0,0 +1,408 @@
+import os
+import glob
+import fcntl
+import asyncio
+import logging
+import sqlite3
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import bson
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from app.utils import batching
+from app.utils.db import get_db
+from app.utils.batching import BufferFullError
+from app.utils.timeseries import MEASUREMENTS_COLLECTION, MEASUREMENTS_TIMESERIES, not_yet_inserted
+from app.apis.influx_api import INFLUX_PERMANENT_ERRORS, post_lines_to_influx
+
+# ---------------------------------------------------
+# Spool local en disco (store-and-forward)
+# ---------------------------------------------------
+# Si Influx o MongoDB no responden, los lotes que no se pudieron escribir
+# se guardan en un log SQLite local y se reenvían en orden al recuperarse
+# el enlace. Mientras un destino tiene atrasos en el spool, las nuevas
+# escrituras van directamente al disco en lugar de esperar al timeout.
+#
+# Destinos: "influx:<bucket>" (líneas de protocolo) y "mongo:<colección>"
+# (documentos BSON con _id fijado). Reescribir un punto en Influx es
+# idempotente; en Mongo el _id repetido se ignora y, como las colecciones
+# time-series no tienen _id único, en ellas se descartan antes de reenviar
+# los _id que ya existen.
+#
+# Cada proceso usa su propio fichero (SPOOL_PATH, SPOOL_PATH-1, ...),
+# reservado con flock mientras vive: nunca hay dos procesos reenviando las
+# mismas entradas. Al arrancar, un proceso absorbe los ficheros que nadie
+# tiene reservados (de procesos que ya no existen).
+SPOOL_ENABLED = os.getenv("SPOOL_ENABLED", "true").lower() in ("1", "true", "yes")
+SPOOL_PATH = os.getenv("SPOOL_PATH", "spool/spool.db")
+SPOOL_MAX_MB = float(os.getenv("SPOOL_MAX_MB", 512))
+# Los appends que llegan en esta ventana comparten commit (y fsync)
+SPOOL_FSYNC_INTERVAL_MS = int(os.getenv("SPOOL_FSYNC_INTERVAL_MS", 50))
+SPOOL_REPLAY_BATCH = int(os.getenv("SPOOL_REPLAY_BATCH", 5000))
+SPOOL_REPLAY_INTERVAL_S = float(os.getenv("SPOOL_REPLAY_INTERVAL_S", 5))
+
+
+class DiskSpool:
+    """
+    Log append-only en SQLite (modo WAL, synchronous=FULL). Todo el acceso
+    a SQLite pasa por un único hilo; `append` vuelve cuando sus filas están
+    en disco.
+    """
+
+    def __init__(self, path: str = SPOOL_PATH, max_bytes: int = int(SPOOL_MAX_MB * 1024 * 1024)):
+        self.base_path = path
+        self.path = path
+        self._lock_fd: Optional[int] = None
+        self.max_bytes = max_bytes
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="spool")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pending: List[Tuple[str, bytes]] = []
+        self._pending_bytes = 0
+        self._waiters: List[asyncio.Future] = []
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._commit_task: Optional[asyncio.Task] = None
+        self._replay_task: Optional[asyncio.Task] = None
+        # Destinos con atrasos: sus escrituras nuevas se desvían al spool
+        self._offline: Set[str] = set()
+        # Entradas de cada destino aún no reenviadas (pendientes de commit,
+        # en pleno commit o en disco): el destino deja de desviarse a cero
+        self._backlog: Dict[str, int] = {}
+
+        # Métricas
+        self.bytes = 0
+        self.entries = 0
+        self.appended = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.commits = 0
+
+    # --- Hilo de SQLite ---
+    def _slot_path(self, slot: int) -> str:
+        base, ext = os.path.splitext(self.base_path)
+        return self.base_path if slot == 0 else f"{base}-{slot}{ext}"
+
+    def _lock(self, path: str) -> Optional[int]:
+        fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def _adopt_orphans(self) -> int:
+        """Mueve a nuestro fichero las entradas de los ficheros sin proceso dueño."""
+        base, ext = os.path.splitext(self.base_path)
+        movidas = 0
+        for path in sorted({self.base_path, *glob.glob(f"{glob.escape(base)}-*{ext}")}):
+            if path == self.path or not os.path.exists(path):
+                continue
+            fd = self._lock(path)
+            if fd is None:
+                continue
+            try:
+                self._conn.execute("ATTACH DATABASE ? AS huerfano", (path,))
+                try:
+                    existe = self._conn.execute(
+                        "SELECT 1 FROM huerfano.sqlite_master WHERE type = 'table' AND name = 'spool'"
+                    ).fetchone()
+                    if existe:
+                        with self._conn:
+                            movidas += self._conn.execute(
+                                "INSERT INTO spool (target, payload)"
+                                " SELECT target, payload FROM huerfano.spool ORDER BY seq"
+                            ).rowcount
+                            self._conn.execute("DELETE FROM huerfano.spool")
+                finally:
+                    self._conn.execute("DETACH DATABASE huerfano")
+            finally:
+                os.close(fd)
+        return movidas
+
+    def _open(self) -> Tuple[int, int, Dict[str, int]]:
+        directorio = os.path.dirname(self.base_path)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        # Primer fichero libre: el lock se mantiene hasta cerrar
+        for slot in itertools.count():
+            self._lock_fd = self._lock(self._slot_path(slot))
+            if self._lock_fd is not None:
+                self.path = self._slot_path(slot)
+                break
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS spool ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " target TEXT NOT NULL,"
+            " payload BLOB NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS spool_target_seq ON spool (target, seq)")
+        conn.commit()
+        self._conn = conn
+        movidas = self._adopt_orphans()
+        if movidas:
+            logging.info(f"[spool] {movidas} entradas de ficheros sin dueño movidas a {self.path}")
+        entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM spool").fetchone()
+        backlog = dict(conn.execute("SELECT target, COUNT(*) FROM spool GROUP BY target").fetchall())
+        return entries, size, backlog
+
+    def _insert(self, rows: List[Tuple[str, bytes]]) -> None:
+        with self._conn:
+            self._conn.executemany("INSERT INTO spool (target, payload) VALUES (?, ?)", rows)
+
+    def _read(self, target: str, limit: int) -> List[Tuple[int, bytes]]:
+        return self._conn.execute(
+            "SELECT seq, payload FROM spool WHERE target = ? ORDER BY seq LIMIT ?", (target, limit)
+        ).fetchall()
+
+    def _delete(self, target: str, last_seq: int) -> None:
+        with self._conn:
+            self._conn.execute("DELETE FROM spool WHERE target = ? AND seq <= ?", (target, last_seq))
+
+    def _vacuum(self) -> None:
+        self._conn.execute("PRAGMA incremental_vacuum")
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    async def _call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    # --- Ciclo de vida ---
+    async def start(self) -> None:
+        self.entries, self.bytes, self._backlog = await self._call(self._open)
+        # Lo que quedó de una ejecución anterior se reenvía antes que lo nuevo
+        self._offline.update(self._backlog)
+        self._commit_task = asyncio.create_task(self._commit_loop())
+        self._replay_task = asyncio.create_task(self._replay_loop())
+
+    async def stop(self) -> None:
+        if self._replay_task is not None:
+            self._replay_task.cancel()
+            await asyncio.gather(self._replay_task, return_exceptions=True)
+            self._replay_task = None
+        # El bucle de commit termina tras escribir lo pendiente
+        if self._commit_task is not None:
+            self._closing = True
+            self._wakeup.set()
+            await self._commit_task
+            self._commit_task = None
+        await self._call(self._close)
+        self._executor.shutdown(wait=True)
+
+    # --- Escritura ---
+    def diverting(self, target: str) -> bool:
+        return target in self._offline
+
+    async def append(self, target: str, items: List[Any]) -> None:
+        """
+        Guarda `items` (líneas o documentos) para `target` y espera al commit.
+        Lanza BufferFullError si se superaría SPOOL_MAX_MB.
+        El destino pasa a desviarse al spool, así que solo deben llegar lotes
+        que se puedan reenviar: los rechazos permanentes (INFLUX_PERMANENT_ERRORS)
+        los descartan antes los writers.
+        """
+        if not items:
+            return
+        if self._closing:
+            raise RuntimeError("Spool cerrado")
+        if target.startswith("mongo:"):
+            rows = [(target, bson.encode(_with_id(doc))) for doc in items]
+        else:
+            rows = [(target, item.encode("utf-8")) for item in items]
+        size = sum(len(r[1]) for r in rows)
+        if self.bytes + self._pending_bytes + size > self.max_bytes:
+            self.dropped += len(rows)
+            raise BufferFullError(f"Spool lleno ({self.max_bytes} bytes)")
+
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.extend(rows)
+        self._pending_bytes += size
+        self._waiters.append(fut)
+        self._backlog[target] = self._backlog.get(target, 0) + len(rows)
+        self._offline.add(target)
+        self._wakeup.set()
+        await fut
+
+    async def _commit_loop(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            if not self._closing:
+                # Agrupa los appends que lleguen durante la ventana en un commit
+                await asyncio.sleep(SPOOL_FSYNC_INTERVAL_MS / 1000)
+            self._wakeup.clear()
+
+            rows, waiters, size = self._pending, self._waiters, self._pending_bytes
+            self._pending, self._waiters, self._pending_bytes = [], [], 0
+            if rows:
+                try:
+                    await self._call(self._insert, rows)
+                    self.entries += len(rows)
+                    self.bytes += size
+                    self.appended += len(rows)
+                    self.commits += 1
+                    for fut in waiters:
+                        if not fut.done():
+                            fut.set_result(None)
+                except Exception as e:
+                    logging.error(f"[spool] Error escribiendo {len(rows)} entradas en disco: {e!r}")
+                    for target, _ in rows:
+                        self._backlog[target] -= 1
+                    for fut in waiters:
+                        if not fut.done():
+                            fut.set_exception(e)
+            if self._closing and not self._pending:
+                return
+
+    # --- Reenvío ---
+    async def _replay_loop(self) -> None:
+        while True:
+            await asyncio.sleep(SPOOL_REPLAY_INTERVAL_S)
+            for target in list(self._offline):
+                try:
+                    await self.replay(target)
+                except Exception as e:
+                    logging.error(f"[spool] Error reenviando {target}: {e!r}")
+
+    async def replay(self, target: str) -> int:
+        """
+        Reenvía las entradas de `target` en orden de llegada, por lotes de
+        SPOOL_REPLAY_BATCH. Para en el primer lote que falle; si se vacía,
+        el destino deja de desviarse al spool.
+        """
+        enviados = 0
+        while True:
+            rows = await self._call(self._read, target, SPOOL_REPLAY_BATCH)
+            if not rows:
+                break
+            if not await _send(target, [payload for _, payload in rows]):
+                if enviados:
+                    logging.info(f"[spool] {enviados} entradas reenviadas a {target}; el destino volvió a fallar")
+                return enviados
+            await self._call(self._delete, target, rows[-1][0])
+            self._backlog[target] = self._backlog.get(target, 0) - len(rows)
+            self.entries -= len(rows)
+            self.bytes -= sum(len(payload) for _, payload in rows)
+            self.replayed += len(rows)
+            enviados += len(rows)
+            if len(rows) < SPOOL_REPLAY_BATCH:
+                break
+
+        # Sin atrasos (ni appends en cola o en pleno commit): se vuelve a escribir directo
+        if self._backlog.get(target, 0) <= 0:
+            self._backlog.pop(target, None)
+            self._offline.discard(target)
+        if enviados:
+            await self._call(self._vacuum)
+            logging.info(f"[spool] {enviados} entradas reenviadas a {target}")
+        return enviados
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": self.entries,
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "appended": self.appended,
+            "replayed": self.replayed,
+            "dropped": self.dropped,
+            "commits": self.commits,
+            "diverting": sorted(self._offline),
+        }
+
+
+def _with_id(doc: Dict[str, Any]) -> Dict[str, Any]:
+    # _id fijo: reenviar el documento no lo duplica
+    if "_id" not in doc:
+        doc["_id"] = ObjectId()
+    return doc
+
+
+# Colecciones sin _id único: el reenvío comprueba antes qué documentos ya están
+_TIMESERIES_COLLECTIONS = {MEASUREMENTS_COLLECTION} if MEASUREMENTS_TIMESERIES else set()
+
+
+async def _send(target: str, payloads: List[bytes]) -> bool:
+    """Escribe un lote reenviado; False si el destino sigue sin estar disponible."""
+    kind, _, name = target.partition(":")
+    if kind == "influx":
+        try:
+            resp = await post_lines_to_influx([p.decode("utf-8") for p in payloads], name or None)
+        except Exception as e:
+            logging.debug("[spool] Influx no disponible: %r", e)
+            return False
+        if resp.status_code in INFLUX_PERMANENT_ERRORS:
+            logging.error(f"[spool] Influx rechazó {len(payloads)} líneas ({resp.status_code} {resp.text}); se descartan")
+            return True
+        return resp.status_code == 204
+
+    if kind == "mongo":
+        db = get_db()
+        if db is None:
+            return False
+        docs = [bson.decode(p) for p in payloads]
+        try:
+            if name in _TIMESERIES_COLLECTIONS:
+                docs = await not_yet_inserted(db[name], docs)
+            if docs:
+                await db[name].insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # 11000 = ya insertado en un intento anterior
+            errores = [w for w in e.details.get("writeErrors", []) if w.get("code") != 11000]
+            if errores:
+                logging.error(f"[spool] {len(errores)} documentos rechazados por {name}; se descartan")
+        except PyMongoError as e:
+            logging.debug("[spool] MongoDB no disponible: %r", e)
+            return False
+        return True
+
+    logging.error(f"[spool] Destino desconocido '{target}': {len(payloads)} entradas descartadas")
+    return True
+
+
+disk_spool: Optional[DiskSpool] = None
+
+async def start_spool() -> None:
+    global disk_spool
+    if SPOOL_ENABLED and disk_spool is None:
+        disk_spool = DiskSpool()
+        await disk_spool.start()
+        batching.set_spool(disk_spool)
+        logging.info(f"[spool] Spool local en {disk_spool.path} ({disk_spool.entries} entradas pendientes)")
+
+async def stop_spool() -> None:
+    global disk_spool
+    if disk_spool is not None:
+        batching.set_spool(None)
+        await disk_spool.stop()
+        disk_spool = None
+        logging.info("[spool] Spool local cerrado")
+
+def get_spool() -> Optional[DiskSpool]:
+    return disk_spool
+
+
+async def spill(target: str, items: List[Any]) -> bool:
+    """
+    Guarda en el spool lo que no se pudo escribir. Devuelve False si el
+    spool está desactivado o lleno (el llamador mantiene su error).
+    """
+    if disk_spool is None:
+        return False
+    try:
+        await disk_spool.append(target, items)
+        return True
+    except (BufferFullError, RuntimeError, sqlite3.Error) as e:
+        logging.error(f"[spool] No se pudieron guardar {len(items)} entradas de {target}: {e!r}")
+        return False
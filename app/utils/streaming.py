@@ -0,0 +1,79 @@
+from collections import deque
+from typing import Optional
+
+# ---------------------------------------------------
+# Agregados en streaming
+# ---------------------------------------------------
+
+AGGREGATES = ("mean", "min", "max", "count")
+
+
+class SlidingWindow:
+    """
+    Ventana deslizante por tiempo (`window_s` segundos) con mean/min/max/count
+    incrementales. Cada `add` es O(1) amortizado: la suma se mantiene al
+    vuelo y min/max con deques monótonas. La memoria está acotada por
+    `max_samples`: si se supera, se descartan las muestras más antiguas.
+    """
+
+    __slots__ = ("window_s", "max_samples", "_samples", "_min", "_max", "_sum", "_seq")
+
+    def __init__(self, window_s: float, max_samples: int = 10000):
+        self.window_s = window_s
+        self.max_samples = max_samples
+        self._samples: deque = deque()   # (seq, ts, value)
+        self._min: deque = deque()       # (seq, value) con valores crecientes
+        self._max: deque = deque()       # (seq, value) con valores decrecientes
+        self._sum = 0.0
+        self._seq = 0
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def add(self, ts: float, value: float) -> None:
+        self._seq += 1
+        seq = self._seq
+        self._samples.append((seq, ts, value))
+        self._sum += value
+
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((seq, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((seq, value))
+
+        self._expire(ts - self.window_s)
+        while len(self._samples) > self.max_samples:
+            self._pop_oldest()
+
+    def _expire(self, limite: float) -> None:
+        while self._samples and self._samples[0][1] <= limite:
+            self._pop_oldest()
+
+    def _pop_oldest(self) -> None:
+        seq, _, value = self._samples.popleft()
+        self._sum -= value
+        if self._min and self._min[0][0] == seq:
+            self._min.popleft()
+        if self._max and self._max[0][0] == seq:
+            self._max.popleft()
+
+    @property
+    def count(self) -> int:
+        return len(self._samples)
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self._sum / len(self._samples) if self._samples else None
+
+    @property
+    def min(self) -> Optional[float]:
+        return self._min[0][1] if self._min else None
+
+    @property
+    def max(self) -> Optional[float]:
+        return self._max[0][1] if self._max else None
+
+    def aggregate(self, name: str) -> Optional[float]:
+        return getattr(self, name)
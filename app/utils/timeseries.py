@@ -0,0 +1,233 @@
+import os
+import socket
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+
+# ---------------------------------------------------
+# measurements como colección time-series (MongoDB >= 5.0)
+# ---------------------------------------------------
+# Cada muestra se guarda como {timestamp, meta: {username, device_id,
+# variable_id}, value}: Mongo agrupa internamente las muestras de una misma
+# serie en buckets comprimidos en lugar de repetir las cadenas por documento.
+MEASUREMENTS_COLLECTION = "measurements"
+MEASUREMENTS_TIMESERIES = os.getenv("MEASUREMENTS_TIMESERIES", "true").lower() in ("1", "true", "yes")
+MEASUREMENTS_GRANULARITY = os.getenv("MEASUREMENTS_GRANULARITY", "seconds")
+# Retención en días; 0 = sin caducidad
+MEASUREMENTS_TTL_DAYS = float(os.getenv("MEASUREMENTS_TTL_DAYS", 90))
+
+# Migración desde la colección plana anterior
+LEGACY_COLLECTION = "measurements_legacy"
+MIGRATION_BATCH_SIZE = int(os.getenv("MEASUREMENTS_MIGRATION_BATCH_SIZE", 5000))
+MIGRATION_ID = "measurements_timeseries"
+# Solo un proceso migra: el que tiene el lease (se renueva en cada lote)
+MIGRATION_LEASE_S = float(os.getenv("MEASUREMENTS_MIGRATION_LEASE_S", 60))
+MIGRATION_OWNER = f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _expire_after_seconds() -> Optional[int]:
+    return int(MEASUREMENTS_TTL_DAYS * 86400) if MEASUREMENTS_TTL_DAYS > 0 else None
+
+
+async def _collection_options(db, name: str) -> Optional[Dict[str, Any]]:
+    async for info in db.list_collections(filter={"name": name}):
+        return info.get("options", {})
+    return None
+
+
+async def ensure_measurements_collection(db) -> None:
+    """
+    Crea `measurements` como time-series si no existe, ajusta la retención
+    si cambió y, si existe como colección plana, la renombra a
+    `measurements_legacy` para migrarla en segundo plano.
+    Debe ejecutarse antes de crear los índices de la colección.
+    """
+    if not MEASUREMENTS_TIMESERIES:
+        return
+
+    expire = _expire_after_seconds()
+    options = await _collection_options(db, MEASUREMENTS_COLLECTION)
+
+    if options is not None and "timeseries" not in options:
+        if await _collection_options(db, LEGACY_COLLECTION) is not None:
+            logging.error(
+                f"[timeseries] Existen '{MEASUREMENTS_COLLECTION}' plana y '{LEGACY_COLLECTION}': "
+                "revisar la migración a time-series"
+            )
+            return
+        await db[MEASUREMENTS_COLLECTION].rename(LEGACY_COLLECTION)
+        logging.info(f"[timeseries] '{MEASUREMENTS_COLLECTION}' plana renombrada a '{LEGACY_COLLECTION}'")
+        options = None
+
+    if options is None:
+        kwargs = {
+            "timeseries": {
+                "timeField": "timestamp",
+                "metaField": "meta",
+                "granularity": MEASUREMENTS_GRANULARITY,
+            }
+        }
+        if expire is not None:
+            kwargs["expireAfterSeconds"] = expire
+        await db.create_collection(MEASUREMENTS_COLLECTION, **kwargs)
+        logging.info(f"[timeseries] Colección time-series '{MEASUREMENTS_COLLECTION}' creada (TTL={expire}s)")
+        return
+
+    if options.get("expireAfterSeconds") != expire:
+        await db.command({"collMod": MEASUREMENTS_COLLECTION, "expireAfterSeconds": expire or "off"})
+        logging.info(f"[timeseries] Retención de '{MEASUREMENTS_COLLECTION}' actualizada a {expire}s")
+
+
+def legacy_to_timeseries(doc: Dict[str, Any]) -> Dict[str, Any]:
+    # Conserva el _id: un lote recopiado se reconoce por él
+    return {
+        "_id": doc["_id"],
+        "timestamp": doc["timestamp"],
+        "meta": {
+            "username": doc.get("username"),
+            "device_id": doc.get("device_id"),
+            "variable_id": doc.get("variable_id"),
+        },
+        "value": doc.get("value"),
+    }
+
+
+async def not_yet_inserted(collection, docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Documentos cuyo _id aún no está en una colección time-series (que no
+    impone _id único), p.ej. tras un insert_many interrumpido. El rango de
+    timestamp limita la búsqueda a los buckets del lote.
+    """
+    if not docs:
+        return docs
+    tiempos = [d["timestamp"] for d in docs]
+    existentes = set()
+    cursor = collection.find(
+        {"_id": {"$in": [d["_id"] for d in docs]}, "timestamp": {"$gte": min(tiempos), "$lte": max(tiempos)}},
+        {"_id": 1}
+    )
+    async for doc in cursor:
+        existentes.add(doc["_id"])
+    return [d for d in docs if d["_id"] not in existentes]
+
+
+class MigrationLeaseLost(Exception):
+    pass
+
+
+async def _acquire_lease(db) -> Optional[Dict[str, Any]]:
+    """
+    Toma (o renueva) el lease de la migración en `migrations` con una
+    operación atómica. None si lo tiene otro proceso o ya terminó.
+    """
+    ahora = datetime.utcnow()
+    try:
+        return await db["migrations"].find_one_and_update(
+            {
+                "_id": MIGRATION_ID,
+                "done": {"$ne": True},
+                "$or": [{"owner": MIGRATION_OWNER}, {"lease_until": {"$not": {"$gt": ahora}}}],
+            },
+            {"$set": {"owner": MIGRATION_OWNER, "lease_until": ahora + timedelta(seconds=MIGRATION_LEASE_S)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # El documento existe pero no cumple el filtro: lease ajeno o migración hecha
+        return None
+
+
+async def migrate_legacy_measurements(db) -> int:
+    """
+    Copia `measurements_legacy` a la colección time-series por lotes en
+    orden de _id. Solo migra el proceso que tiene el lease en `migrations`
+    (se renueva en cada lote); el progreso se guarda junto a él, así que
+    una migración interrumpida continúa donde quedó. La colección antigua
+    no se borra: se deja para que el operador la elimine tras verificar.
+    """
+    if await _collection_options(db, LEGACY_COLLECTION) is None:
+        return 0
+
+    estado = await _acquire_lease(db)
+    if estado is None:
+        return 0
+
+    filtro = {"_id": {"$gt": estado["last_id"]}} if estado.get("last_id") else {}
+    copiados = 0
+    batch = []
+    cursor = db[LEGACY_COLLECTION].find(filtro).sort("_id", 1).batch_size(MIGRATION_BATCH_SIZE)
+    async for doc in cursor:
+        if doc.get("timestamp") is not None:
+            batch.append(legacy_to_timeseries(doc))
+        last_id = doc["_id"]
+        if len(batch) >= MIGRATION_BATCH_SIZE:
+            copiados += await _copiar_lote(db, batch, last_id)
+            batch = []
+    if batch:
+        copiados += await _copiar_lote(db, batch, last_id)
+
+    await db["migrations"].update_one(
+        {"_id": MIGRATION_ID, "owner": MIGRATION_OWNER},
+        {"$set": {"done": True}, "$unset": {"lease_until": ""}}
+    )
+    logging.info(
+        f"[timeseries] Migración completada: {copiados} muestras copiadas; "
+        f"'{LEGACY_COLLECTION}' puede eliminarse"
+    )
+    return copiados
+
+
+async def _copiar_lote(db, batch, last_id) -> int:
+    # Un lote ya copiado en parte (caída antes de guardar last_id) no se duplica
+    pendientes = await not_yet_inserted(db[MEASUREMENTS_COLLECTION], batch)
+    if pendientes:
+        try:
+            await db[MEASUREMENTS_COLLECTION].insert_many(pendientes, ordered=False)
+        except BulkWriteError as e:
+            logging.warning(f"[timeseries] Lote migrado con {len(e.details.get('writeErrors', []))} errores")
+    resultado = await db["migrations"].update_one(
+        {"_id": MIGRATION_ID, "owner": MIGRATION_OWNER},
+        {"$set": {
+            "last_id": last_id,
+            "lease_until": datetime.utcnow() + timedelta(seconds=MIGRATION_LEASE_S)
+        }}
+    )
+    if resultado.matched_count == 0:
+        raise MigrationLeaseLost("Lease de la migración tomado por otro proceso")
+    return len(pendientes)
+
+
+_migration_task: Optional[asyncio.Task] = None
+
+async def _run_migration(db) -> None:
+    # Si el proceso que migra cae, otro toma el lease cuando caduca
+    while True:
+        try:
+            await migrate_legacy_measurements(db)
+            estado = await db["migrations"].find_one({"_id": MIGRATION_ID}, {"done": 1})
+            if estado is None or estado.get("done") or await _collection_options(db, LEGACY_COLLECTION) is None:
+                return
+        except MigrationLeaseLost as e:
+            logging.warning(f"[timeseries] {e}")
+        except PyMongoError as e:
+            logging.error(f"[timeseries] Error migrando measurements: {e!r}")
+        await asyncio.sleep(MIGRATION_LEASE_S)
+
+def start_measurements_migration(db) -> None:
+    global _migration_task
+    if MEASUREMENTS_TIMESERIES and db is not None:
+        _migration_task = asyncio.create_task(_run_migration(db))
+
+async def stop_measurements_migration() -> None:
+    global _migration_task
+    if _migration_task is not None and not _migration_task.done():
+        _migration_task.cancel()
+        try:
+            await _migration_task
+        except asyncio.CancelledError:
+            pass
+    _migration_task = None
@@ -0,0 +1,19 @@
+import re
+from typing import Tuple
+
+# ---------------------------------------------------
+# Parser de topics de datos: iot/{username}/{device_id}/{variable_id}/sdata
+# ---------------------------------------------------
+# Cada segmento es no vacío y no puede contener "/", "+" ni "#".
+SDATA_TOPIC_RE = re.compile(r"iot/([^/+#]+)/([^/+#]+)/([^/+#]+)/sdata")
+
+
+def parse_sdata_topic(topic: str) -> Tuple[str, str, str]:
+    """
+    Devuelve (username, device_id, variable_id) de un topic de datos.
+    Lanza ValueError si el topic no sigue el formato esperado.
+    """
+    match = SDATA_TOPIC_RE.fullmatch(topic) if isinstance(topic, str) else None
+    if match is None:
+        raise ValueError("Formato de topic inválido")
+    return match.groups()
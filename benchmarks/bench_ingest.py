@@ -0,0 +1,277 @@
+"""
+Benchmark de ingesta de /saver-webhook, /saver-webhook/batch y
+/alarms-webhook sin el stack de docker-compose: la API corre en proceso
+(ASGI) contra sustitutos locales de Influx, EMQX y MongoDB
+(benchmarks/fakes.py) y un generador de carga con concurrencia fija
+reproduce una mezcla de topics/payloads generada con semilla fija.
+Imprime un JSON con mensajes/s, latencias p50/p99 y CPU por mensaje.
+
+Uso:
+    python -m benchmarks.bench_ingest [--scenario saver|saver-batch|alarms|mix]
+        [--concurrency 32] [--duration 10 | --requests 20000] [--batch-size 100]
+        [--users 10] [--devices 20] [--variables 5]
+        [--influx-latency-ms 0] [--mongo-latency-ms 0]
+        [--save-rule-mode device] [--alarm-engine emqx] [--output resultados.json]
+
+Con --url se mide una API ya desplegada (sin sustitutos ni contadores de backend).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from benchmarks.fakes import FakeDatabase, FakeEmqx, FakeInflux, seed_fleet
+
+Request = Tuple[str, str, bytes, Dict[str, str], int]  # (endpoint, path, body, headers, mensajes)
+
+
+def generar_peticiones(args, series: List[Tuple[str, str, str]], n: int = 5000) -> List[Request]:
+    """
+    Mezcla reproducible de peticiones: cada serie sigue un paseo aleatorio,
+    una de cada diez muestras es entera y los lotes mezclan series como un
+    gateway que reenvía datos retenidos (con timestamp propio).
+    """
+    rnd = random.Random(args.seed)
+    valores = {s: rnd.uniform(10, 30) for s in series}
+    json_h = {"content-type": "application/json"}
+
+    def muestra(serie):
+        valores[serie] += rnd.gauss(0, 0.5)
+        valor = round(valores[serie], 3) if rnd.random() > 0.1 else int(valores[serie])
+        username, device_id, variable_id = serie
+        return f"iot/{username}/{device_id}/{variable_id}/sdata", {"value": valor, "save": 1}
+
+    pesos = {
+        "saver": {"saver": 1},
+        "saver-batch": {"saver-batch": 1},
+        "alarms": {"alarms": 1},
+        "mix": {"saver": 0.90, "saver-batch": 0.05, "alarms": 0.05},
+    }[args.scenario]
+    tipos, probabilidades = zip(*pesos.items())
+
+    peticiones: List[Request] = []
+    ahora_ms = int(time.time() * 1000)
+    for _ in range(n):
+        tipo = rnd.choices(tipos, probabilidades)[0]
+        if tipo == "saver":
+            topic, payload = muestra(rnd.choice(series))
+            body = json.dumps({"topic": topic, "payload": json.dumps(payload)})
+            peticiones.append(("saver", "/saver-webhook", body.encode(), json_h, 1))
+        elif tipo == "saver-batch":
+            lineas = []
+            for i in range(args.batch_size):
+                topic, payload = muestra(rnd.choice(series))
+                lineas.append(json.dumps({"topic": topic, "payload": payload, "timestamp": ahora_ms - i * 1000}))
+            body = "\n".join(lineas)
+            peticiones.append(("saver-batch", "/saver-webhook/batch", body.encode(),
+                               {"content-type": "application/x-ndjson"}, args.batch_size))
+        else:
+            topic, payload = muestra(rnd.choice(series))
+            body = json.dumps({"topic": topic, "value": payload["value"] + 50})
+            peticiones.append(("alarms", "/alarms-webhook", body.encode(), json_h, 1))
+    return peticiones
+
+
+def percentil(ordenados: List[float], p: float) -> float:
+    if not ordenados:
+        return 0.0
+    return ordenados[min(len(ordenados) - 1, max(0, int(round(p / 100 * len(ordenados) + 0.5)) - 1))]
+
+
+async def generar_carga(client: httpx.AsyncClient, peticiones: List[Request], args) -> Dict[str, Any]:
+    latencias: Dict[str, List[float]] = {}
+    estados: Counter = Counter()
+    mensajes = 0
+    enviadas = 0
+    siguiente = iter(range(sys.maxsize))
+    fin = time.perf_counter() + args.duration if not args.requests else None
+
+    async def worker():
+        nonlocal mensajes, enviadas
+        while True:
+            i = next(siguiente)
+            if (args.requests and i >= args.requests) or (fin is not None and time.perf_counter() >= fin):
+                return
+            endpoint, path, body, headers, n = peticiones[i % len(peticiones)]
+            inicio = time.perf_counter()
+            try:
+                resp = await client.post(path, content=body, headers=headers)
+                estado = str(resp.status_code)
+            except httpx.HTTPError as e:
+                estado = type(e).__name__
+            latencias.setdefault(endpoint, []).append(time.perf_counter() - inicio)
+            estados[estado] += 1
+            enviadas += 1
+            if estado == "200":
+                mensajes += n
+
+    cpu = time.process_time()
+    inicio = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - inicio
+    cpu = time.process_time() - cpu
+
+    todas = sorted(l for ls in latencias.values() for l in ls)
+
+    def resumen(ls: List[float]) -> Dict[str, float]:
+        ls = sorted(ls)
+        return {
+            "count": len(ls),
+            "p50_ms": round(percentil(ls, 50) * 1000, 3),
+            "p90_ms": round(percentil(ls, 90) * 1000, 3),
+            "p99_ms": round(percentil(ls, 99) * 1000, 3),
+            "max_ms": round(ls[-1] * 1000, 3) if ls else 0.0,
+            "mean_ms": round(sum(ls) / len(ls) * 1000, 3) if ls else 0.0,
+        }
+
+    return {
+        "requests": enviadas,
+        "messages": mensajes,
+        "status": dict(estados),
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(enviadas / elapsed, 1) if elapsed else 0.0,
+        "messages_per_s": round(mensajes / elapsed, 1) if elapsed else 0.0,
+        "latency": resumen(todas),
+        "latency_by_endpoint": {e: resumen(ls) for e, ls in latencias.items()},
+        "cpu_s": round(cpu, 3),
+        "cpu_us_per_msg": round(cpu / mensajes * 1e6, 2) if mensajes else None,
+    }
+
+
+async def bench_en_proceso(args) -> Dict[str, Any]:
+    influx = FakeInflux(args.influx_latency_ms / 1000)
+    emqx = FakeEmqx(args.emqx_latency_ms / 1000)
+    await influx.start()
+    await emqx.start()
+
+    # Los módulos de la API leen su configuración al importarse
+    os.environ.update({
+        "INFLUX_URL": influx.url,
+        "INFLUX_AUTH_TOKEN": "bench",
+        "EMQX_API_BASE": f"{emqx.url}/api/v4",
+        "SAVE_RULE_MODE": args.save_rule_mode,
+        "ALARM_ENGINE": args.alarm_engine,
+        "INGEST_MODE": "webhook",
+        "SPOOL_ENABLED": "false",
+        "LATEST_SNAPSHOT_ENABLED": "false",
+        # Los rollups son tareas de Influx, fuera del camino de ingesta
+        "ROLLUPS_ENABLED": "false",
+    })
+    from app.utils import db as db_module
+    from app.apis import emqx_api
+    from app.main import app
+    from app.utils.http_clients import init_http_clients, close_http_clients
+    from app.utils.mongo_buffer import start_mongo_buffers, stop_mongo_buffers
+    from app.utils.device_registry import device_registry
+    from app.utils.rules_loader import cargar_alarm_rules_desde_mongo, reconciliar_reglas_emqx
+    from app.apis.influx_api import start_influx_writer, stop_influx_writer
+    from app.utils.rollups import start_rollups, stop_rollups
+
+    # influx_api recarga .env con override: se fijan de nuevo los destinos locales
+    os.environ["INFLUX_URL"] = influx.url
+    os.environ["INFLUX_AUTH_TOKEN"] = "bench"
+    emqx_api.EMQX_API_BASE = f"{emqx.url}/api/v4"
+
+    db = FakeDatabase(args.mongo_latency_ms / 1000)
+    db_module.db = db
+    series = seed_fleet(db, args.users, args.devices, args.variables)
+
+    setup: Dict[str, float] = {}
+    await init_http_clients()
+    inicio = time.perf_counter()
+    await emqx_api.init_emqx_resources()
+    await device_registry.load_from_mongo()
+    await cargar_alarm_rules_desde_mongo()
+    await reconciliar_reglas_emqx()
+    setup["emqx_reconcile_s"] = round(time.perf_counter() - inicio, 3)
+    await start_mongo_buffers()
+    await start_influx_writer()
+    await start_rollups()
+
+    peticiones = generar_peticiones(args, series)
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://api") as client:
+            resultado = await generar_carga(client, peticiones, args)
+    finally:
+        # Vaciar los buffers para contar todo lo que llegó a los backends
+        await stop_rollups()
+        await stop_influx_writer()
+        await stop_mongo_buffers()
+        await close_http_clients()
+        await influx.stop()
+        await emqx.stop()
+
+    resultado["setup"] = setup
+    resultado["backends"] = {
+        "influx_requests": influx.requests,
+        "influx_lines": influx.lines,
+        "emqx_requests": emqx.requests,
+        "emqx_rules": len(emqx.rules),
+        "mongo_docs": db.counts(),
+    }
+    # El proceso incluye API, generador de carga y sustitutos
+    resultado["cpu_scope"] = "api+loadgen+fakes"
+    return resultado
+
+
+async def bench_remoto(args) -> Dict[str, Any]:
+    rnd_series = [(f"user{u}", f"dev{d}", f"var{v}")
+                  for u in range(args.users) for d in range(args.devices) for v in range(args.variables)]
+    peticiones = generar_peticiones(args, rnd_series)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=30) as client:
+        resultado = await generar_carga(client, peticiones, args)
+    resultado["cpu_scope"] = "loadgen"
+    return resultado
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenario", choices=["saver", "saver-batch", "alarms", "mix"], default="saver")
+    parser.add_argument("--concurrency", type=int, default=32, help="peticiones simultáneas")
+    parser.add_argument("--duration", type=float, default=10, help="segundos de carga")
+    parser.add_argument("--requests", type=int, default=0, help="número fijo de peticiones (en lugar de --duration)")
+    parser.add_argument("--batch-size", type=int, default=100, help="registros por petición en saver-batch")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--devices", type=int, default=20, help="dispositivos por usuario")
+    parser.add_argument("--variables", type=int, default=5, help="variables por dispositivo")
+    parser.add_argument("--influx-latency-ms", type=float, default=0)
+    parser.add_argument("--emqx-latency-ms", type=float, default=0)
+    parser.add_argument("--mongo-latency-ms", type=float, default=0)
+    parser.add_argument("--save-rule-mode", choices=["device", "tenant", "global"], default="device")
+    parser.add_argument("--alarm-engine", choices=["emqx", "local"], default="emqx")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--url", help="API ya desplegada (p.ej. http://localhost:8000)")
+    parser.add_argument("--output", help="fichero donde guardar el JSON además de imprimirlo")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level, force=True)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    resultado = asyncio.run(bench_remoto(args) if args.url else bench_en_proceso(args))
+    salida = {
+        "benchmark": "ingest",
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "log_level")},
+        "python": sys.version.split()[0],
+        **resultado,
+    }
+    texto = json.dumps(salida, indent=2)
+    print(texto)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(texto + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Micro-benchmark del decodificado del saver-webhook: coste de CPU por
+mensaje del camino anterior (json + split + logs con f-string) frente al
+camino rápido (decode_saver_body: orjson opcional + regex de topic).
+
+Uso:
+    python -m benchmarks.bench_webhook_decode [-n 200000] [--log-level WARNING]
+"""
+import argparse
+import io
+import json
+import logging
+import time
+from datetime import datetime
+
+from app.utils import fastjson
+from app.utils.ingest import decode_saver_body, build_measurement_doc
+
+
+def legacy_decode(raw: bytes):
+    # Reproduce el handler original paso a paso
+    body = json.loads(raw)
+    logging.info("Saver webhook payload raw = %r", body)
+    topic = body.get("topic")
+    payload = json.loads(body.get("payload"))
+    value = payload.get("value")
+    parts = topic.split("/")
+    username, device_id, variable_id = parts[1], parts[2], parts[3]
+    logging.info(f"username: {username}, device_id: {device_id}, variable_id: {variable_id}")
+    doc = {
+        "username": username,
+        "device_id": device_id,
+        "variable_id": variable_id,
+        "value": value,
+        "topic": topic,
+        "timestamp": datetime.utcnow()
+    }
+    logging.info("data save: %r", doc)
+    return doc
+
+
+def fast_decode(raw: bytes):
+    return build_measurement_doc(decode_saver_body(raw))
+
+
+def medir(fn, mensajes, n: int) -> float:
+    total = len(mensajes)
+    start = time.process_time()
+    for i in range(n):
+        fn(mensajes[i % total])
+    return (time.process_time() - start) / n * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", type=int, default=200000, help="mensajes por caso")
+    parser.add_argument("--log-level", default="INFO", help="nivel de logging durante la medida")
+    args = parser.parse_args()
+
+    # Los logs van a un buffer en memoria: se mide el formateo, no la E/S
+    logging.basicConfig(level=args.log_level, stream=io.StringIO(), force=True)
+
+    mensajes = [
+        json.dumps({
+            "username": f"user{i % 10}",
+            "topic": f"iot/user{i % 10}/dev{i % 100}/var{i % 7}/sdata",
+            "payload": json.dumps({"value": 20.0 + i % 50 / 10, "save": 1})
+        }).encode()
+        for i in range(1000)
+    ]
+
+    antes = medir(legacy_decode, mensajes, args.n)
+    despues = medir(fast_decode, mensajes, args.n)
+    print(json.dumps({
+        "json_backend": fastjson.JSON_BACKEND,
+        "log_level": args.log_level,
+        "messages": args.n,
+        "legacy_us_per_msg": round(antes, 2),
+        "fast_us_per_msg": round(despues, 2),
+        "speedup": round(antes / despues, 2)
+    }))
+
+
+if __name__ == "__main__":
+    main()
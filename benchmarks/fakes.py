@@ -0,0 +1,324 @@
+"""
+Sustitutos locales de los backends para los benchmarks: un sumidero de
+/api/v2/write de Influx y un stub de la API de gestión de EMQX (servidores
+aiohttp en localhost) y una base de datos MongoDB en memoria con la
+interfaz async de Motor que usa la API.
+"""
+import asyncio
+import itertools
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import web
+from bson.objectid import ObjectId
+
+
+# ---------------------------------------------------
+# Servidores HTTP
+# ---------------------------------------------------
+class FakeServer:
+    """Servidor aiohttp en un puerto libre de 127.0.0.1; `latency_s` retrasa cada respuesta."""
+
+    def __init__(self, latency_s: float = 0.0):
+        self.latency_s = latency_s
+        self.requests = 0
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self._runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+    async def start(self) -> str:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _delay(self) -> None:
+        self.requests += 1
+        if self.latency_s:
+            await asyncio.sleep(self.latency_s)
+
+
+class FakeInflux(FakeServer):
+    """Acepta escrituras de protocolo de línea y solo cuenta líneas y bytes."""
+
+    def __init__(self, latency_s: float = 0.0):
+        super().__init__(latency_s)
+        self.lines = 0
+        self.bytes = 0
+        self.app.router.add_post("/api/v2/write", self._write)
+        self.app.router.add_get("/health", self._health)
+
+    async def _write(self, request: web.Request) -> web.Response:
+        await self._delay()
+        body = await request.read()
+        self.bytes += len(body)
+        self.lines += body.count(b"\n") + 1 if body else 0
+        return web.Response(status=204)
+
+    async def _health(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "pass"})
+
+
+class FakeEmqx(FakeServer):
+    """Recursos y reglas de la API v4 de EMQX guardados en memoria."""
+
+    def __init__(self, latency_s: float = 0.0):
+        super().__init__(latency_s)
+        self.resources: Dict[str, Dict[str, Any]] = {}
+        self.rules: Dict[str, Dict[str, Any]] = {}
+        self._ids = itertools.count(1)
+        r = self.app.router
+        r.add_get("/api/v4/resources", self._list_resources)
+        r.add_post("/api/v4/resources", self._create_resource)
+        r.add_get("/api/v4/rules", self._list_rules)
+        r.add_post("/api/v4/rules", self._create_rule)
+        r.add_put("/api/v4/rules/{rule_id}", self._update_rule)
+        r.add_delete("/api/v4/rules/{rule_id}", self._delete_rule)
+
+    async def _list_resources(self, request: web.Request) -> web.Response:
+        await self._delay()
+        return web.json_response({"code": 0, "data": list(self.resources.values())})
+
+    async def _create_resource(self, request: web.Request) -> web.Response:
+        await self._delay()
+        resource = {**await request.json(), "id": f"resource:{next(self._ids)}"}
+        self.resources[resource["id"]] = resource
+        return web.json_response({"code": 0, "data": resource})
+
+    async def _list_rules(self, request: web.Request) -> web.Response:
+        await self._delay()
+        page = int(request.query.get("_page", 1))
+        limit = int(request.query.get("_limit", 10000))
+        rules = list(self.rules.values())[(page - 1) * limit:page * limit]
+        return web.json_response({"code": 0, "data": rules, "meta": {"page": page, "limit": limit, "count": len(self.rules)}})
+
+    async def _create_rule(self, request: web.Request) -> web.Response:
+        await self._delay()
+        rule = {**await request.json(), "id": f"rule:{next(self._ids)}"}
+        self.rules[rule["id"]] = rule
+        return web.json_response({"code": 0, "data": rule})
+
+    async def _update_rule(self, request: web.Request) -> web.Response:
+        await self._delay()
+        rule_id = request.match_info["rule_id"]
+        if rule_id not in self.rules:
+            return web.json_response({"code": 404, "message": "Not Found"}, status=404)
+        self.rules[rule_id] = {**await request.json(), "id": rule_id}
+        return web.json_response({"code": 0, "data": self.rules[rule_id]})
+
+    async def _delete_rule(self, request: web.Request) -> web.Response:
+        await self._delay()
+        self.rules.pop(request.match_info["rule_id"], None)
+        return web.json_response({"code": 0})
+
+
+# ---------------------------------------------------
+# MongoDB en memoria
+# ---------------------------------------------------
+def _get(doc: Dict[str, Any], path: str) -> Any:
+    for part in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+def _matches(doc: Dict[str, Any], filtro: Dict[str, Any]) -> bool:
+    for key, cond in filtro.items():
+        value = _get(doc, key)
+        if isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond):
+            for op, arg in cond.items():
+                if op == "$in" and value not in arg:
+                    return False
+                if op == "$gt" and not (value is not None and value > arg):
+                    return False
+                if op == "$ne" and value == arg:
+                    return False
+                if op == "$exists" and (value is not None) != bool(arg):
+                    return False
+        elif value != cond:
+            return False
+    return True
+
+
+def _project(doc: Dict[str, Any], projection: Optional[Dict[str, int]]) -> Dict[str, Any]:
+    if not projection:
+        return dict(doc)
+    incluidos = [k for k, v in projection.items() if v and k != "_id"]
+    if incluidos:
+        out = {k: doc[k] for k in incluidos if k in doc}
+        if projection.get("_id", 1) and "_id" in doc:
+            out["_id"] = doc["_id"]
+        return out
+    return {k: v for k, v in doc.items() if projection.get(k, 1)}
+
+
+class _Result:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeCursor:
+
+    def __init__(self, docs: List[Dict[str, Any]]):
+        self._docs = docs
+        self._limit = 0
+
+    def sort(self, key, direction: int = 1) -> "FakeCursor":
+        self._docs.sort(key=lambda d: (_get(d, key) is None, _get(d, key)), reverse=direction < 0)
+        return self
+
+    def limit(self, n: int) -> "FakeCursor":
+        self._limit = n
+        return self
+
+    def batch_size(self, n: int) -> "FakeCursor":
+        return self
+
+    def _result(self) -> List[Dict[str, Any]]:
+        return self._docs[:self._limit] if self._limit else self._docs
+
+    async def to_list(self, length: Optional[int] = None) -> List[Dict[str, Any]]:
+        docs = self._result()
+        return docs[:length] if length else docs
+
+    def __aiter__(self):
+        return self._iter()
+
+    async def _iter(self):
+        for doc in self._result():
+            yield doc
+
+
+class FakeCollection:
+    """Subconjunto de AsyncIOMotorCollection; `latency_s` simula el viaje al servidor."""
+
+    def __init__(self, name: str, latency_s: float = 0.0):
+        self.name = name
+        self.latency_s = latency_s
+        self.docs: List[Dict[str, Any]] = []
+
+    async def _delay(self) -> None:
+        if self.latency_s:
+            await asyncio.sleep(self.latency_s)
+
+    def find(self, filtro: Optional[Dict[str, Any]] = None, projection=None) -> FakeCursor:
+        filtro = filtro or {}
+        return FakeCursor([_project(d, projection) for d in self.docs if _matches(d, filtro)])
+
+    async def find_one(self, filtro: Optional[Dict[str, Any]] = None, projection=None):
+        await self._delay()
+        filtro = filtro or {}
+        for doc in self.docs:
+            if _matches(doc, filtro):
+                return _project(doc, projection)
+        return None
+
+    async def count_documents(self, filtro: Dict[str, Any]) -> int:
+        await self._delay()
+        return sum(1 for d in self.docs if _matches(d, filtro))
+
+    async def insert_one(self, doc: Dict[str, Any], **kwargs):
+        await self._delay()
+        doc.setdefault("_id", ObjectId())
+        self.docs.append(doc)
+        return _Result(inserted_id=doc["_id"])
+
+    async def insert_many(self, docs: List[Dict[str, Any]], ordered: bool = True, **kwargs):
+        await self._delay()
+        for doc in docs:
+            doc.setdefault("_id", ObjectId())
+        self.docs.extend(docs)
+        return _Result(inserted_ids=[d["_id"] for d in docs])
+
+    def _update(self, doc: Dict[str, Any], update: Dict[str, Any]) -> None:
+        doc.update(update.get("$set", {}))
+        for key in update.get("$unset", {}):
+            doc.pop(key, None)
+
+    async def update_one(self, filtro, update, upsert: bool = False, **kwargs):
+        await self._delay()
+        for doc in self.docs:
+            if _matches(doc, filtro):
+                self._update(doc, update)
+                return _Result(matched_count=1, modified_count=1, upserted_id=None)
+        if upsert:
+            doc = {k: v for k, v in filtro.items() if not isinstance(v, dict)}
+            doc.update(update.get("$setOnInsert", {}))
+            self._update(doc, update)
+            await self.insert_one(doc)
+            return _Result(matched_count=0, modified_count=0, upserted_id=doc["_id"])
+        return _Result(matched_count=0, modified_count=0, upserted_id=None)
+
+    async def update_many(self, filtro, update, upsert: bool = False, **kwargs):
+        await self._delay()
+        n = 0
+        for doc in self.docs:
+            if _matches(doc, filtro):
+                self._update(doc, update)
+                n += 1
+        return _Result(matched_count=n, modified_count=n)
+
+    async def delete_many(self, filtro, **kwargs):
+        await self._delay()
+        antes = len(self.docs)
+        self.docs = [d for d in self.docs if not _matches(d, filtro)]
+        return _Result(deleted_count=antes - len(self.docs))
+
+    async def bulk_write(self, ops, ordered: bool = True, **kwargs):
+        for op in ops:
+            await self.update_one(op._filter, op._doc, upsert=op._upsert)
+
+    def aggregate(self, pipeline) -> FakeCursor:
+        # Los benchmarks no dependen de agregaciones
+        return FakeCursor([])
+
+    async def create_indexes(self, models) -> List[str]:
+        return [m.document["name"] for m in models]
+
+
+class FakeDatabase:
+    """Base de datos en memoria; sin `client`, así que no hay transacciones."""
+
+    client = None
+
+    def __init__(self, latency_s: float = 0.0):
+        self.latency_s = latency_s
+        self._collections: Dict[str, FakeCollection] = {}
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        coll = self._collections.get(name)
+        if coll is None:
+            coll = self._collections[name] = FakeCollection(name, self.latency_s)
+        return coll
+
+    def counts(self) -> Dict[str, int]:
+        return {name: len(c.docs) for name, c in self._collections.items()}
+
+
+def seed_fleet(db: FakeDatabase, users: int, devices: int, variables: int) -> List[Tuple[str, str, str]]:
+    """Crea usuarios/dispositivos/variables y devuelve las series (username, device_id, variable_id)."""
+    series = []
+    for u in range(users):
+        username = f"user{u}"
+        db["usuarios"].docs.append({"_id": ObjectId(), "username": username, "email": f"{username}@bench.local"})
+        for d in range(devices):
+            device_id = f"dev{d}"
+            db["dispositivos"].docs.append({
+                "_id": ObjectId(), "username": username, "device_id": device_id,
+                "name": device_id, "mqtt_username": f"dev_{username}_{device_id}"
+            })
+            for v in range(variables):
+                variable_id = f"var{v}"
+                db["variables"].docs.append({
+                    "_id": ObjectId(), "username": username, "device_id": device_id, "variable_name": variable_id
+                })
+                series.append((username, device_id, variable_id))
+    return series